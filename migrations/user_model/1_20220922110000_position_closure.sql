@@ -0,0 +1,13 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS `user_position_closure` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `depth` INT NOT NULL  COMMENT '相隔层数，0表示自身',
+    `ancestor_id` INT NOT NULL COMMENT '上级职位',
+    `descendant_id` INT NOT NULL COMMENT '下级职位',
+    UNIQUE KEY `uid_user_positi_ancesto_3d102e` (`ancestor_id`, `descendant_id`),
+    CONSTRAINT `fk_user_pos_user_pos_387408e2` FOREIGN KEY (`ancestor_id`) REFERENCES `user_position` (`id`) ON DELETE CASCADE,
+    CONSTRAINT `fk_user_pos_user_pos_ab457c36` FOREIGN KEY (`descendant_id`) REFERENCES `user_position` (`id`) ON DELETE CASCADE,
+    KEY `idx_user_positi_descend_f9d013` (`descendant_id`, `depth`)
+) CHARACTER SET utf8mb4 COMMENT='职位的闭包表，每个职位与其所有上级（包括自身）各一行';
+-- downgrade --
+DROP TABLE IF EXISTS `user_position_closure`;
@@ -0,0 +1,7 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS `user_uid_sequence` (
+    `name` VARCHAR(32) NOT NULL  PRIMARY KEY COMMENT '序列名称',
+    `value` BIGINT NOT NULL  COMMENT '下一个未预留的编号'
+) CHARACTER SET utf8mb4 COMMENT='uid的序列表，每个前缀（年月）一行，由HiLoAllocator按段预留';
+-- downgrade --
+DROP TABLE IF EXISTS `user_uid_sequence`;
@@ -0,0 +1,5 @@
+-- upgrade --
+ALTER TABLE `user_user` MODIFY COLUMN `password` VARCHAR(128) NOT NULL  COMMENT '密码哈希';
+-- downgrade --
+-- pbkdf2_sha256的哈希超过64个字符，降级前需要重置这些用户的密码，否则修改列会失败（严格模式）或截断哈希
+ALTER TABLE `user_user` MODIFY COLUMN `password` VARCHAR(64) NOT NULL  COMMENT '密码';
@@ -2,11 +2,15 @@
 # @Time    : 2021/11/24 9:37
 # @Author  : NotBeBarnon
 # @Description :
+import json
+import subprocess
+import sys
+from typing import List, Tuple
 
 import typer
 import uvicorn
 
-from .settings import HTTP_API_LISTEN_HOST, HTTP_API_LISTEN_PORT
+from .settings import HTTP_API_LISTEN_HOST, HTTP_API_LISTEN_PORT, PROJECT_DIR
 
 Application = typer.Typer()
 
@@ -19,3 +23,50 @@ def run():
         port=HTTP_API_LISTEN_PORT,
         reload=False,
     )
+
+
+@Application.command("profile-startup")
+def profile_startup(
+    top: int = typer.Option(20, help="显示导入耗时最多的模块数量"),
+    project_only: bool = typer.Option(False, "--project-only", help="只显示项目内（src.*）的模块"),
+):
+    """
+    分析服务的启动耗时：在子进程中以 -X importtime 导入 src.faster，统计各模块的导入耗时及各视图集的注册耗时
+    """
+    code_ = (
+        "import json, time;"
+        "start_ = time.perf_counter();"
+        "import src.faster;"
+        "from src.my_tools.fastapi_tools import BaseViewSet;"
+        "print(json.dumps({'total': time.perf_counter() - start_, 'viewsets': BaseViewSet.register_costs()}))"
+    )
+    process_ = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code_],
+        cwd=PROJECT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if process_.returncode != 0:
+        typer.echo(process_.stderr, err=True)
+        raise typer.Exit(process_.returncode)
+
+    # 每行格式：import time: self [us] | cumulative | imported package
+    modules_: List[Tuple[str, int, int]] = []
+    for line_ in process_.stderr.splitlines():
+        if not line_.startswith("import time:") or "self [us]" in line_:
+            continue
+        self_, cumulative_, name_ = line_[len("import time:"):].split("|", 2)
+        name_ = name_.strip()
+        if project_only and not name_.startswith("src."):
+            continue
+        modules_.append((name_, int(self_), int(cumulative_)))
+    result_ = json.loads(process_.stdout.strip().splitlines()[-1])
+
+    typer.echo(f"Import src.faster: {result_['total'] * 1000:.1f} ms\n")
+    typer.echo(f"{'self(ms)':>10} {'cumulative(ms)':>15}  module")
+    for name_, self_, cumulative_ in sorted(modules_, key=lambda item_: item_[1], reverse=True)[:top]:
+        typer.echo(f"{self_ / 1000:>10.1f} {cumulative_ / 1000:>15.1f}  {name_}")
+
+    typer.echo(f"\n{'register(ms)':>12}  viewset")
+    for name_, cost_ in sorted(result_["viewsets"].items(), key=lambda item_: item_[1], reverse=True):
+        typer.echo(f"{cost_ * 1000:>12.1f}  {name_}")
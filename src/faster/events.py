@@ -7,8 +7,14 @@ import logging
 from loguru import logger
 from tortoise import Tortoise
 
+from src.my_tools.executor_tools import executors
+from src.my_tools.fastapi_tools import BaseViewSet
 from src.my_tools.logging_handler import AccessHandler, LoguruHandler
-from src.settings import DATABASE_CONFIG
+from src.my_tools.metrics_tools import request_metrics
+from src.my_tools.tortoise_tools.pools import database_pools
+from src.my_tools.tortoise_tools.routers import read_routing
+from src.my_tools.tortoise_tools.xa_transaction import xa_coordinator
+from src.settings import DATABASE_CONFIG, EXECUTOR_CONFIG, METRICS_CONFIG, READ_ROUTING_CONFIG, XA_CONFIG
 from .apps import fast_app
 
 __all__ = ()
@@ -40,13 +46,72 @@ async def logger_startup() -> None:
         logger_.propagate = False
 
 
+@fast_app.on_event("startup")
+async def executor_startup() -> None:
+    executors.configure(**EXECUTOR_CONFIG)
+    executors.start()
+    logger.info(f"Executors started: {EXECUTOR_CONFIG}")
+
+
+@fast_app.on_event("startup")
+async def metrics_startup() -> None:
+    request_metrics.configure(**METRICS_CONFIG)
+    await request_metrics.start()
+    logger.info(f"Request metrics started: {METRICS_CONFIG}")
+
+
 @fast_app.on_event("startup")
 async def init_orm() -> None:
     await Tortoise.init(config=DATABASE_CONFIG)
-    logger.success(f"Tortoise-ORM started: {Tortoise.apps}")
+    await database_pools.start()
+    logger.success(f"Tortoise-ORM started: {Tortoise.apps}, pools: {database_pools.metrics()}")
+
+
+@fast_app.on_event("startup")
+async def xa_recover() -> None:
+    xa_coordinator.configure(**XA_CONFIG)
+    logger.info(f"XA recovered: {await xa_coordinator.recover()}")
+
+
+@fast_app.on_event("startup")
+async def read_routing_startup() -> None:
+    read_routing.configure(**READ_ROUTING_CONFIG)
+    await read_routing.start()
+    logger.info(f"Read routing started: {READ_ROUTING_CONFIG}")
+
+
+@fast_app.on_event("startup")
+async def viewsets_startup() -> None:
+    await BaseViewSet.startup_all()
+    logger.info("ViewSets started")
+
+
+@fast_app.on_event("shutdown")
+async def viewsets_shutdown() -> None:
+    await BaseViewSet.shutdown_all()
+    logger.info("ViewSets shutdown")
+
+
+@fast_app.on_event("shutdown")
+async def read_routing_shutdown() -> None:
+    await read_routing.stop()
+    logger.info(f"Read routing shutdown: {read_routing.metrics()}")
 
 
 @fast_app.on_event("shutdown")
 async def close_orm() -> None:
+    await database_pools.stop()
     await Tortoise.close_connections()
     logger.info("Tortoise-ORM shutdown")
+
+
+@fast_app.on_event("shutdown")
+async def executor_shutdown() -> None:
+    executors.shutdown()
+    logger.info(f"Executors shutdown: {executors.metrics()}")
+
+
+@fast_app.on_event("shutdown")
+async def metrics_shutdown() -> None:
+    await request_metrics.stop()
+    logger.info("Request metrics shutdown")
@@ -8,6 +8,8 @@ from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, ValidationError as PydanticValidationError
 from tortoise.exceptions import DoesNotExist, IntegrityError, ValidationError as TortoiseValidationError
 
+from src.my_tools.executor_tools import ExecutorBusyError
+from src.my_tools.tortoise_tools.pools import PoolTimeoutError
 from .apps import fast_app
 
 __all__ = ("HTTPError",)
@@ -78,3 +80,27 @@ async def database_validation_exception_handler(request: Request, exc: ValueErro
         status_code=422,
         content={"detail": [{"loc": [], "msg": str(exc), "type": "ValueError"}]},
     )
+
+
+@fast_app.exception_handler(ExecutorBusyError)
+async def executor_busy_exception_handler(request: Request, exc: ExecutorBusyError):
+    """
+    捕获进程池/线程池排队已满的异常，提示客户端稍后重试
+    """
+    return ORJSONResponse(
+        status_code=503,
+        content={"detail": "服务繁忙，请稍后重试"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@fast_app.exception_handler(PoolTimeoutError)
+async def pool_timeout_exception_handler(request: Request, exc: PoolTimeoutError):
+    """
+    捕获获取数据库连接超时的异常，连接池已满时提示客户端稍后重试
+    """
+    return ORJSONResponse(
+        status_code=503,
+        content={"detail": "数据库繁忙，请稍后重试"},
+        headers={"Retry-After": "1"},
+    )
@@ -3,13 +3,23 @@
 # @Author  : NotBeBarnon
 # @Description : FastAPI中间件
 
-from fastapi import Request
-
+from src.my_tools.fastapi_tools import QueryTiming, ReadYourWrites, RequestMiddleware, RouteMetrics
+from src.my_tools.metrics_tools import request_metrics
+from src.my_tools.tortoise_tools.routers import read_routing
+from src.settings import QUERY_TIMING_CONFIG
 from .apps import fast_app
 
 __all__ = ()
 
+read_your_writes = ReadYourWrites(read_routing)
+query_timing = QueryTiming(**QUERY_TIMING_CONFIG)
+route_metrics = RouteMetrics(fast_app, request_metrics)
 
-@fast_app.middleware("http")
-async def middleware_func(request: Request, call_next):
-    return await call_next(request)
+# 写入后的一段时间内同一会话的读取使用主库；统计请求中执行的SQL，输出Server-Timing响应头，发现N+1查询与慢查询；
+# 按路由模板记录请求数、耗时与报文大小。合并为一个纯ASGI中间件，请求合并与固定连接由视图集的路由类处理
+fast_app.add_middleware(
+    RequestMiddleware,
+    read_your_writes=read_your_writes,
+    query_timing=query_timing,
+    route_metrics=route_metrics,
+)
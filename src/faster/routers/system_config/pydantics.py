@@ -3,6 +3,7 @@
 # @Author  : NotBeBarnon
 # @Description :
 from enum import Enum
+from typing import Dict
 
 from pydantic import BaseModel, Field
 
@@ -33,3 +34,39 @@ class LoggerConfigPydantic(BaseModel):
                 "access_file": "INFO",
             }
         }
+
+
+class ExecutorMetricsPydantic(BaseModel):
+    started: bool = Field(..., description="是否已创建")
+    max_workers: int = Field(..., description="最大进程/线程数")
+    max_pending: int = Field(..., description="排队与执行中的任务上限")
+    in_flight: int = Field(..., description="排队与执行中的任务数")
+    submitted: int = Field(..., description="已提交的任务数")
+    completed: int = Field(..., description="已完成的任务数")
+    failed: int = Field(..., description="执行失败的任务数")
+    rejected: int = Field(..., description="等待超时被拒绝的任务数")
+    queue_seconds: float = Field(..., description="在池中排队的总耗时（秒）")
+    run_seconds: float = Field(..., description="执行的总耗时（秒）")
+
+
+class PoolMetricsPydantic(BaseModel):
+    minsize: int = Field(..., description="最小连接数")
+    maxsize: int = Field(..., description="最大连接数，自适应时会变化")
+    size: int = Field(..., description="当前连接数")
+    in_use: int = Field(..., description="使用中的连接数")
+    idle: int = Field(..., description="空闲的连接数")
+    acquires: int = Field(..., description="获取连接的次数")
+    timeouts: int = Field(..., description="获取连接超时的次数")
+    waiting: int = Field(..., description="正在等待连接的数量")
+    wait_seconds: float = Field(..., description="获取连接的总等待时间（秒）")
+    pinned_reuses: int = Field(..., description="复用请求中固定的连接的次数")
+    wait_histogram: Dict[str, int] = Field(..., description="等待时间不超过各个上限（秒）的获取次数，累计计数")
+
+
+class RouteLatencyPydantic(BaseModel):
+    count: int = Field(..., description="请求数")
+    errors: int = Field(..., description="状态码为5xx的请求数")
+    mean: float = Field(..., description="平均耗时（毫秒）")
+    p50: float = Field(..., description="耗时中位数（毫秒），由直方图估算")
+    p90: float = Field(..., description="90分位耗时（毫秒），由直方图估算")
+    p99: float = Field(..., description="99分位耗时（毫秒），由直方图估算，超过最大的桶时为最大的桶上限")
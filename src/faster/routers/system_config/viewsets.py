@@ -3,18 +3,22 @@
 # @Author  : NotBeBarnon
 # @Description :
 from fastapi import APIRouter
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from loguru import logger
 
-from src.my_tools.fastapi_tools import BaseViewSet, Action
-from src.settings import LOGGER_CONFIG, LOGGERS_ID
+from src.my_tools.executor_tools import executors
+from src.my_tools.fastapi_tools import BaseViewSet, Action, ViewSetScopeEnum
+from src.my_tools.metrics_tools import request_metrics
+from src.my_tools.tortoise_tools.pools import database_pools
+from src.settings import HTTP_BASE_URL, LOGGER_CONFIG, LOGGERS_ID
 from . import app_name
 from .pydantics import *
 
-system_config_routers = APIRouter(prefix=f"/{app_name}")
+system_config_routers = APIRouter(prefix=f"{HTTP_BASE_URL}/{app_name}")
 
 
 class LoggerViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
 
     @Action.get("", response_model=LoggerConfigPydantic)
     async def get_config(self):
@@ -53,3 +57,52 @@ class LoggerViewSet(BaseViewSet):
 
 
 LoggerViewSet.register(system_config_routers)
+
+
+class ExecutorViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
+
+    @Action.get("", response_model=Dict[str, ExecutorMetricsPydantic])
+    async def metrics(self):
+        """
+        获取进程池与线程池的排队及执行情况
+        """
+        return executors.metrics()
+
+
+ExecutorViewSet.register(system_config_routers)
+
+
+class DatabaseViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
+
+    @Action.get("/pools", response_model=Dict[str, PoolMetricsPydantic])
+    async def pools(self):
+        """
+        获取各个数据库连接的连接池使用情况
+        """
+        return database_pools.metrics()
+
+
+DatabaseViewSet.register(system_config_routers)
+
+
+class MetricsViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
+
+    @Action.get("", response_class=PlainTextResponse)
+    async def exposition(self):
+        """
+        Prometheus文本格式的请求指标，包括所有worker进程
+        """
+        return PlainTextResponse(request_metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @Action.get("/routes", response_model=Dict[str, RouteLatencyPydantic])
+    async def routes(self):
+        """
+        获取各个路由的请求数与耗时分位数
+        """
+        return request_metrics.route_summary()
+
+
+MetricsViewSet.register(system_config_routers)
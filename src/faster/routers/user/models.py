@@ -18,7 +18,7 @@ class User(models.Model):
     user_number = fields.IntField(null=True, description="用户编号")
     uid = fields.CharField(max_length=10, unique=True, description="用户UID，唯一标识用户", pk=True)
     username = fields.CharField(max_length=32, description="用户名")
-    password = fields.CharField(max_length=64, description="密码")
+    password = fields.CharField(max_length=128, description="密码哈希")
 
     name = fields.CharField(max_length=32, null=True, description="用户的名字")
     family_name = fields.CharField(max_length=32, null=True, description="用户的姓氏")
@@ -56,6 +56,17 @@ class User(models.Model):
         table = f"{app_name}_user"
 
 
+class UidSequence(models.Model):
+    """
+    uid的序列表，每个前缀（年月）一行，由HiLoAllocator按段预留
+    """
+    name = fields.CharField(max_length=32, pk=True, description="序列名称")
+    value = fields.BigIntField(description="下一个未预留的编号")
+
+    class Meta:
+        table = f"{app_name}_uid_sequence"
+
+
 class PositionLevelEnum(IntEnum):
     one = 1
     two = 2
@@ -83,6 +94,7 @@ class Position(models.Model):
 
     class PydanticMeta:
         allow_cycles = True  # 允许循环引用，外键关联
+        exclude = ("descendant_links", "ancestor_links")  # 闭包表只用于层级查询
 
     #   max_recursion = 1  # 最大递归深度
 
@@ -90,6 +102,20 @@ class Position(models.Model):
         table = f"{app_name}_position"
 
 
+class PositionClosure(models.Model):
+    """
+    职位的闭包表，每个职位与其所有上级（包括自身）各一行
+    """
+    ancestor = fields.ForeignKeyField("user_model.Position", related_name="descendant_links", description="上级职位", on_delete=fields.CASCADE)
+    descendant = fields.ForeignKeyField("user_model.Position", related_name="ancestor_links", description="下级职位", on_delete=fields.CASCADE)
+    depth = fields.IntField(description="相隔层数，0表示自身")
+
+    class Meta:
+        table = f"{app_name}_position_closure"
+        unique_together = (("ancestor", "descendant"),)
+        indexes = (("descendant", "depth"),)
+
+
 class Company(models.Model):
     """
     公司
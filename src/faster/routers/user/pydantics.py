@@ -149,6 +149,27 @@ class PositionTreePydantic(PositionTreeBasePydantic):
         title = "PositionTreePydantic"
 
 
+class PositionNodePydantic(BaseModel):
+    """
+    职位树索引中的节点
+    """
+    id: int = Field(..., description="职位id")
+    name: str = Field(..., description="职位名称")
+    level: PositionLevelEnum = Field(..., description="职位级别")
+    company_id: int = Field(..., description="公司id")
+    higher_id: int = Field(None, description="上级职位id")
+
+
+class PositionNodeTreePydantic(PositionNodePydantic):
+    """
+    不限层级的职位树
+    """
+    lowers: List["PositionNodeTreePydantic"] = Field([], description="下级职位")
+
+
+PositionNodeTreePydantic.update_forward_refs()
+
+
 class PositionCreatePydantic(
     pydantic_model_creator(
         Position,
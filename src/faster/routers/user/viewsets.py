@@ -3,25 +3,66 @@
 # @Author  : NotBeBarnon
 # @Description :
 import asyncio
+import time
+from typing import AsyncIterator, Dict, List, Set, Tuple
 
 import arrow
 import orjson
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Query, Request, Response
 from fastapi.responses import ORJSONResponse
 from loguru import logger
+from pydantic import ValidationError
 from starlette import status
 from tortoise.contrib.fastapi import HTTPNotFoundError
-from tortoise.functions import Count
-
-from src.my_tools.fastapi_tools import Action, BaseViewSet
+from tortoise.transactions import in_transaction
+
+from src.my_tools.fastapi_tools import (
+    Action,
+    BaseViewSet,
+    CompiledSerializer,
+    RelationPlan,
+    ResponseCache,
+    Rule,
+    StreamFormatEnum,
+    UploadFormatEnum,
+    ViewSetScopeEnum,
+    conditional_delete,
+    conditional_update,
+    make_version_etag,
+    validate_all,
+)
+from src.my_tools.fastapi_tools.factory import generate_bulk_delete, generate_delete
+from src.my_tools.fastapi_tools.pydantics import BulkItemResultPydantic, ImportResultPydantic
+from src.my_tools.fastapi_tools.uploads import AdaptiveBatchSize, UploadRecord, iter_batches, iter_records
+from src.my_tools.executor_tools import run_cpu
 from src.my_tools.password_tools import make_password
-from src.settings import LOCAL_TIMEZONE
+from src.my_tools.tortoise_tools.closure import ClosureTable
+from src.my_tools.tortoise_tools.sequence import HiLoAllocator
+from src.my_tools.tortoise_tools.tree import TreeIndex, TreeIndexCache
+from src.settings import HTTP_BASE_URL, LOCAL_TIMEZONE
 from .pydantics import *
 
-user_routers = APIRouter(prefix=f"/{app_name}")
+user_routers = APIRouter(prefix=f"{HTTP_BASE_URL}/{app_name}")
+
+
+async def initial_uid_of(pre: str) -> int:
+    """
+    新的前缀从已有uid的最大编号之后开始
+    """
+    uid_ = await User.filter(uid__startswith=pre).order_by("-uid").first().values_list("uid", flat=True)
+    return int(uid_[len(pre):]) + 1 if uid_ else 1
+
+
+uid_allocator = HiLoAllocator(UidSequence, block_size=20, initial=initial_uid_of)
 
 
 class UserViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
+
+    @classmethod
+    async def on_startup(cls):
+        # 预先编译序列化器，避免第一个请求承担编译的耗时
+        CompiledSerializer.of(UserIncludeCompanyAndPositionPydantic).columns
 
     @Action("", methods=["POST"], response_model=UserIncludeCompanyAndPositionPydantic)
     async def create(self, user: UserCreatePydantic):
@@ -30,22 +71,17 @@ class UserViewSet(BaseViewSet):
         """
 
         create_dict_ = user.dict(exclude={"password_again"})
-        create_dict_["password"] = make_password(user.password)
-        # 生成uid
+        create_dict_["password"] = await run_cpu(make_password, user.password)
+        # 生成uid，前缀变化后使用新的序列
         pre_ = arrow.now(tz=LOCAL_TIMEZONE).format("YYMM")
-        suf_ = await User.filter(uid__startswith=pre_).count()
-        create_dict_["uid"] = f"{pre_}{suf_ + 1:05d}"
+        create_dict_["uid"] = f"{pre_}{await uid_allocator.next(pre_):05d}"
         user_obj = await User.create(**create_dict_)
-        return await UserIncludeCompanyAndPositionPydantic.from_tortoise_orm(user_obj)
+        return await RelationPlan.of(UserIncludeCompanyAndPositionPydantic).from_tortoise_orm(user_obj)
 
-    # @redis_client(RedisNamespace.key(b"rcu_info:all"), Response(headers={"Content-Type": "application/json"}), ex_pttl=10000)
-    @Action.get("/cache_sample")
+    @Action.get("/cache_sample", cache=10)
     async def cache_sample(self):
         logger.info("<Key:cache_sample> visiting Database")
         await asyncio.sleep(0.5)
-        # with redis_client.get_client(SentinelNodeEnum.master) as client:
-        #     assert isinstance(client, Redis)
-        #     await client.set(RedisNamespace.key(b"cache_sample"), orjson.dumps({"success": "Hello World!"}), ex=10)
         return Response(
             content=orjson.dumps({"success": "Hello World!"}),
             headers={
@@ -58,70 +94,175 @@ class UserViewSet(BaseViewSet):
     async def cache_query_list(self, beams: List[int]):
         pass
 
-    @Action("/all", methods=["GET"], response_model=List[UserIncludeCompanyAndPositionPydantic])
+    @Action("/all", methods=["GET"], response_model=List[UserIncludeCompanyAndPositionPydantic],
+            stream=StreamFormatEnum.json_array, projection=True, compiled=True)
     async def all(self, response: Response):
         """
         查询所有用户
         """
         response.headers["No-Cache"] = "no_cache"
-        return await UserIncludeCompanyAndPositionPydantic.from_queryset(User.all())
+        return User.all()
 
     @Action("/{uid}", methods=["GET"], response_model=UserIncludeCompanyAndPositionPydantic,
-            responses={404: {"model": HTTPNotFoundError}})
+            responses={404: {"model": HTTPNotFoundError}}, projection=True, etag="modified_at", coalesce=True, compiled=True)
     async def get(self, uid: str):
         """
-        查询用户信息
+        查询用户信息，ETag由modified_at与响应内容生成，公司与职位的变更也会使其失效，可用于修改与删除的If-Match
         """
-        return await UserIncludeCompanyAndPositionPydantic.from_queryset_single(User.get(uid=uid))
+        return User.get(uid=uid)
 
     @Action("/{uid}", methods=["PATCH"], response_model=UserIncludeCompanyAndPositionPydantic,
-            responses={404: {"model": HTTPNotFoundError}})
-    async def update(self, uid: str, user: UserUpdatePydantic):
+            responses={404: {"model": HTTPNotFoundError}, 412: {"model": HTTPNotFoundError}})
+    async def update(self, uid: str, user: UserUpdatePydantic, response: Response,
+                     if_match: str = Header(None, description="get接口返回的ETag，数据已被修改时返回412"),
+                     prefer: str = Header(None, description="return=minimal 时返回204，不再查询数据")):
         """
         修改用户信息
         """
         # 密码加密
         update_dict_ = user.dict(exclude={"password_again"}, exclude_unset=True, exclude_defaults=True)
         if "password" in update_dict_:
-            update_dict_["password"] = make_password(update_dict_["password"])
-        await User.filter(uid=uid).update(**update_dict_)
-        return await UserIncludeCompanyAndPositionPydantic.from_queryset_single(User.get(uid=uid))
+            update_dict_["password"] = await run_cpu(make_password, update_dict_["password"])
+        # 没有需要修改的字段时conditional_update不写入，modified_at不变，已有的ETag仍然有效
+        etag_ = make_version_etag(await conditional_update(User, uid, update_dict_, "modified_at", if_match))
+        if prefer and "return=minimal" in prefer:
+            return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"ETag": etag_})
+        response.headers["ETag"] = etag_
+        return User.get(uid=uid)
 
     @Action("/{uid}", methods=["DELETE"], response_model=UserIncludeCompanyAndPositionPydantic,
-            responses={404: {"model": HTTPNotFoundError}})
-    async def delete(self, uid: str):
+            responses={404: {"model": HTTPNotFoundError}, 412: {"model": HTTPNotFoundError}})
+    async def delete(self, uid: str, if_match: str = Header(None, description="get接口返回的ETag，数据已被修改时返回412")):
         """
         删除用户
         """
         user_obj = await User.get(uid=uid)
-        deleted_count_ = await User.filter(uid=uid).delete()
-        return await UserIncludeCompanyAndPositionPydantic.from_tortoise_orm(user_obj)
+        await conditional_delete(User, uid, "modified_at", if_match)
+        return await RelationPlan.of(UserIncludeCompanyAndPositionPydantic).from_tortoise_orm(user_obj)
 
 
 UserViewSet.register(user_routers)
 
 
+class CompanyUsersImporter(object):
+    """
+    将上传的用户逐批加入公司
+    - 每批的职位与用户分别用一条IN查询校验，已校验的职位在批之间复用
+    - 每批按职位分组，每个职位一条UPDATE，在一个事务中执行
+    - 失败的行记录原因后跳过，不影响其他行
+    """
+
+    def __init__(self, company_id: int):
+        self.company_id = company_id
+        self.seen_uids: Set[str] = set()
+        self.positions: Dict[int, bool] = {}  # 职位id: 是否属于此公司
+        self.result = ImportResultPydantic()
+
+    async def run(self, records: AsyncIterator[UploadRecord]) -> ImportResultPydantic:
+        start_ = time.perf_counter()
+        batch_size_ = AdaptiveBatchSize()
+        async for batch_ in iter_batches(records, batch_size_):
+            batch_start_ = time.perf_counter()
+            await self.import_batch(batch_)
+            batch_size_.record(len(batch_), time.perf_counter() - batch_start_)
+        self.result.elapsed = round(time.perf_counter() - start_, 3)
+        self.result.errors.sort(key=lambda error_: error_.line)
+        return self.result
+
+    async def import_batch(self, batch: List[UploadRecord]):
+        self.result.total += len(batch)
+        self.result.batches += 1
+        rows_: List[Tuple[int, CompanyAddUsersPydantic]] = []
+        for line_, record_, error_ in batch:
+            if error_ is not None:
+                self.result.add_error(line_, None, error_)
+                continue
+            try:
+                user_info_ = CompanyAddUsersPydantic.parse_obj(record_)
+            except ValidationError as exc:
+                self.result.add_error(line_, record_.get("uid"), "; ".join(f"{error_['loc'][0]}: {error_['msg']}" for error_ in exc.errors()))
+                continue
+            if user_info_.uid in self.seen_uids:
+                self.result.add_error(line_, user_info_.uid, "用户uid不能重复")
+                continue
+            self.seen_uids.add(user_info_.uid)
+            rows_.append((line_, user_info_))
+
+        unknown_positions_ = {user_info_.position_id for _, user_info_ in rows_} - self.positions.keys()
+        if unknown_positions_:
+            valid_ = set(await Position.filter(id__in=unknown_positions_, company_id=self.company_id).values_list("id", flat=True))
+            self.positions.update({position_id_: position_id_ in valid_ for position_id_ in unknown_positions_})
+        existing_uids_ = set(await User.filter(uid__in=[user_info_.uid for _, user_info_ in rows_]).values_list("uid", flat=True))
+
+        groups_: Dict[int, List[str]] = {}
+        for line_, user_info_ in rows_:
+            if not self.positions[user_info_.position_id]:
+                self.result.add_error(line_, user_info_.uid, "用户职位不存在")
+            elif user_info_.uid not in existing_uids_:
+                self.result.add_error(line_, user_info_.uid, "用户不存在")
+            else:
+                groups_.setdefault(user_info_.position_id, []).append(user_info_.uid)
+        if not groups_:
+            return
+        async with in_transaction("master") as connection_:
+            for position_id_, uids_ in groups_.items():
+                await User.filter(uid__in=uids_).using_db(connection_).update(company_id=self.company_id, position_id=position_id_)
+        self.result.success += sum(len(uids_) for uids_ in groups_.values())
+
+
+# 删除公司会级联删除职位，在生成的删除视图之后清理职位树的缓存
+_delete_company = generate_delete(Company, CompanyPydantic, int, fast_write=True)
+_bulk_delete_companies = generate_bulk_delete(Company, int)
+
+
 class CompanyViewSet(BaseViewSet):
     model = Company
     schema = CompanyPydantic
     pk_name = "id"
     pk_type = int
     page_size = 10
+    scope = ViewSetScopeEnum.singleton
+    etag = True
+    fast_write = True
+    compiled_serializer = True
     views = {
         "all": None,
         "create": CompanyCreatePydantic,
         "get": None,
         "update": CompanyUpdatePydantic,
-        "delete": None,
+        "bulk_create": CompanyCreatePydantic,
+        "bulk_update": CompanyUpdatePydantic,
     }
 
-    @Action.get("/query_company_include_users", response_model=List[CompanyIncludeUsersPydantic])
+    @Action.get("/query_company_include_users", response_model=List[CompanyIncludeUsersPydantic],
+                stream=StreamFormatEnum.json_array)
     async def query_company_include_users(self, company_id: int = None):
         if company_id:
-            return await CompanyIncludeUsersPydantic.from_queryset(Company.filter(id=company_id))
-        return await CompanyIncludeUsersPydantic.from_queryset(Company.all())
+            return Company.filter(id=company_id)
+        return Company.all()
+
+    @Action.delete("/{pk}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response,
+                   responses={404: {"model": HTTPNotFoundError}, 412: {"model": HTTPNotFoundError}})
+    async def delete(self, pk: int, if_match: str = Header(None, description="数据的ETag，版本不一致时返回412")):
+        """
+        删除公司，公司的职位随外键级联删除，同时清理职位树的缓存
+        """
+        response_ = await _delete_company(self, pk, if_match)
+        invalidate_position_tree(pk)
+        return response_
+
+    @Action.delete("/bulk", response_model=List[BulkItemResultPydantic])
+    async def bulk_delete(self, body: List[int] = Body(..., description="主键列表")):
+        """
+        在一个事务中批量删除公司，同时清理职位树的缓存
+        """
+        results_ = await _bulk_delete_companies(self, body)
+        for result_ in results_:
+            if result_.success:
+                invalidate_position_tree(result_.pk)
+        return results_
 
-    @Action.patch("/{company_id}/add_users", response_model=CompanyPydantic)
+    @Action.patch("/{company_id}/add_users", response_model=CompanyPydantic, pin_connections=True)
     async def add_users(self, company_id: int, users_info: List[CompanyAddUsersPydantic]):
         """为公司添加用户"""
         company_obj = await Company.get(id=company_id)
@@ -135,36 +276,51 @@ class CompanyViewSet(BaseViewSet):
             position_set.add(user_info_.position_id)
             users_obj.append(User(uid=user_info_.uid, position_id=user_info_.position_id, company_id=company_id))
 
-        # 校验职位是否存在
-        position_num_ = len(position_set)
-        p_count_ = await Position.annotate(num_count=Count('id')).filter(id__in=position_set,
-                                                                         company_id=company_id).limit(
-            position_num_).first()
-        if p_count_.num_count != position_num_:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="部分用户职位不存在")
-
-        # 校验用户是否都存在
-        user_num_ = len(user_set)
-        u_count_ = await User.annotate(num_count=Count('uid')).filter(uid__in=user_set).limit(user_num_).first()
-        if u_count_.num_count != user_num_:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="部分用户不存在")
+        # 校验职位与用户是否存在
+        position_num_, user_num_ = len(position_set), len(user_set)
+        await validate_all(
+            Rule(
+                Position.filter(id__in=position_set, company_id=company_id).count(),
+                "部分用户职位不存在",
+                expect=lambda count_: count_ == position_num_,
+            ),
+            Rule(User.filter(uid__in=user_set).count(), "部分用户不存在", expect=lambda count_: count_ == user_num_),
+        )
 
         # 更新
         num_ = await User.bulk_update(users_obj, ["company_id", "position_id"], batch_size=10)
         return await CompanyPydantic.from_tortoise_orm(company_obj)
 
+    @Action.post("/{company_id}/import_users", response_model=ImportResultPydantic)
+    async def import_users(self, company_id: int, request: Request,
+                           upload_format: UploadFormatEnum = Query(None, alias="format", description="不传时根据Content-Type判断")):
+        """
+        流式导入公司用户，请求体直接为文件内容，大小不受限制
+        - ndjson: 每行一个 {"uid": "...", "position_id": 1}
+        - csv: 第一行为表头 uid,position_id
+        - 失败的行会跳过，并在结果中返回原因
+        """
+        if not await Company.exists(id=company_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="公司不存在")
+        upload_format_ = upload_format or UploadFormatEnum.of(request.headers.get("content-type"))
+        result_ = await CompanyUsersImporter(company_id).run(iter_records(request, upload_format_))
+        logger.info(f"Import users into company {company_id}: total={result_.total} success={result_.success} "
+                    f"failed={result_.failed} batches={result_.batches} elapsed={result_.elapsed}s")
+        return result_
+
 
 CompanyViewSet.register(user_routers)
 
 
+# 职位的上下级关系，用于检测环与查询所有下级
+position_closure = ClosureTable(PositionClosure)
+
+
 class PositionDepends(object):
 
     @classmethod
     async def validator_info_of_create(cls, body: PositionCreatePydantic):
-        if not await Company.exists(id=body.company_id):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="所选公司不存在")
-
-        if body.higher_id:
+        async def check_higher_():
             higher_position_obj = await Position.get_or_none(id=body.higher_id, company_id=body.company_id)
             if higher_position_obj is None:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="所选上级职位在此公司不存在")
@@ -172,21 +328,18 @@ class PositionDepends(object):
             if body.level <= higher_position_obj.level:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="职位级别必须小于上级职位")
 
-        if await Position.exists(company_id=body.company_id, name=body.name):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="职位名称在此公司已存在")
-
+        await validate_all(
+            Rule.must(Company.exists(id=body.company_id), "所选公司不存在"),
+            Rule.custom(check_higher_()) if body.higher_id else None,
+            Rule.must_not(Position.exists(company_id=body.company_id, name=body.name), "职位名称在此公司已存在"),
+        )
         return body
 
     @classmethod
     async def validator_info_of_update(cls, pk: int, body: PositionUpdatePydantic):
         position_obj = await Position.get(id=pk)
-        if body.name and await Position.exists(company_id=body.company_id, name=body.name, id__not=pk):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="职位名称在此公司已被其他职位使用")
-
-        if body.higher_id or body.level:
-            body.level = body.level or position_obj.level
-            body.higher_id = body.higher_id or position_obj.higher_id
 
+        async def check_higher_():
             higher_position_obj = await Position.get_or_none(id=body.higher_id, company_id=position_obj.company_id,
                                                              id__not=pk)
             if higher_position_obj is None:
@@ -195,72 +348,200 @@ class PositionDepends(object):
             if body.level <= higher_position_obj.level:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="职位级别必须小于上级职位")
 
+        check_higher_or_level_ = bool(body.higher_id or body.level)
+        if check_higher_or_level_:
+            body.level = body.level or position_obj.level
+            body.higher_id = body.higher_id or position_obj.higher_id
+
+        await validate_all(
+            Rule.must_not(
+                Position.exists(company_id=position_obj.company_id, name=body.name, id__not=pk),
+                "职位名称在此公司已被其他职位使用",
+            ) if body.name else None,
+            Rule.custom(check_higher_()) if check_higher_or_level_ else None,
+            Rule.must_not(
+                position_closure.is_descendant(body.higher_id, pk),
+                "上级职位不能是此职位的下级",
+            ) if check_higher_or_level_ else None,
+        )
         return body
 
     @classmethod
     async def validator_add_lowers(cls, pk: int, body: AddLowersPositionPydantic):
         position_obj = await Position.get(pk=pk)
         position_num_ = len(body.lowers)
-        p_count_ = await Position.annotate(num_count=Count('id')).filter(id__in=body.lowers,
-                                                                         company_id=position_obj.company_id).limit(
-            position_num_).first()
-        if p_count_.num_count != position_num_:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="部分职位不存在")
-        if await Position.exists(id__in=body.lowers, level__lte=position_obj.level):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="下级职位级别必须比此职位小")
+        await validate_all(
+            Rule(
+                Position.filter(id__in=body.lowers, company_id=position_obj.company_id).count(),
+                "部分职位不存在",
+                expect=lambda count_: count_ == position_num_,
+            ),
+            Rule.must_not(Position.exists(id__in=body.lowers, level__lte=position_obj.level), "下级职位级别必须比此职位小"),
+            Rule.must_not(
+                position_closure.is_descendant_of_any(pk, body.lowers, include_self=True),
+                "下级职位不能是此职位或其上级",
+            ),
+        )
         return body
 
 
+# 职位树的查询较重，数据变更时清理。
+# 缓存在进程内，清理只对当前进程生效：其他进程的变更在索引（10秒）与响应缓存（5秒）都过期后可见，最多约15秒，
+# 读写一致性（ReadYourWrites）只保证读主库，不包括这两层缓存
+position_tree_cache = ResponseCache(ttl=5, maxsize=128, stale_ttl=5)
+# 每个公司的职位一次查询建立索引，树、子树与上级路径都从索引生成
+position_tree_index = TreeIndexCache(
+    Position,
+    group_field="company_id",
+    parent_field="higher_id",
+    fields=("name", "level", "company_id"),
+    children_key="lowers",
+    ttl=10,
+)
+
+
+def invalidate_position_tree(company_id: int):
+    position_tree_index.invalidate(company_id)
+    position_tree_cache.invalidate()
+
+
+async def position_tree_index_of(pk: int) -> TreeIndex:
+    company_id_ = await Position.filter(pk=pk).first().values_list("company_id", flat=True)
+    if company_id_ is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="职位不存在")
+    index_ = await position_tree_index.get(company_id_)
+    if pk not in index_:
+        # 其他进程新建的职位，本进程的索引还未过期
+        position_tree_index.invalidate(company_id_)
+        index_ = await position_tree_index.get(company_id_)
+    return index_
+
+
 class PositionViewSet(BaseViewSet):
     model = Position
     schema = PositionPydantic
     pk_name = "id"
     pk_type = int
     page_size = 10
+    scope = ViewSetScopeEnum.singleton
     views = {
         "all": None,
-        "delete": None,
     }
 
-    @Action.post("", response_model=PositionPydantic)
+    @classmethod
+    async def on_startup(cls):
+        # 启用闭包表前已经存在的职位，第一次启动时生成其上下级关系。
+        # 表由迁移（migrations/user_model/1_*_position_closure.sql）创建，未迁移或多个进程同时重建失败时只记录日志，不影响启动
+        try:
+            if not await PositionClosure.exists() and await Position.exists():
+                await position_closure.rebuild(await Position.all().values_list("id", "higher_id"))
+        except Exception as exc:
+            logger.exception(
+                f"Rebuild position closure failed, run \"aerich upgrade\" and restart - {exc.__class__.__name__}:{exc}"
+            )
+
+    @classmethod
+    async def on_shutdown(cls):
+        position_tree_index.invalidate()
+        position_tree_cache.invalidate()
+
+    @Action.post("", response_model=PositionPydantic, pin_connections=True)
     async def create(self, body: PositionCreatePydantic = Depends(PositionDepends.validator_info_of_create)):
         """
         在指定公司创建一个职位
         - level: 职位级别，从1开始，1表示最高级
         """
-        return await PositionPydantic.from_tortoise_orm(await Position.create(**body.dict(exclude_unset=True)))
+        async with in_transaction("master") as connection_:
+            position_obj = await Position.create(**body.dict(exclude_unset=True), using_db=connection_)
+            await position_closure.insert(position_obj.id, position_obj.higher_id, connection_)
+        invalidate_position_tree(position_obj.company_id)
+        return await PositionPydantic.from_tortoise_orm(position_obj)
 
-    @Action.patch("/{pk}", response_model=PositionTreePydantic)
+    @Action.patch("/{pk}", response_model=PositionTreePydantic, pin_connections=True)
     async def update(self, pk: int, body: PositionUpdatePydantic = Depends(PositionDepends.validator_info_of_update)):
-        await Position.filter(pk=pk).update(**body.dict(exclude_unset=True))
-        return await PositionTreePydantic.from_queryset_single(Position.get(pk=pk))
-
-    @Action.get("/{pk}", response_model=PositionTreePydantic)
+        position_obj = await Position.get(pk=pk)
+        update_dict_ = body.dict(exclude_unset=True)
+        async with in_transaction("master") as connection_:
+            await Position.filter(pk=pk).using_db(connection_).update(**update_dict_)
+            if "higher_id" in update_dict_ and update_dict_["higher_id"] != position_obj.higher_id:
+                await position_closure.move(pk, update_dict_["higher_id"], connection_)
+        invalidate_position_tree(position_obj.company_id)
+        return Position.get(pk=pk)
+
+    @Action.get("/{pk}", response_model=PositionTreePydantic, etag=True)
     async def get(self, pk: int):
-        return await PositionTreePydantic.from_queryset_single(Position.get(pk=pk))
+        return Position.get(pk=pk)
 
-    @Action.get("/tree", response_model=PositionTreePydantic)
-    async def tree(self, company_id: int = None, level: int = None):
-        """获取职位树状图"""
-        filter_dict = {"higher_id": None}
-        if company_id:
-            filter_dict["company_id"] = company_id
+    @Action.get("/tree", response_model=List[PositionNodeTreePydantic], cache=position_tree_cache, coalesce=True)
+    async def tree(self, company_id: int = None, level: int = None, depth: int = Query(None, ge=0)):
+        """
+        获取职位树状图
+        - depth: 下级职位的层数，不传时返回完整的树
+        """
+        index_ = await position_tree_index.get(company_id) if company_id else await position_tree_index.get()
+        roots_ = [pk_ for pk_ in index_.roots if index_.nodes[pk_]["higher_id"] is None]
         if level:
-            filter_dict["level"] = level
+            roots_ = [pk_ for pk_ in roots_ if index_.nodes[pk_]["level"] == level]
+        return index_.build(roots_, depth)
+
+    @Action.get("/{pk}/subtree", response_model=PositionNodeTreePydantic, cache=position_tree_cache, coalesce=True)
+    async def subtree(self, pk: int, depth: int = Query(None, ge=0)):
+        """
+        获取以此职位为根的子树
+        - depth: 下级职位的层数，不传时返回完整的子树
+        """
+        index_ = await position_tree_index_of(pk)
+        return index_.subtree(pk, depth)
+
+    @Action.get("/{pk}/descendant_ids", response_model=List[int])
+    async def descendant_ids(self, pk: int, depth: int = Query(None, ge=1)):
+        """
+        获取此职位所有下级的id，按层级排序
+        - depth: 下级职位的层数，不传时返回全部下级
+        """
+        return await position_closure.descendants(pk, depth)
 
-        return await PositionTreePydantic.from_queryset(Position.filter(**filter_dict))
+    @Action.get("/{pk}/ancestors", response_model=List[PositionNodePydantic], cache=position_tree_cache)
+    async def ancestors(self, pk: int):
+        """
+        获取从最高级职位到此职位的路径
+        """
+        index_ = await position_tree_index_of(pk)
+        return index_.path(pk)
 
-    @Action.post("/{pk}/add_lowers", response_model=PositionTreePydantic)
+    @Action.post("/{pk}/add_lowers", response_model=PositionTreePydantic, pin_connections=True)
     async def add_lowers(self, pk: int,
                          body: AddLowersPositionPydantic = Depends(PositionDepends.validator_add_lowers)):
-        await Position.filter(pk__in=body.lowers).update(higher_id=pk)
-        return await PositionTreePydantic.from_queryset_single(Position.get(pk=pk))
+        async with in_transaction("master") as connection_:
+            await Position.filter(pk__in=body.lowers).using_db(connection_).update(higher_id=pk)
+            for lower_ in body.lowers:
+                await position_closure.move(lower_, pk, connection_)
+        invalidate_position_tree((await Position.get(pk=pk)).company_id)
+        return Position.get(pk=pk)
+
+    @Action.delete("/{pk}", response_model=PositionPydantic, responses={404: {"model": HTTPNotFoundError}},
+                   pin_connections=True)
+    async def delete(self, pk: int):
+        """
+        删除职位，其直接下级成为最高级职位（与外键的SET_NULL一致），下级的子树保持不变
+        """
+        position_obj = await Position.get(pk=pk)
+        async with in_transaction("master") as connection_:
+            lowers_ = await Position.filter(higher_id=pk).using_db(connection_).values_list("id", flat=True)
+            await Position.filter(id__in=lowers_).using_db(connection_).update(higher_id=None)
+            for lower_ in lowers_:
+                # 外键的级联删除只删除引用此职位的行，此职位的上级到下级子树的路径需要先移除
+                await position_closure.move(lower_, None, connection_)
+            await Position.filter(pk=pk).using_db(connection_).delete()
+        invalidate_position_tree(position_obj.company_id)
+        return await PositionPydantic.from_tortoise_orm(position_obj)
 
 
 PositionViewSet.register(user_routers)
 
 
 class QuerySetTestViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.singleton
 
     @Action.get("/all_values")
     async def all_values(self):
@@ -316,6 +597,8 @@ class DependsTestDepends(object):
 
 
 class DependsTestViewSet(BaseViewSet):
+    scope = ViewSetScopeEnum.pool
+    pool_size = 4
 
     @Action.get("/depends", response_model=UserIncludeCompanyAndPositionPydantic)
     async def depends(self, user_obj: User = Depends(DependsTestDepends.get_user), company: int = None):
@@ -323,7 +606,7 @@ class DependsTestViewSet(BaseViewSet):
         Depends测试
         """
         if user_obj:
-            return await UserIncludeCompanyAndPositionPydantic.from_tortoise_orm(user_obj)
+            return await RelationPlan.of(UserIncludeCompanyAndPositionPydantic).from_tortoise_orm(user_obj)
         else:
             return ORJSONResponse(status_code=status.HTTP_201_CREATED)
 
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/9 10:30
+# @Author  : NotBeBarnon
+# @Description : 进程池与线程池，将CPU密集或阻塞的调用移出事件循环
+import asyncio
+import multiprocessing
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+__all__ = (
+    "ExecutorBusyError",
+    "ManagedExecutor",
+    "ExecutorManager",
+    "executors",
+    "run_cpu",
+    "run_in_thread",
+)
+
+T = TypeVar("T")
+
+
+class ExecutorBusyError(RuntimeError):
+    """
+    等待执行的任务过多，在超时时间内没有空位
+    """
+
+
+def _timed(fn: Callable[..., T], *args: Any, **kwargs: Any) -> Tuple[T, float, float]:
+    """
+    在executor中执行，返回结果、开始执行的时间戳与执行耗时，用于区分排队与执行的耗时
+    """
+    started_at_ = time.time()
+    start_ = time.perf_counter()
+    return fn(*args, **kwargs), started_at_, time.perf_counter() - start_
+
+
+class ManagedExecutor(object):
+    """
+    带排队上限与指标的executor
+    - 同时提交（排队+执行）的任务数不超过max_pending，超过时等待空位，超时抛出ExecutorBusyError
+    - 第一次提交时才创建executor，未调用start时也可以使用
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Executor], max_workers: int, max_pending: int,
+                 wait_timeout: float = 10, prewarm: bool = False):
+        self.name = name
+        self.prewarm = prewarm
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self.__factory = factory
+        self.__executor: Optional[Executor] = None
+        self.__slots: Optional[asyncio.Semaphore] = None
+        # 指标
+        self.in_flight = 0  # 已提交未完成（排队+执行）的任务数
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0  # 等待空位超时被拒绝的任务数
+        self.queue_seconds = 0.0  # 在executor中排队的总耗时
+        self.run_seconds = 0.0  # 执行的总耗时
+
+    @property
+    def started(self) -> bool:
+        return self.__executor is not None
+
+    def start(self):
+        if self.__executor is None:
+            self.__executor = self.__factory()
+            if self.prewarm:
+                # 进程池在任务到达时才创建子进程，预先提交空任务使第一个请求不承担创建子进程的耗时
+                for _ in range(self.max_workers):
+                    self.__executor.submit(int)
+
+    def shutdown(self, wait: bool = True):
+        executor_, self.__executor = self.__executor, None
+        self.__slots = None
+        if executor_ is not None:
+            if sys.version_info >= (3, 9):
+                executor_.shutdown(wait=wait, cancel_futures=True)
+            else:
+                # Python3.8没有cancel_futures，排队中的任务会执行完（数量不超过max_pending）
+                executor_.shutdown(wait=wait)
+
+    async def submit(self, fn: Callable[..., T], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> T:
+        """
+        在executor中执行fn并等待结果
+        Args:
+            fn: 进程池中执行时fn及参数需要可以pickle（模块级函数）
+            timeout: 等待空位的超时时间，默认wait_timeout
+        """
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.max_pending)
+        slots_ = self.__slots
+        try:
+            await asyncio.wait_for(slots_.acquire(), timeout if timeout is not None else self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ExecutorBusyError(f"Executor {self.name} is busy, {self.in_flight} tasks in flight")
+
+        self.start()
+        self.submitted += 1
+        self.in_flight += 1
+        submitted_at_ = time.time()
+        try:
+            result_, started_at_, run_seconds_ = await asyncio.get_running_loop().run_in_executor(
+                self.__executor, partial(_timed, fn, *args, **kwargs)
+            )
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            slots_.release()
+        self.completed += 1
+        self.queue_seconds += max(started_at_ - submitted_at_, 0)
+        self.run_seconds += run_seconds_
+        return result_
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queue_seconds": round(self.queue_seconds, 6),
+            "run_seconds": round(self.run_seconds, 6),
+        }
+
+
+class ExecutorManager(object):
+    """
+    管理进程池（CPU密集的调用）与线程池（阻塞的调用），在应用启动与关闭时统一启停
+    - 进程池默认使用spawn创建子进程，不会复制事件循环与数据库连接
+    """
+
+    def __init__(self, process_workers: int = 2, thread_workers: int = 8, max_pending: int = 64,
+                 wait_timeout: float = 10, mp_context: str = "spawn"):
+        self.process = ManagedExecutor(
+            "process",
+            partial(ProcessPoolExecutor, max_workers=process_workers, mp_context=multiprocessing.get_context(mp_context)),
+            max_workers=process_workers,
+            max_pending=max_pending,
+            wait_timeout=wait_timeout,
+            prewarm=True,
+        )
+        self.thread = ManagedExecutor(
+            "thread",
+            partial(ThreadPoolExecutor, max_workers=thread_workers, thread_name_prefix="executor"),
+            max_workers=thread_workers,
+            max_pending=max_pending,
+            wait_timeout=wait_timeout,
+        )
+
+    def configure(self, **config: Any):
+        """
+        使用配置重新创建，需要在start之前调用
+        """
+        self.__init__(**config)
+
+    def start(self):
+        self.process.start()
+        self.thread.start()
+
+    def shutdown(self, wait: bool = True):
+        self.process.shutdown(wait)
+        self.thread.shutdown(wait)
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            "process": self.process.metrics(),
+            "thread": self.thread.metrics(),
+        }
+
+
+executors = ExecutorManager()
+
+
+async def run_cpu(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    在进程池中执行CPU密集的函数，fn及参数需要可以pickle
+    """
+    return await executors.process.submit(fn, *args, **kwargs)
+
+
+async def run_in_thread(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    在线程池中执行阻塞的函数
+    """
+    return await executors.thread.submit(fn, *args, **kwargs)
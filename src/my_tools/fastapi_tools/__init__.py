@@ -5,3 +5,19 @@
 
 from .viewsets import BaseViewSet
 from .decorators import Action
+from .lifecycle import ViewSetScopeEnum
+from .streaming import StreamFormatEnum
+from .cache import ResponseCache
+from .coalesce import RequestCoalescer
+from .conditional import make_version_etag
+from .optimistic import conditional_delete, conditional_update
+from .planner import RelationPlan
+from .serializer import CompiledSerializer
+from .uploads import UploadFormatEnum
+from .consistency import ReadYourWrites
+from .pinning import ConnectionPinning
+from .query_timing import QueryTiming
+from .metrics import RouteMetrics
+from .middleware import RequestMiddleware
+from .routing import ViewSetRoute
+from .validation import Rule, validate_all
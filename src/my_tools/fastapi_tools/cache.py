@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/26 10:20
+# @Author  : NotBeBarnon
+# @Description : 进程内的响应缓存
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from starlette import status
+
+from .singleflight import SingleFlight
+
+__all__ = (
+    "ResponseCache",
+    "CachedResponse",
+    "VARY_HEADERS",
+)
+
+VARY_HEADERS = ("authorization", "cookie")  # 不同用户的响应可能不同，作为key的一部分
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    status_code: int
+    raw_headers: List[Tuple[bytes, bytes]]
+    fresh_until: float  # 在此之前直接返回
+    stale_until: float  # 在此之前，正在刷新时其他请求返回旧数据
+
+    def to_response(self, cache_status: str) -> Response:
+        response_ = Response(content=self.body, status_code=self.status_code)
+        response_.raw_headers = list(self.raw_headers)
+        response_.headers["X-Cache"] = cache_status
+        return response_
+
+
+class ResponseCache(object):
+    """
+    缓存路由最终的响应体
+    - 以路径、排序后的查询参数及认证相关的请求头（摘要）为key，LRU淘汰，每个路由使用独立的实例
+    - 同一个key的并发未命中只执行一次视图
+    - 过期后stale_ttl秒内，正在刷新时其他请求返回旧数据（stale-while-revalidate），
+      刷新由过期后的第一个请求使用自身的参数与上下文完成，不在请求结束后复用其依赖项
+    - 只缓存200且不是流式的响应，响应头包含 Cache-Control: no-store 时不缓存
+    - 缓存在进程内，多个worker之间不共享，数据变更时可以调用invalidate清理，
+      清理前开始生成的响应不会写入缓存
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 256, stale_ttl: float = 0):
+        """
+        Args:
+            ttl: 缓存有效期（秒）
+            maxsize: 最多缓存的key数量
+            stale_ttl: 过期后仍可返回旧数据的时长（秒），为0时不启用
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.__entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.__flight = SingleFlight()
+        self.__generation = 0  # invalidate时加1
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    @staticmethod
+    def make_key(request: Request) -> str:
+        key_ = f"{request.url.path}?{urlencode(sorted(request.query_params.multi_items()))}"
+        vary_ = [request.headers.get(name_, "") for name_ in VARY_HEADERS]
+        if any(vary_):
+            key_ = f"{key_}#{hashlib.blake2b(chr(0).join(vary_).encode(), digest_size=16).hexdigest()}"
+        return key_
+
+    def invalidate(self, prefix: str = ""):
+        """
+        清理以prefix开头的key，prefix为空时清理全部
+        """
+        self.__generation += 1
+        for key_ in [key_ for key_ in self.__entries if key_.startswith(prefix)]:
+            del self.__entries[key_]
+
+    async def get_or_render(self, key: str, render: Callable[[], Awaitable[Response]]) -> Response:
+        """
+        获取缓存的响应，未命中时执行render
+        Args:
+            key: 缓存key
+            render: 生成响应的协程函数
+        """
+        now_ = time.monotonic()
+        if (entry_ := self.__entries.get(key)) is not None:
+            if now_ < entry_.fresh_until:
+                self.__entries.move_to_end(key)
+                return entry_.to_response("HIT")
+            if now_ < entry_.stale_until and key in self.__flight:
+                self.__entries.move_to_end(key)
+                return entry_.to_response("STALE")
+
+        own_response_: Optional[Response] = None
+        generation_ = self.__generation
+
+        async def fill_() -> Optional[CachedResponse]:
+            nonlocal own_response_
+            own_response_ = await render()
+            return self.__store(key, own_response_, generation_)
+
+        if (entry_ := await self.__flight.do(key, fill_)) is not None:
+            return entry_.to_response("MISS")
+        if own_response_ is not None:
+            return own_response_
+        # 不可缓存的响应不能共享给其他等待者，由等待者自行执行
+        return await render()
+
+    def __store(self, key: str, response: Response, generation: int) -> Optional[CachedResponse]:
+        if (
+            generation != self.__generation
+            or isinstance(response, StreamingResponse)
+            or response.status_code != status.HTTP_200_OK
+            or "no-store" in response.headers.get("cache-control", "")
+        ):
+            return None
+        now_ = time.monotonic()
+        entry_ = CachedResponse(
+            body=response.body,
+            status_code=response.status_code,
+            raw_headers=list(response.raw_headers),
+            fresh_until=now_ + self.ttl,
+            stale_until=now_ + self.ttl + self.stale_ttl,
+        )
+        self.__entries[key] = entry_
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+        return entry_
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/26 15:40
+# @Author  : NotBeBarnon
+# @Description : 合并相同的并发GET请求
+from typing import Awaitable, Callable, List, Tuple
+
+from fastapi import Request, Response
+
+from .cache import VARY_HEADERS
+from .singleflight import SingleFlight
+
+__all__ = (
+    "RequestCoalescer",
+)
+
+_VARY_HEADERS = (*VARY_HEADERS, "if-none-match")  # 与ResponseCache一致区分用户，条件请求的响应也不同，不能合并
+
+
+class RequestCoalescer(object):
+    """
+    相同的GET请求正在处理时，新的请求等待并共享其响应，不会再次执行视图
+    - 由ViewSetRoute包装Action(coalesce=True)的路由，每个路由一个实例，不需要在中间件中匹配路由
+    - 以路径、排序后的查询参数及认证相关的请求头为key
+    - 只合并同时在处理中的请求，处理结束后不保留结果，因此不会返回过期数据
+    - 响应体会被完整读入内存后分发，不适用于流式响应；响应的后台任务不会执行
+    """
+
+    def __init__(self):
+        self.__flight = SingleFlight()
+
+    @staticmethod
+    def make_key(request: Request) -> Tuple:
+        return (
+            request.url.path,
+            tuple(sorted(request.query_params.multi_items())),
+            tuple(request.headers.get(name_, "") for name_ in _VARY_HEADERS),
+        )
+
+    def wrap(self, handler: Callable[[Request], Awaitable[Response]]) -> Callable[[Request], Awaitable[Response]]:
+        async def coalesced_handler_(request: Request) -> Response:
+            if request.method != "GET":
+                return await handler(request)
+
+            async def fetch_() -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+                response_ = await handler(request)
+                body_iterator_ = getattr(response_, "body_iterator", None)
+                if body_iterator_ is None:
+                    body_ = response_.body
+                else:
+                    body_ = b"".join([
+                        chunk_ if isinstance(chunk_, bytes) else chunk_.encode(response_.charset)
+                        async for chunk_ in body_iterator_
+                    ])
+                return response_.status_code, list(response_.raw_headers), body_
+
+            status_code_, raw_headers_, body_ = await self.__flight.do(self.make_key(request), fetch_)
+            response_ = Response(content=body_, status_code=status_code_)
+            response_.raw_headers = list(raw_headers_)
+            return response_
+
+        return coalesced_handler_
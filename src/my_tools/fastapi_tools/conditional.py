@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/25 15:10
+# @Author  : NotBeBarnon
+# @Description : ETag 条件请求
+import hashlib
+from typing import Any, List, Optional, Sequence
+
+from fastapi import HTTPException, Response
+from starlette import status
+
+from .pagination import decode_cursor, encode_cursor
+
+__all__ = (
+    "make_content_etag",
+    "make_version_etag",
+    "parse_version_etag",
+    "etag_matches",
+    "not_modified_response",
+)
+
+
+def make_content_etag(content: bytes) -> str:
+    """
+    根据响应内容生成ETag
+    """
+    return f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+
+
+def make_version_etag(version: Any, fields: Optional[Sequence[str]] = None, content: Optional[bytes] = None) -> str:
+    """
+    根据版本列（如modified_at）的值生成ETag，无需序列化数据即可比较
+    - 版本值可以从ETag中还原，用于 If-Match 条件更新
+    - 字段投影得到的是不同的表示，需要区分
+    - 表示中包含关联数据时传入响应内容，关联数据的变更也会改变ETag
+    """
+    etag_ = encode_cursor([version])
+    if fields:
+        etag_ = f"{etag_}.{hashlib.blake2b(','.join(fields).encode(), digest_size=4).hexdigest()}"
+    if content is not None:
+        etag_ = f"{etag_}.{hashlib.blake2b(content, digest_size=8).hexdigest()}"
+    return f'"{etag_}"'
+
+
+def parse_version_etag(etag: str) -> Optional[Any]:
+    """
+    从ETag中还原版本值，无法还原时返回None
+    """
+    etag_ = etag.strip()
+    if etag_.startswith("W/"):
+        etag_ = etag_[2:]
+    etag_ = etag_.strip('"').split(".", 1)[0]
+    try:
+        values_: List[Any] = decode_cursor(etag_)
+    except HTTPException:
+        return None
+    return values_[0] if len(values_) == 1 else None
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """
+    判断 If-None-Match / If-Match 请求头是否与ETag匹配（弱比较）
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    etag_ = etag[2:] if etag.startswith("W/") else etag
+    for item_ in header.split(","):
+        item_ = item_.strip()
+        if (item_[2:] if item_.startswith("W/") else item_) == etag_:
+            return True
+    return False
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/13 10:00
+# @Author  : NotBeBarnon
+# @Description : 读写分离下保证同一会话能读到自己写入的数据
+import time
+from http.cookies import SimpleCookie
+from typing import Mapping, Optional
+
+from src.my_tools.tortoise_tools.routers import ReadConsistency, ReadRouting
+
+__all__ = (
+    "ReadYourWrites",
+)
+
+_SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ReadYourWrites(object):
+    """
+    写入后的一段时间内将同一会话的读取固定到主库，避免从库延迟导致读不到刚写入的数据
+    - 非GET请求及请求中执行过写操作时，通过cookie记录固定到主库的截止时间
+    - 请求的cookie未过期时，该请求的所有读取都读主库
+    - 同一请求中写入之后的读取也读主库
+    - 进程内的缓存（ResponseCache、TreeIndexCache）不在此保证内，其他进程的写入在缓存过期后才可见
+    """
+
+    def __init__(self, routing: ReadRouting, cookie_name: str = "fs_read_master_until"):
+        self.routing = routing
+        self.cookie_name = cookie_name
+
+    def is_pinned(self, method: str, cookies: Mapping[str, str]) -> bool:
+        if method not in _SAFE_METHODS:
+            return True
+        try:
+            return float(cookies.get(self.cookie_name, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def begin(self, method: str, cookies: Mapping[str, str]) -> ReadConsistency:
+        """
+        请求开始时调用，cookies只在安全方法的请求中读取
+        """
+        return self.routing.begin(self.is_pinned(method, cookies))
+
+    def set_cookie(self, method: str, consistency: ReadConsistency) -> Optional[str]:
+        """
+        返回响应时调用，需要固定到主库时返回Set-Cookie响应头的值
+        """
+        if not (consistency.written or method not in _SAFE_METHODS) or self.routing.sticky_seconds <= 0:
+            return None
+        cookie_ = SimpleCookie()
+        cookie_[self.cookie_name] = f"{time.time() + self.routing.sticky_seconds:.3f}"
+        cookie_[self.cookie_name]["max-age"] = max(int(self.routing.sticky_seconds + 0.999), 1)
+        cookie_[self.cookie_name]["path"] = "/"
+        cookie_[self.cookie_name]["httponly"] = True
+        cookie_[self.cookie_name]["samesite"] = "lax"
+        return cookie_.output(header="").strip()
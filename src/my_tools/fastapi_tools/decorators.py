@@ -20,6 +20,9 @@ from fastapi.responses import ORJSONResponse, Response
 from fastapi.types import DecoratedCallable
 from starlette.routing import BaseRoute
 
+from .cache import ResponseCache
+from .streaming import DEFAULT_CHUNK_SIZE, StreamFormatEnum
+
 
 class Action(object):
     def __init__(
@@ -48,7 +51,41 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        stream: Optional[StreamFormatEnum] = None,
+        stream_chunk_size: int = DEFAULT_CHUNK_SIZE,
+        projection: bool = False,
+        etag: Union[bool, str] = False,
+        cache: Union[None, float, ResponseCache] = None,
+        coalesce: bool = False,
+        compiled: bool = False,
+        pin_connections: bool = False,
     ):
+        """
+        视图的路由参数，与FastAPI的add_api_route参数一致，另外包括以下扩展参数：
+        - stream: 流式响应格式，视图返回QuerySet时按块查询并逐行输出，序列化类取自response_model
+        - stream_chunk_size: 流式响应时每次查询的行数
+        - projection: 是否支持 ?fields= 字段投影，视图返回QuerySet时只查询所选的列并直接输出，不再构建序列化对象
+        - etag: 条件请求，If-None-Match 匹配时返回304
+            - True: 根据响应内容计算ETag，节省带宽，视图返回值直接编码，不再经过response_model过滤
+            - str: 版本列名称（如"modified_at"），视图返回单个对象的QuerySet时只查询该列计算ETag，匹配时不再查询与序列化完整数据；
+              输出包含关联数据时关联数据的变更不会改变版本列，ETag由版本值与响应内容共同生成，需要完整查询后比较
+        - cache: 进程内响应缓存，数字表示缓存秒数，需要LRU容量或stale-while-revalidate时传入ResponseCache，视图返回值直接编码
+        - coalesce: 是否合并相同的并发GET请求，由视图集的路由类（ViewSetRoute）处理
+        - compiled: 视图返回QuerySet时使用编译的序列化器直接输出，跳过pydantic对象的构建与response_model校验
+        - pin_connections: 请求中（包括依赖项）的查询复用每个数据库连接名称固定的连接，由视图集的路由类（ViewSetRoute）处理
+
+        视图返回QuerySet且response_model为Tortoise的序列化类时，由视图集完成查询与序列化
+        """
+        self.__fast_options = {
+            "stream": stream,
+            "stream_chunk_size": stream_chunk_size,
+            "projection": projection,
+            "etag": etag,
+            "cache": ResponseCache(ttl=cache) if isinstance(cache, (int, float)) else cache,
+            "coalesce": coalesce,
+            "compiled": compiled,
+            "pin_connections": pin_connections,
+        }
         self.__fast_params = {
             "path": path,
             "response_model": response_model,
@@ -77,6 +114,7 @@ class Action(object):
 
     def __call__(self, func: Callable) -> DecoratedCallable:
         func.__dict__["__fast_view__"] = self.__fast_params
+        func.__dict__["__fast_options__"] = self.__fast_options
         return func
 
     @staticmethod
@@ -104,6 +142,14 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        stream: Optional[StreamFormatEnum] = None,
+        stream_chunk_size: int = DEFAULT_CHUNK_SIZE,
+        projection: bool = False,
+        etag: Union[bool, str] = False,
+        cache: Union[None, float, ResponseCache] = None,
+        coalesce: bool = False,
+        compiled: bool = False,
+        pin_connections: bool = False,
     ):
         return Action(
             path,
@@ -129,6 +175,14 @@ class Action(object):
             name=name,
             callbacks=callbacks,
             openapi_extra=openapi_extra,
+            stream=stream,
+            stream_chunk_size=stream_chunk_size,
+            projection=projection,
+            etag=etag,
+            cache=cache,
+            coalesce=coalesce,
+            compiled=compiled,
+            pin_connections=pin_connections,
         )
 
     @staticmethod
@@ -156,6 +210,7 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        pin_connections: bool = False,
     ):
         return Action(
             path,
@@ -181,6 +236,7 @@ class Action(object):
             name=name,
             callbacks=callbacks,
             openapi_extra=openapi_extra,
+            pin_connections=pin_connections,
         )
 
     @staticmethod
@@ -208,6 +264,7 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        pin_connections: bool = False,
     ):
         return Action(
             path,
@@ -233,6 +290,7 @@ class Action(object):
             name=name,
             callbacks=callbacks,
             openapi_extra=openapi_extra,
+            pin_connections=pin_connections,
         )
 
     @staticmethod
@@ -260,6 +318,7 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        pin_connections: bool = False,
     ):
         return Action(
             path,
@@ -285,6 +344,7 @@ class Action(object):
             name=name,
             callbacks=callbacks,
             openapi_extra=openapi_extra,
+            pin_connections=pin_connections,
         )
 
     @staticmethod
@@ -312,6 +372,7 @@ class Action(object):
         name: Optional[str] = None,
         callbacks: Optional[List[BaseRoute]] = None,
         openapi_extra: Optional[Dict[str, Any]] = None,
+        pin_connections: bool = False,
     ):
         return Action(
             path,
@@ -337,4 +398,5 @@ class Action(object):
             name=name,
             callbacks=callbacks,
             openapi_extra=openapi_extra,
+            pin_connections=pin_connections,
         )
@@ -2,31 +2,98 @@
 # @Time    : 2021/12/16 9:14
 # @Author  : NotBeBarnon
 # @Description :
-from typing import List, Type
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
+from fastapi import Body, Depends, Header, Query, Response
+from pydantic import Field, create_model
+from starlette import status
+from tortoise import timezone
 from tortoise.contrib.fastapi import HTTPNotFoundError
 from tortoise.contrib.pydantic import PydanticModel
 from tortoise.models import MODEL
+from tortoise.transactions import in_transaction
 
+from .conditional import make_version_etag
 from .decorators import Action
+from .optimistic import conditional_delete, conditional_update
+from .pagination import KeysetPagination
+from .planner import RelationPlan
+from .projection import FieldsProjection
+from .pydantics import BulkItemResultPydantic, CursorPage
+from .responses import PydanticORJSONResponse
+from .serializer import CompiledSerializer
+from .streaming import DEFAULT_CHUNK_SIZE, StreamFormatEnum
 
+MAX_PAGE_SIZE = 100  # 分页查询时每页数量的默认上限
+BULK_BATCH_SIZE = 100  # 批量操作时每条SQL处理的数据量
 
-def generate_all(model: Type[MODEL], schema: Type[PydanticModel]):
+
+def generate_all(
+    model: Type[MODEL],
+    schema: Type[PydanticModel],
+    page_size: Optional[int] = None,
+    cursor_field: Optional[str] = None,
+    max_page_size: int = MAX_PAGE_SIZE,
+    stream_format: Optional[StreamFormatEnum] = None,
+    stream_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    compiled: bool = False,
+):
     """
     生成视图集的all方法
     Args:
         model: 视图集的orm模型
         schema: 视图输出的序列化
+        page_size: 每页的默认数量，为None时不分页，一次返回所有数据
+        cursor_field: 游标分页使用的索引列，为None时使用主键
+        max_page_size: 每页数量的上限
+        stream_format: 流式响应格式，设置后不分页，按块查询所有数据并流式输出
+        stream_chunk_size: 流式响应时每次查询的行数
+        compiled: 是否使用编译的序列化器
 
     Returns:
         CoroutineType: 由 async def 创建的协程方法
     """
+    if stream_format is not None:
+        @Action.get("/all", response_model=List[schema], stream=stream_format, stream_chunk_size=stream_chunk_size,
+                    projection=True, compiled=compiled)
+        async def all(self):
+            return model.all()
+
+        all.__doc__ = f"Stream all {model.__name__}"
+        return all
+
+    if page_size is None:
+        @Action.get("/all", response_model=List[schema], projection=True, compiled=compiled)
+        async def all(self):
+            return model.all()
+
+        all.__doc__ = f"Query all {model.__name__}"
+        return all
+
+    pagination = KeysetPagination(model, cursor_field)
+    serializer = CompiledSerializer.of(schema) if compiled else None
+
+    @Action.get("/all", response_model=CursorPage[schema])
+    async def all(
+        self,
+        cursor: str = Query(None, description="上一页返回的next_cursor，为空时查询第一页"),
+        limit: int = Query(page_size, ge=1, le=max(page_size, max_page_size), description="每页数量"),
+        fields: Optional[Tuple[str, ...]] = Depends(FieldsProjection(schema)),
+    ):
+        queryset_ = pagination.apply(model.all(), cursor, limit)
+        if fields:
+            # 投影查询时游标列也需要查询
+            items_, next_cursor_ = pagination.cut(await queryset_.values(*dict.fromkeys(fields + pagination.fields)), limit)
+            return PydanticORJSONResponse({"items": items_, "next_cursor": next_cursor_})
+
+        if serializer is not None:
+            items_, next_cursor_ = pagination.cut(await serializer.serialize_queryset(queryset_), limit)
+            return PydanticORJSONResponse({"items": items_, "next_cursor": next_cursor_})
 
-    @Action.get("/all", response_model=List[schema])
-    async def all(self):
-        return await schema.from_queryset(model.all())
+        items_, next_cursor_ = pagination.cut(await RelationPlan.of(schema).from_queryset(queryset_), limit)
+        return CursorPage[schema](items=items_, next_cursor=next_cursor_)
 
-    all.__doc__ = f"Query all {model.__name__}"
+    all.__doc__ = f"Query {model.__name__} page by page\n- cursor: 游标，由上一页的next_cursor获得\n- limit: 每页数量\n- fields: 需要返回的字段"
 
     return all
 
@@ -45,34 +112,50 @@ def generate_create(model: Type[MODEL], schema: Type[PydanticModel], input_schem
 
     @Action.post("", response_model=schema)
     async def create(self, body: input_schema):
-        return await schema.from_tortoise_orm(await model.create(**body.dict()))
+        return await RelationPlan.of(schema).from_tortoise_orm(await model.create(**body.dict()))
 
     create.__doc__ = f"Create {model.__name__}"
     return create
 
 
-def generate_get(model: Type[MODEL], schema: Type[PydanticModel], pk_type: Type):
+def generate_get(
+    model: Type[MODEL],
+    schema: Type[PydanticModel],
+    pk_type: Type,
+    etag: Union[bool, str] = False,
+    compiled: bool = False,
+):
     """
     生成视图集的get方法
     Args:
         model: 视图集的orm模型
         schema: 视图输出序列化
         pk_type: 主键类型
+        etag: 条件请求，True根据响应内容计算ETag，字符串为版本列名称
+        compiled: 是否使用编译的序列化器
 
     Returns:
         CoroutineType: 由 async def 创建的协程方法
     """
 
-    @Action.get(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}})
+    @Action.get(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}},
+                projection=True, etag=etag, compiled=compiled)
     async def get(self, pk: pk_type):
-        return await schema.from_queryset_single(model.get(pk=pk))
+        return model.get(pk=pk)
 
     get.__doc__ = f"Get {model.__name__} by primary key"
 
     return get
 
 
-def generate_update(model: Type[MODEL], schema: Type[PydanticModel], pk_type: Type, input_schema: Type[PydanticModel]):
+def generate_update(
+    model: Type[MODEL],
+    schema: Type[PydanticModel],
+    pk_type: Type,
+    input_schema: Type[PydanticModel],
+    fast_write: bool = False,
+    version_field: Optional[str] = None,
+):
     """
     生成视图集的update方法
     Args:
@@ -80,41 +163,217 @@ def generate_update(model: Type[MODEL], schema: Type[PydanticModel], pk_type: Ty
         schema: 视图输出序列化
         pk_type: 主键类型
         input_schema: http视图的body序列化
+        fast_write: 是否使用单条条件UPDATE更新，不先读取数据
+        version_field: 版本列，快速模式下支持 If-Match 乐观并发控制
 
     Returns:
         CoroutineType: 由 async def 创建的协程方法
     """
 
-    @Action.patch(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}})
-    async def update(self, pk: pk_type, body: input_schema):
-        obj: MODEL = await model.get(pk=pk)
-        obj.update_from_dict(body.dict(exclude_unset=True, exclude_defaults=True))
-        await obj.save()
-        return await schema.from_tortoise_orm(obj)
+    if not fast_write:
+        @Action.patch(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}})
+        async def update(self, pk: pk_type, body: input_schema):
+            obj: MODEL = await model.get(pk=pk)
+            obj.update_from_dict(body.dict(exclude_unset=True, exclude_defaults=True))
+            await obj.save()
+            return await RelationPlan.of(schema).from_tortoise_orm(obj)
+
+    else:
+        @Action.patch(
+            f"/{{pk}}",
+            response_model=schema,
+            responses={404: {"model": HTTPNotFoundError}, 412: {"model": HTTPNotFoundError}},
+        )
+        async def update(
+            self,
+            pk: pk_type,
+            body: input_schema,
+            response: Response,
+            if_match: str = Header(None, description="数据的ETag，版本不一致时返回412"),
+            prefer: str = Header(None, description="return=minimal 时返回204，不再查询数据"),
+        ):
+            version_ = await conditional_update(
+                model, pk, body.dict(exclude_unset=True, exclude_defaults=True), version_field, if_match
+            )
+            headers_ = {"ETag": make_version_etag(version_)} if version_ is not None else {}
+            if prefer and "return=minimal" in prefer:
+                return Response(status_code=status.HTTP_204_NO_CONTENT, headers=headers_)
+            response.headers.update(headers_)
+            return model.get(pk=pk)
 
     update.__doc__ = f"Update {model.__name__} by primary key"
 
     return update
 
 
-def generate_delete(model: Type[MODEL], schema: Type[PydanticModel], pk_type: Type):
+def generate_delete(
+    model: Type[MODEL],
+    schema: Type[PydanticModel],
+    pk_type: Type,
+    fast_write: bool = False,
+    version_field: Optional[str] = None,
+):
     """
     生成视图集的delete方法
     Args:
         model: 视图集的orm模型
         schema: 视图输出序列化
         pk_type: 主键类型
+        fast_write: 是否使用单条条件DELETE删除，不先读取数据，成功时返回204
+        version_field: 版本列，快速模式下支持 If-Match 乐观并发控制
 
     Returns:
         CoroutineType: 由 async def 创建的协程方法
     """
 
-    @Action.delete(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}})
-    async def delete(self, pk: pk_type):
-        obj = await model.get(pk=pk)
-        deleted_count_ = await model.filter(pk=pk).delete()
-        return await schema.from_tortoise_orm(obj)
+    if not fast_write:
+        @Action.delete(f"/{{pk}}", response_model=schema, responses={404: {"model": HTTPNotFoundError}})
+        async def delete(self, pk: pk_type):
+            obj = await model.get(pk=pk)
+            deleted_count_ = await model.filter(pk=pk).delete()
+            return await RelationPlan.of(schema).from_tortoise_orm(obj)
+
+    else:
+        @Action.delete(
+            f"/{{pk}}",
+            status_code=status.HTTP_204_NO_CONTENT,
+            response_class=Response,
+            responses={404: {"model": HTTPNotFoundError}, 412: {"model": HTTPNotFoundError}},
+        )
+        async def delete(self, pk: pk_type, if_match: str = Header(None, description="数据的ETag，版本不一致时返回412")):
+            await conditional_delete(model, pk, version_field, if_match)
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     delete.__doc__ = f"Delete {model.__name__} by primary key"
 
     return delete
+
+
+def _write_connection_name(model: Type[MODEL]) -> str:
+    """
+    获取模型写操作使用的数据库连接名称
+    """
+    return model._choose_db(True).connection_name
+
+
+def generate_bulk_create(model: Type[MODEL], input_schema: Type[PydanticModel], batch_size: int = BULK_BATCH_SIZE):
+    """
+    生成视图集的bulk_create方法
+    Args:
+        model: 视图集的orm模型
+        input_schema: 单条数据的body序列化对象
+        batch_size: 每条INSERT语句插入的数据量
+
+    Returns:
+        CoroutineType: 由 async def 创建的协程方法
+    """
+
+    # MySQL的批量INSERT不会回填自增主键，没有主键时结果中不包含pk，而不是返回null
+    @Action.post("/bulk", response_model=List[BulkItemResultPydantic], response_model_exclude_unset=True)
+    async def bulk_create(self, body: List[input_schema] = Body(...)):
+        objs_ = [model(**item_.dict()) for item_ in body]
+        async with in_transaction(_write_connection_name(model)) as connection_:
+            await model.bulk_create(objs_, batch_size=batch_size, using_db=connection_)
+        return [
+            BulkItemResultPydantic(index=index_, pk=obj_.pk, success=True) if obj_.pk is not None
+            else BulkItemResultPydantic(index=index_, success=True)
+            for index_, obj_ in enumerate(objs_)
+        ]
+
+    bulk_create.__doc__ = f"Create {model.__name__} in bulk within one transaction"
+    return bulk_create
+
+
+def generate_bulk_update(model: Type[MODEL], pk_type: Type, input_schema: Type[PydanticModel], batch_size: int = BULK_BATCH_SIZE):
+    """
+    生成视图集的bulk_update方法
+    Args:
+        model: 视图集的orm模型
+        pk_type: 主键类型
+        input_schema: 单条数据的body序列化对象，会自动添加主键字段
+        batch_size: 每条UPDATE语句更新的数据量
+
+    Returns:
+        CoroutineType: 由 async def 创建的协程方法
+    """
+    pk_attr = model._meta.pk_attr
+    item_schema = create_model(
+        f"{input_schema.__name__}BulkItem",
+        __base__=input_schema,
+        **{pk_attr: (pk_type, Field(..., description="主键"))},
+    )
+    # 批量更新不会触发auto_now，需要手动更新
+    auto_now_fields = [name_ for name_, field_ in model._meta.fields_map.items() if getattr(field_, "auto_now", False)]
+
+    @Action.patch("/bulk", response_model=List[BulkItemResultPydantic])
+    async def bulk_update(self, body: List[item_schema] = Body(...)):
+        results_: List[BulkItemResultPydantic] = []
+        groups_: Dict[Tuple[str, ...], List[MODEL]] = {}
+        pks_ = {getattr(item_, pk_attr) for item_ in body}
+        async with in_transaction(_write_connection_name(model)) as connection_:
+            exist_pks_ = set(await model.filter(pk__in=pks_).using_db(connection_).values_list(pk_attr, flat=True))
+            seen_pks_ = set()
+            now_ = timezone.now()
+            for index_, item_ in enumerate(body):
+                pk_ = getattr(item_, pk_attr)
+                if pk_ not in exist_pks_:
+                    results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=False, detail="数据不存在"))
+                    continue
+                if pk_ in seen_pks_:
+                    results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=False, detail="主键重复"))
+                    continue
+                seen_pks_.add(pk_)
+                results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=True))
+
+                update_dict_ = item_.dict(exclude={pk_attr}, exclude_unset=True, exclude_defaults=True)
+                if not update_dict_:
+                    continue
+                update_dict_.update({name_: now_ for name_ in auto_now_fields})
+                # 更新的字段相同的数据才能在一条语句中更新
+                groups_.setdefault(tuple(sorted(update_dict_)), []).append(model(**{pk_attr: pk_, **update_dict_}))
+
+            for fields_, objs_ in groups_.items():
+                await model.bulk_update(objs_, fields_, batch_size=batch_size, using_db=connection_)
+        return results_
+
+    bulk_update.__doc__ = f"Update {model.__name__} in bulk within one transaction"
+    return bulk_update
+
+
+def generate_bulk_delete(model: Type[MODEL], pk_type: Type, batch_size: int = BULK_BATCH_SIZE):
+    """
+    生成视图集的bulk_delete方法
+    Args:
+        model: 视图集的orm模型
+        pk_type: 主键类型
+        batch_size: 每条DELETE语句删除的数据量
+
+    Returns:
+        CoroutineType: 由 async def 创建的协程方法
+    """
+    pk_attr = model._meta.pk_attr
+
+    @Action.delete("/bulk", response_model=List[BulkItemResultPydantic])
+    async def bulk_delete(self, body: List[pk_type] = Body(..., description="主键列表")):
+        results_: List[BulkItemResultPydantic] = []
+        async with in_transaction(_write_connection_name(model)) as connection_:
+            exist_pks_ = set(await model.filter(pk__in=set(body)).using_db(connection_).values_list(pk_attr, flat=True))
+            delete_pks_: List[Any] = []
+            seen_pks_ = set()
+            for index_, pk_ in enumerate(body):
+                if pk_ not in exist_pks_:
+                    results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=False, detail="数据不存在"))
+                    continue
+                if pk_ in seen_pks_:
+                    results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=False, detail="主键重复"))
+                    continue
+                seen_pks_.add(pk_)
+                delete_pks_.append(pk_)
+                results_.append(BulkItemResultPydantic(index=index_, pk=pk_, success=True))
+
+            for start_ in range(0, len(delete_pks_), batch_size):
+                await model.filter(pk__in=delete_pks_[start_:start_ + batch_size]).using_db(connection_).delete()
+        return results_
+
+    bulk_delete.__doc__ = f"Delete {model.__name__} in bulk within one transaction"
+    return bulk_delete
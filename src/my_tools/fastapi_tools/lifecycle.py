@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/31 9:50
+# @Author  : NotBeBarnon
+# @Description : 视图集实例的生命周期
+from enum import Enum
+from typing import Any, List, Optional, Type
+
+__all__ = (
+    "ViewSetScopeEnum",
+    "ViewSetLifecycle",
+)
+
+
+class ViewSetScopeEnum(str, Enum):
+    request = "request"  # 每个请求创建新的实例
+    singleton = "singleton"  # 所有请求共享一个实例，视图不能在self上保存请求相关的数据
+    pool = "pool"  # 实例池，同一时间一个实例只服务一个请求，请求结束后放回复用
+
+
+class ViewSetLifecycle(object):
+    """
+    按作用域获取与归还视图集实例
+    - pool作用域不会阻塞等待：没有空闲实例时直接创建，归还时超过pool_size的实例被丢弃
+    """
+
+    def __init__(self, viewset_cls: Type, scope: ViewSetScopeEnum = ViewSetScopeEnum.request, pool_size: int = 16):
+        self.viewset_cls = viewset_cls
+        self.scope = scope
+        self.pool_size = pool_size
+        self.__singleton: Optional[Any] = None
+        self.__free: List[Any] = []
+
+    def prepare(self):
+        """
+        预先创建实例，在应用启动时调用
+        """
+        if self.scope == ViewSetScopeEnum.singleton and self.__singleton is None:
+            self.__singleton = self.viewset_cls()
+        elif self.scope == ViewSetScopeEnum.pool:
+            self.__free.extend(self.viewset_cls() for _ in range(self.pool_size - len(self.__free)))
+
+    def clear(self):
+        """
+        丢弃所有实例，在应用关闭时调用
+        """
+        self.__singleton = None
+        self.__free.clear()
+
+    def acquire(self) -> Any:
+        if self.scope == ViewSetScopeEnum.singleton:
+            if self.__singleton is None:
+                self.__singleton = self.viewset_cls()
+            return self.__singleton
+        if self.scope == ViewSetScopeEnum.pool and self.__free:
+            return self.__free.pop()
+        return self.viewset_cls()
+
+    def release(self, instance: Any):
+        if self.scope == ViewSetScopeEnum.pool and len(self.__free) < self.pool_size:
+            self.__free.append(instance)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/21 10:30
+# @Author  : NotBeBarnon
+# @Description : 按路由模板记录请求的耗时与报文大小
+from typing import Any, Dict, MutableMapping, Optional
+
+from fastapi import FastAPI
+
+from src.my_tools.metrics_tools import RequestMetrics
+
+__all__ = (
+    "RouteMetrics",
+)
+
+UNMATCHED_ROUTE = "unmatched"  # 没有匹配的路由（404）的请求合并为一个标签，避免任意路径产生无限的标签值
+
+
+class RouteMetrics(object):
+    """
+    记录每个请求的方法、路由模板（如 /api/sample/user/{pk}）、状态码、耗时与请求/响应的大小
+    - 路由匹配后endpoint写入scope，通过endpoint查找路由模板，不需要再次匹配路由
+    - 请求大小取Content-Length，不读取请求体
+    - 在响应体发送结束时记录，响应大小为实际发送的字节数
+    - 视图抛出未处理的异常时记录为500
+    """
+
+    def __init__(self, app: FastAPI, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+        self.__templates: Optional[Dict[Any, str]] = None
+
+    @property
+    def templates(self) -> Dict[Any, str]:
+        # 路由在导入时注册，第一次请求时才收集，同一个endpoint由第一个路由处理
+        if self.__templates is None:
+            self.__templates = {}
+            for route_ in self.app.routes:
+                endpoint_ = getattr(route_, "endpoint", None)
+                if endpoint_ is not None:
+                    self.__templates.setdefault(endpoint_, route_.path)
+        return self.__templates
+
+    def route_template(self, scope: MutableMapping[str, Any]) -> str:
+        endpoint_ = scope.get("endpoint")
+        if endpoint_ is None:
+            return UNMATCHED_ROUTE
+        return self.templates.get(endpoint_, UNMATCHED_ROUTE)
+
+    def begin(self, method: str):
+        self.metrics.begin(method)
+
+    def end(self, method: str):
+        self.metrics.end(method)
+
+    def observe(self, scope: MutableMapping[str, Any], status_code: int, seconds: float, request_bytes: int,
+                response_bytes: int):
+        self.metrics.observe(
+            scope["method"], self.route_template(scope), status_code, seconds, request_bytes, response_bytes
+        )
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/22 10:30
+# @Author  : NotBeBarnon
+# @Description : 对所有请求生效的处理合并为一个ASGI中间件
+import time
+from contextlib import nullcontext
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .consistency import ReadYourWrites
+from .metrics import RouteMetrics
+from .query_timing import QueryTiming
+
+__all__ = (
+    "RequestMiddleware",
+)
+
+
+class RequestMiddleware(object):
+    """
+    读写一致性、SQL统计与请求指标，未配置的部分跳过
+    - 纯ASGI中间件，只包装send，不像BaseHTTPMiddleware为每个请求创建任务组与内存流
+    - 视图在同一个任务中执行，contextvar的设置对视图可见
+    - 响应头在http.response.start中添加，指标在最后一块响应体发送后记录
+    - 只对部分路由生效的处理（请求合并、固定连接）由视图集的路由类ViewSetRoute处理
+    """
+
+    def __init__(self, app: ASGIApp, read_your_writes: Optional[ReadYourWrites] = None,
+                 query_timing: Optional[QueryTiming] = None, route_metrics: Optional[RouteMetrics] = None):
+        self.app = app
+        self.read_your_writes = read_your_writes
+        self.query_timing = query_timing
+        self.route_metrics = route_metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method_ = scope["method"]
+        start_ = time.perf_counter()
+        headers_ = Headers(scope=scope)
+        content_length_ = headers_.get("content-length", "")
+        request_bytes_ = int(content_length_) if content_length_.isdigit() else 0
+        consistency_ = None
+        if self.read_your_writes is not None:
+            consistency_ = self.read_your_writes.begin(method_, cookie_parser(headers_.get("cookie", "")))
+        status_code_ = 500
+        response_bytes_ = 0
+        observed_ = False
+
+        def observe_():
+            nonlocal observed_
+            if self.route_metrics is not None and not observed_:
+                observed_ = True
+                self.route_metrics.observe(
+                    scope, status_code_, time.perf_counter() - start_, request_bytes_, response_bytes_
+                )
+
+        async def send_(message: Message):
+            nonlocal status_code_, response_bytes_
+            if message["type"] == "http.response.start":
+                status_code_ = message["status"]
+                response_headers_ = MutableHeaders(scope=message)
+                if consistency_ is not None:
+                    cookie_ = self.read_your_writes.set_cookie(method_, consistency_)
+                    if cookie_ is not None:
+                        response_headers_.append("set-cookie", cookie_)
+                if stats_ is not None:
+                    server_timing_ = self.query_timing.server_timing(stats_, (time.perf_counter() - start_) * 1000)
+                    if server_timing_ is not None:
+                        response_headers_.append("server-timing", server_timing_)
+            elif message["type"] == "http.response.body":
+                response_bytes_ += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    await send(message)
+                    observe_()
+                    return
+            await send(message)
+
+        if self.route_metrics is not None:
+            self.route_metrics.begin(method_)
+        try:
+            with (self.query_timing.collect() if self.query_timing is not None else nullcontext()) as stats_:
+                try:
+                    await self.app(scope, receive, send_)
+                except Exception:
+                    status_code_ = 500
+                    raise
+                finally:
+                    # 客户端断开等原因没有发送完响应体时，按已发送的部分记录
+                    observe_()
+        finally:
+            if self.route_metrics is not None:
+                self.route_metrics.end(method_)
+        if stats_ is not None:
+            self.query_timing.report(
+                method_, scope["path"], status_code_, stats_, (time.perf_counter() - start_) * 1000
+            )
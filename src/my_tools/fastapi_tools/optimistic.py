@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/29 10:05
+# @Author  : NotBeBarnon
+# @Description : 基于版本列的乐观并发控制（If-Match）
+from typing import Any, Dict, Optional, Type
+
+from fastapi import HTTPException
+from starlette import status
+from tortoise import timezone
+from tortoise.exceptions import DoesNotExist
+from tortoise.expressions import F
+from tortoise.fields import Field
+from tortoise.models import MODEL
+
+from .conditional import parse_version_etag
+
+__all__ = (
+    "is_version_field",
+    "conditional_update",
+    "conditional_delete",
+)
+
+
+def is_version_field(model: Type[MODEL], field: str) -> bool:
+    """
+    版本列需要在每次更新时改变：auto_now的时间列或整数列（每次加1）
+    """
+    field_: Optional[Field] = model._meta.fields_map.get(field)
+    if field_ is None or field not in model._meta.db_fields:
+        return False
+    return getattr(field_, "auto_now", False) or field_.field_type is int
+
+
+def _filter_of(model: Type[MODEL], pk: Any, version_field: Optional[str], if_match: Optional[str]) -> Dict[str, Any]:
+    filter_ = {"pk": pk}
+    if version_field and if_match and if_match.strip() != "*":
+        version_ = parse_version_etag(if_match)
+        if version_ is None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="无效的If-Match")
+        filter_[version_field] = model._meta.fields_map[version_field].to_python_value(version_)
+    return filter_
+
+
+async def _raise_for_missing(model: Type[MODEL], pk: Any, filter_: Dict[str, Any]):
+    """
+    条件写入没有影响任何行时，区分数据不存在与版本不匹配
+    """
+    if len(filter_) > 1 and await model.exists(pk=pk):
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="数据已被修改，请重新获取后再操作")
+    raise DoesNotExist("Object does not exist")
+
+
+async def _current_version(model: Type[MODEL], pk: Any, filter_: Dict[str, Any], version_field: Optional[str]) -> Optional[Any]:
+    """
+    查询匹配条件的数据的版本值，没有匹配的数据时区分不存在与版本不匹配
+    """
+    versions_ = await model.filter(**filter_).limit(1).values_list(version_field or model._meta.pk_attr, flat=True)
+    if not versions_:
+        await _raise_for_missing(model, pk, filter_)
+    return versions_[0] if version_field else None
+
+
+async def conditional_update(
+    model: Type[MODEL],
+    pk: Any,
+    update_dict: Dict[str, Any],
+    version_field: Optional[str] = None,
+    if_match: Optional[str] = None,
+) -> Optional[Any]:
+    """
+    单条 UPDATE ... WHERE pk=? [AND version=?] 完成更新，不需要先读取数据
+    - update()不会处理auto_now，由这里显式设置
+    - 整数版本列自增1
+    Args:
+        model: orm模型
+        pk: 主键
+        update_dict: 需要更新的列
+        version_field: 版本列
+        if_match: If-Match请求头，为None或*时不检查版本
+
+    Returns:
+        更新后的版本值，整数版本列且未传If-Match时无法得知，返回None
+    """
+    filter_ = _filter_of(model, pk, version_field, if_match)
+    if not update_dict:
+        # 没有需要更新的列时不写入，版本不变，只检查数据是否存在及版本是否匹配
+        return await _current_version(model, pk, filter_, version_field)
+
+    update_dict_ = dict(update_dict)
+    now_ = timezone.now()
+    for field_name_, field_ in model._meta.fields_map.items():
+        if getattr(field_, "auto_now", False):
+            update_dict_[field_name_] = now_
+    if version_field and model._meta.fields_map[version_field].field_type is int:
+        update_dict_[version_field] = F(version_field) + 1
+
+    if not await model.filter(**filter_).update(**update_dict_):
+        # MySQL返回的是实际改变的行数（未设置CLIENT.FOUND_ROWS），值与原值相同时也为0，需要确认是否匹配到了数据
+        return await _current_version(model, pk, filter_, version_field)
+
+    if not version_field:
+        return None
+    if model._meta.fields_map[version_field].field_type is not int:
+        return update_dict_[version_field]
+    # 整数版本列只有通过If-Match确定了旧版本时才能得知新版本
+    return filter_[version_field] + 1 if version_field in filter_ else None
+
+
+async def conditional_delete(
+    model: Type[MODEL],
+    pk: Any,
+    version_field: Optional[str] = None,
+    if_match: Optional[str] = None,
+):
+    """
+    单条 DELETE ... WHERE pk=? [AND version=?] 完成删除，不需要先读取数据
+    """
+    filter_ = _filter_of(model, pk, version_field, if_match)
+    if not await model.filter(**filter_).delete():
+        await _raise_for_missing(model, pk, filter_)
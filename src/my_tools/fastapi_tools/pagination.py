@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/22 10:20
+# @Author  : NotBeBarnon
+# @Description : 基于索引列的游标(keyset)分页
+import base64
+import binascii
+from typing import Any, List, Optional, Sequence, Tuple, Type
+
+import orjson
+from fastapi import HTTPException
+from starlette import status
+from tortoise.expressions import Q
+from tortoise.models import MODEL
+from tortoise.queryset import QuerySet
+
+__all__ = (
+    "KeysetPagination",
+    "encode_cursor",
+    "decode_cursor",
+)
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    将游标列的值编码为不透明的游标字符串
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(list(values), default=str)).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """
+    解码游标字符串
+
+    Raises:
+        HTTPException: 游标无法解析时返回400
+    """
+    try:
+        values_ = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="无效的分页游标")
+    if not isinstance(values_, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="无效的分页游标")
+    return values_
+
+
+class KeysetPagination(object):
+    """
+    游标分页
+    - 按 (cursor_field, pk) 排序，通过 WHERE 条件直接定位到上一页的最后一行，查询耗时不随页码增长
+    - cursor_field 必须是有索引的非空列，为None时使用主键
+    """
+
+    def __init__(self, model: Type[MODEL], cursor_field: Optional[str] = None):
+        self.model = model
+        pk_ = model._meta.pk_attr
+        self.fields: Tuple[str, ...] = (cursor_field, pk_) if cursor_field and cursor_field != pk_ else (pk_,)
+
+    @staticmethod
+    def is_indexed(model: Type[MODEL], field_name: str) -> bool:
+        """
+        判断字段是否可以作为游标列
+        """
+        field_ = model._meta.fields_map.get(field_name, None)
+        if field_ is None or field_name not in model._meta.db_fields or field_.null:
+            return False
+        return bool(field_.pk or field_.unique or field_.index)
+
+    def apply(self, queryset: QuerySet, cursor: Optional[str], limit: int) -> QuerySet:
+        """
+        为查询集添加游标条件，多查询一行用于判断是否存在下一页
+        """
+        if not cursor:
+            return self.seek(queryset, None, limit + 1)
+
+        values_ = decode_cursor(cursor)
+        if len(values_) != len(self.fields):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="无效的分页游标")
+        try:
+            values_ = [
+                self.model._meta.fields_map[field_name].to_python_value(value_)
+                for field_name, value_ in zip(self.fields, values_)
+            ]
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="无效的分页游标")
+        return self.seek(queryset, values_, limit + 1)
+
+    def seek(self, queryset: QuerySet, values: Optional[Sequence[Any]], limit: int) -> QuerySet:
+        """
+        查询排在values之后的limit行
+        Args:
+            queryset: 查询集，原有的排序与limit会被覆盖
+            values: 上一行游标列的值，为None时从头查询
+            limit: 查询行数
+        """
+        queryset = queryset.order_by(*self.fields).limit(limit)
+        if values is None:
+            return queryset
+        if len(self.fields) == 1:
+            return queryset.filter(**{f"{self.fields[0]}__gt": values[0]})
+        # (cursor_field, pk) > (value, pk_value)
+        return queryset.filter(
+            Q(**{f"{self.fields[0]}__gt": values[0]})
+            | Q(**{self.fields[0]: values[0], f"{self.fields[1]}__gt": values[1]})
+        )
+
+    def values_of(self, row: Any) -> List[Any]:
+        """
+        获取一行数据中游标列的值，row可以是模型、序列化对象或values()得到的字典
+        """
+        if isinstance(row, dict):
+            return [row[field_name] for field_name in self.fields]
+        return [getattr(row, field_name) for field_name in self.fields]
+
+    def cut(self, rows: List[Any], limit: int) -> Tuple[List[Any], Optional[str]]:
+        """
+        截取当前页数据并生成下一页游标
+        Args:
+            rows: apply后查询得到的数据，可以是模型、序列化对象或values()得到的字典
+            limit: 每页数量
+
+        Returns:
+            Tuple[List, Optional[str]]: 当前页数据，下一页游标
+        """
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(self.values_of(rows[-1]))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/16 10:00
+# @Author  : NotBeBarnon
+# @Description : 请求中的查询复用固定的数据库连接
+from typing import Awaitable, Callable
+
+from fastapi import Request, Response
+
+from src.my_tools.tortoise_tools.pools import pin_connections
+
+__all__ = (
+    "ConnectionPinning",
+)
+
+
+class ConnectionPinning(object):
+    """
+    Action(pin_connections=True)的路由，请求中（包括依赖项中的校验）每个数据库连接名称只从连接池获取一次连接
+    - 由ViewSetRoute包装路由的处理函数，依赖项在其中解析，也在范围内
+    - 视图返回响应后归还连接，流式响应在返回后执行的查询从连接池获取连接
+    """
+
+    @staticmethod
+    def wrap(handler: Callable[[Request], Awaitable[Response]]) -> Callable[[Request], Awaitable[Response]]:
+        async def pinned_handler_(request: Request) -> Response:
+            async with pin_connections():
+                return await handler(request)
+
+        return pinned_handler_
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/1 10:10
+# @Author  : NotBeBarnon
+# @Description : 根据序列化类生成关联查询计划（select_related / prefetch_related）
+from typing import Dict, List, Optional, Tuple, Type
+
+from tortoise.contrib.pydantic import PydanticModel
+from tortoise.models import Model
+from tortoise.query_utils import Prefetch
+from tortoise.queryset import QuerySet, QuerySetSingle
+
+__all__ = (
+    "RelationPlan",
+)
+
+
+class RelationPlan(object):
+    """
+    遍历序列化类的嵌套字段，生成最少的关联查询
+    - 正向外键/一对一且目标序列化类不再包含关联时使用select_related，与主查询JOIN，不产生额外查询
+    - 其余关联使用prefetch_related，每个关联一次查询，关联的查询集递归应用子计划
+      （如User -> position -> higher 时，position的查询JOIN higher，而不是再查询一次）
+    - 读取序列化类的__fields__，包括继承的字段（Tortoise的_get_fetch_fields只读取__annotations__）
+    - 关联关系在Tortoise初始化后才完整，因此在第一次使用时才生成
+    """
+    __instances: Dict[Type[PydanticModel], "RelationPlan"] = {}
+
+    def __init__(self, schema: Type[PydanticModel]):
+        self.schema = schema
+        self.model: Type[Model] = getattr(schema.__config__, "orig_model")
+        self.__select_related: Optional[Tuple[str, ...]] = None
+        self.__prefetches: Tuple[Tuple[str, Optional["RelationPlan"]], ...] = ()
+        self.__building = False
+
+    @classmethod
+    def of(cls, schema: Type[PydanticModel]) -> "RelationPlan":
+        if (plan_ := cls.__instances.get(schema)) is None:
+            plan_ = cls.__instances[schema] = cls(schema)
+        return plan_
+
+    @property
+    def select_related(self) -> Tuple[str, ...]:
+        self.__ensure_built()
+        return self.__select_related
+
+    @property
+    def prefetches(self) -> Tuple[Tuple[str, Optional["RelationPlan"]], ...]:
+        self.__ensure_built()
+        return self.__prefetches
+
+    @property
+    def has_relations(self) -> bool:
+        return bool(self.select_related or self.prefetches)
+
+    @property
+    def paths(self) -> List[str]:
+        """
+        所有需要查询的关联路径，用于Model.fetch_related等只接受路径的场景
+        """
+        paths_ = list(self.select_related)
+        for name_, plan_ in self.prefetches:
+            sub_paths_ = plan_.paths if plan_ is not None else []
+            paths_.extend([f"{name_}__{sub_path_}" for sub_path_ in sub_paths_] or [name_])
+        return paths_
+
+    def apply(self, queryset: QuerySet) -> QuerySet:
+        """
+        为查询集添加关联查询
+        """
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetches:
+            queryset = queryset.prefetch_related(*(
+                Prefetch(name_, plan_.apply(plan_.model.all())) if plan_ is not None and plan_.has_relations else name_
+                for name_, plan_ in self.prefetches
+            ))
+        return queryset
+
+    async def from_queryset(self, queryset: QuerySet) -> List[PydanticModel]:
+        """
+        与 schema.from_queryset 相同，使用查询计划获取关联数据
+        """
+        return [self.schema.from_orm(obj_) for obj_ in await self.apply(queryset)]
+
+    async def from_queryset_single(self, queryset: QuerySetSingle) -> PydanticModel:
+        return self.schema.from_orm(await self.apply(queryset))
+
+    async def from_tortoise_orm(self, obj: Model) -> PydanticModel:
+        """
+        与 schema.from_tortoise_orm 相同，对象已经存在，只能按路径逐个查询关联
+        """
+        await obj.fetch_related(*self.paths)
+        return self.schema.from_orm(obj)
+
+    def __ensure_built(self):
+        if self.__select_related is None and not self.__building:
+            self.__build()
+
+    def __build(self):
+        self.__building = True
+        meta_ = self.model._meta
+        select_related_: List[str] = []
+        prefetches_: List[Tuple[str, Optional[RelationPlan]]] = []
+        for name_, field_ in self.schema.__fields__.items():
+            if name_ not in meta_.fetch_fields:
+                continue
+            sub_schema_ = field_.type_
+            if not (isinstance(sub_schema_, type) and issubclass(sub_schema_, PydanticModel)):
+                prefetches_.append((name_, None))
+                continue
+            sub_plan_ = RelationPlan.of(sub_schema_)
+            if sub_plan_.__building:
+                # 循环引用的序列化类，只查询当前层级
+                prefetches_.append((name_, None))
+            elif (name_ in meta_.fk_fields or name_ in meta_.o2o_fields) and not sub_plan_.has_relations:
+                select_related_.append(name_)
+            else:
+                prefetches_.append((name_, sub_plan_))
+        self.__prefetches = tuple(prefetches_)
+        self.__select_related = tuple(select_related_)
+        self.__building = False
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/24 10:02
+# @Author  : NotBeBarnon
+# @Description : ?fields= 字段投影，只查询需要的列
+from typing import Optional, Set, Tuple, Type
+
+from fastapi import HTTPException, Query
+from starlette import status
+from tortoise.contrib.pydantic import PydanticModel
+
+__all__ = (
+    "FieldsProjection",
+)
+
+
+class FieldsProjection(object):
+    """
+    字段投影依赖
+    - 解析 ?fields=uid,username 为需要查询的列，只允许序列化类中对应数据库列的字段
+    - 返回的列总是包括主键
+    - 未传fields时返回None，表示查询完整数据
+    """
+
+    def __init__(self, schema: Type[PydanticModel]):
+        self.schema = schema
+        self.model = getattr(schema.__config__, "orig_model")
+        self.__allowed_fields: Optional[Set[str]] = None
+
+    @property
+    def allowed_fields(self) -> Set[str]:
+        # 外键的 xxx_id 列在Tortoise初始化后才会生成，所以在第一次使用时才计算
+        if self.__allowed_fields is None:
+            self.__allowed_fields = set(self.schema.__fields__) & set(self.model._meta.db_fields)
+        return self.__allowed_fields
+
+    def __call__(
+        self,
+        fields: str = Query(None, description="需要返回的字段，以逗号分隔，主键总是返回；为空时返回所有字段"),
+    ) -> Optional[Tuple[str, ...]]:
+        if not fields:
+            return None
+        fields_ = [field_.strip() for field_ in fields.split(",") if field_.strip()]
+        if invalid_ := [field_ for field_ in fields_ if field_ not in self.allowed_fields]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"不支持的字段: {','.join(invalid_)}，可选字段: {','.join(sorted(self.allowed_fields))}",
+            )
+        return tuple(dict.fromkeys([self.model._meta.pk_attr, *fields_]))
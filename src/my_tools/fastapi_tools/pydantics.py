@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/22 10:12
+# @Author  : NotBeBarnon
+# @Description : 视图集工具的通用序列化
+from typing import Any, Generic, List, Optional, TypeVar
+
+from pydantic import BaseModel, Field
+from pydantic.generics import GenericModel
+
+__all__ = (
+    "CursorPage",
+    "BulkItemResultPydantic",
+    "ImportErrorPydantic",
+    "ImportResultPydantic",
+)
+
+ItemT = TypeVar("ItemT")
+
+
+class CursorPage(GenericModel, Generic[ItemT]):
+    """
+    游标分页的响应格式
+    """
+    items: List[ItemT] = Field(..., description="当前页数据")
+    next_cursor: Optional[str] = Field(None, description="下一页的游标，为None表示没有更多数据")
+
+
+class BulkItemResultPydantic(BaseModel):
+    """
+    批量操作中单条数据的处理结果
+    """
+    index: int = Field(..., description="数据在请求列表中的下标")
+    pk: Any = Field(None, description="数据的主键，自增主键批量创建时无法获取，结果中不包含此字段")
+    success: bool = Field(..., description="是否成功")
+    detail: str = Field(None, description="失败原因")
+
+
+class ImportErrorPydantic(BaseModel):
+    """
+    导入失败的一行数据
+    """
+    line: int = Field(..., description="数据在上传文件中的行号，从1开始")
+    key: Any = Field(None, description="数据的唯一标识")
+    detail: str = Field(..., description="失败原因")
+
+
+class ImportResultPydantic(BaseModel):
+    """
+    流式导入的结果汇总
+    """
+    total: int = Field(0, description="读取的数据行数")
+    success: int = Field(0, description="成功的行数")
+    failed: int = Field(0, description="失败的行数")
+    batches: int = Field(0, description="分批处理的批数")
+    elapsed: float = Field(0, description="耗时（秒）")
+    errors: List[ImportErrorPydantic] = Field([], description="失败的行，最多返回max_errors条")
+
+    def add_error(self, line: int, key: Any, detail: str, max_errors: int = 100):
+        self.failed += 1
+        if len(self.errors) < max_errors:
+            self.errors.append(ImportErrorPydantic(line=line, key=key, detail=detail))
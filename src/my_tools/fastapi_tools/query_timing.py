@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/19 10:30
+# @Author  : NotBeBarnon
+# @Description : 记录每个请求的SQL数量与耗时，输出Server-Timing响应头与日志
+from typing import ContextManager, Optional
+
+from loguru import logger
+
+from src.my_tools.tortoise_tools.query_stats import QueryStats, collect_query_stats
+
+__all__ = (
+    "QueryTiming",
+)
+
+
+class QueryTiming(object):
+    """
+    统计每个请求执行的SQL
+    - 响应头 Server-Timing: db;dur=数据库耗时;desc="N queries", app;dur=请求总耗时，单位 毫秒，浏览器开发者工具中可以直接查看
+    - 出现N+1查询或慢查询时输出WARNING日志，否则输出DEBUG日志，日志的extra中sql_stats为完整的统计
+    - Server-Timing中的耗时截止到开始发送响应，日志中的耗时截止到响应发送结束，流式响应发送中执行的查询只计入日志
+    """
+
+    def __init__(self, slowest: int = 3, n_plus_one_threshold: int = 5, slow_ms: float = 200, server_timing: bool = True):
+        """
+        Args:
+            slowest: 记录耗时最长的SQL条数
+            n_plus_one_threshold: 形状相同的SQL执行次数达到此值时认为是N+1查询
+            slow_ms: 单条SQL耗时超过此值时认为是慢查询，单位 毫秒
+            server_timing: 是否输出Server-Timing响应头，对外的服务可以关闭
+        """
+        self.slowest = slowest
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.slow_ms = slow_ms
+        self.server_timing_enabled = server_timing
+
+    def collect(self) -> ContextManager[QueryStats]:
+        return collect_query_stats(self.slowest, self.n_plus_one_threshold)
+
+    def server_timing(self, stats: QueryStats, total_ms: float) -> Optional[str]:
+        if not self.server_timing_enabled:
+            return None
+        return f'db;dur={stats.seconds * 1000:.3f};desc="{stats.count} queries", app;dur={total_ms:.3f}'
+
+    def report(self, method: str, path: str, status_code: int, stats: QueryStats, total_ms: float):
+        if not stats.count:
+            return
+        metrics_ = stats.metrics()
+        slow_ = [item_ for item_ in metrics_["slowest"] if item_["ms"] > self.slow_ms]
+        message_ = f"SQL {method} {path}: {stats.count} queries, {metrics_['ms']}ms"
+        if metrics_["repeated"]:
+            message_ += f", repeated: {metrics_['repeated']}"
+        if slow_:
+            message_ += f", slow: {slow_}"
+        logger.bind(sql_stats={
+            "method": method,
+            "path": path,
+            "status_code": status_code,
+            "ms": round(total_ms, 3),
+            **metrics_,
+        }).log("WARNING" if metrics_["repeated"] or slow_ else "DEBUG", message_)
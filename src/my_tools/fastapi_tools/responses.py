@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/24 9:40
+# @Author  : NotBeBarnon
+# @Description : 视图集工具使用的响应类
+from typing import Any
+
+import orjson
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+__all__ = (
+    "orjson_dumps",
+    "PydanticORJSONResponse",
+)
+
+
+def orjson_dumps(content: Any) -> bytes:
+    """
+    序列化为json，支持pydantic对象及orjson不支持的Decimal等类型
+    """
+    if isinstance(content, BaseModel):
+        content = content.dict(by_alias=True)
+    return orjson.dumps(content, default=pydantic_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+
+class PydanticORJSONResponse(ORJSONResponse):
+    """
+    直接序列化内容的ORJSONResponse，用于输出values()查询得到的字典等不经过response_model校验的数据
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson_dumps(content)
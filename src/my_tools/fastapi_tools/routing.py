@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/22 10:00
+# @Author  : NotBeBarnon
+# @Description : 视图集的路由类，按Action的选项包装路由的处理函数
+from typing import Awaitable, Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from .coalesce import RequestCoalescer
+from .pinning import ConnectionPinning
+
+__all__ = (
+    "ViewSetRoute",
+)
+
+
+class ViewSetRoute(APIRoute):
+    """
+    在路由上处理只对部分视图生效的选项，请求只在匹配到路由后才经过包装，其他请求没有额外的开销
+    - coalesce: 合并相同的并发GET请求，在最外层，跟随的请求不解析依赖项
+    - pin_connections: 固定数据库连接，包括依赖项的解析
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Awaitable[Response]]:
+        handler_ = super().get_route_handler()
+        options_ = getattr(self.endpoint, "__fast_options__", {})
+        if options_.get("pin_connections", False):
+            handler_ = ConnectionPinning.wrap(handler_)
+        if options_.get("coalesce", False):
+            handler_ = RequestCoalescer().wrap(handler_)
+        return handler_
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/30 10:30
+# @Author  : NotBeBarnon
+# @Description : 将Tortoise序列化类编译为直接输出字典的函数，跳过pydantic对象的构建与校验
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
+
+from pydantic.fields import SHAPE_SINGLETON
+from tortoise.contrib.pydantic import PydanticModel
+from tortoise.models import Model
+from tortoise.queryset import QuerySet
+
+from .planner import RelationPlan
+
+__all__ = (
+    "CompiledSerializer",
+)
+
+
+class CompiledSerializer(object):
+    """
+    根据 pydantic_model_creator 生成的序列化类编译专用的序列化函数
+    - 输出与 from_tortoise_orm 后再由FastAPI编码的结果一致，可以直接交给orjson
+    - 序列化类的字段全部是数据库列时，直接使用values()查询，不再构建模型对象
+    - 序列化类中自定义的validator不会执行，需要的视图不要使用
+    - 在第一次使用时编译，外键的 xxx_id 列在Tortoise初始化后才存在
+    - 关联数据按RelationPlan查询
+    """
+    __instances: Dict[Type[PydanticModel], "CompiledSerializer"] = {}
+
+    def __init__(self, schema: Type[PydanticModel]):
+        self.schema = schema
+        self.model: Type[Model] = getattr(schema.__config__, "orig_model")
+        self.__serialize: Optional[Callable[[Model], Dict[str, Any]]] = None
+        self.__columns: Optional[Tuple[str, ...]] = None
+        self.source: Optional[str] = None
+
+    @classmethod
+    def of(cls, schema: Type[PydanticModel]) -> "CompiledSerializer":
+        """
+        获取序列化类对应的编译器，同一个序列化类只编译一次，嵌套与循环引用的序列化类共享实例
+        """
+        if (serializer_ := cls.__instances.get(schema)) is None:
+            serializer_ = cls.__instances[schema] = cls(schema)
+        return serializer_
+
+    @property
+    def columns(self) -> Optional[Tuple[str, ...]]:
+        """
+        所有字段都是数据库列时返回列名，否则返回None
+        """
+        self.__ensure_compiled()
+        return self.__columns
+
+    @property
+    def fetch_fields(self) -> List[str]:
+        """
+        需要预先查询的关联路径
+        """
+        return RelationPlan.of(self.schema).paths
+
+    def serialize(self, obj: Model) -> Dict[str, Any]:
+        """
+        序列化单个模型对象，关联字段需要已经查询
+        """
+        self.__ensure_compiled()
+        return self.__serialize(obj)
+
+    async def serialize_object(self, obj: Model) -> Dict[str, Any]:
+        await obj.fetch_related(*self.fetch_fields)
+        return self.serialize(obj)
+
+    async def serialize_queryset(self, queryset: QuerySet) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        执行查询集并序列化，单个对象的查询集返回字典，否则返回列表
+        """
+        if self.columns is not None:
+            return await queryset.values(*self.columns)
+        result_ = await RelationPlan.of(self.schema).apply(queryset)
+        if queryset._single:
+            return self.serialize(result_)
+        return [self.serialize(obj_) for obj_ in result_]
+
+    def __ensure_compiled(self):
+        if self.__serialize is None:
+            self.__compile()
+
+    def __compile(self):
+        meta_ = self.model._meta
+        namespace_: Dict[str, Any] = {}
+        items_: List[str] = []
+        columns_: List[str] = []
+        for name_, field_ in self.schema.__fields__.items():
+            if name_ in meta_.fetch_fields:
+                serializer_var_ = f"_s{len(namespace_)}"
+                namespace_[serializer_var_] = CompiledSerializer.of(field_.type_)
+                if field_.shape == SHAPE_SINGLETON:
+                    expr_ = f"None if (v_ := obj.{name_}) is None else {serializer_var_}.serialize(v_)"
+                else:
+                    expr_ = f"[{serializer_var_}.serialize(item_) for item_ in obj.{name_}]"
+            elif name_ in meta_.fields_map or name_ in meta_.db_fields:
+                expr_ = f"obj.{name_}"
+                if field_.alias == name_:
+                    columns_.append(name_)
+            elif callable(getattr(self.model, name_, None)):
+                # computed字段
+                expr_ = f"obj.{name_}()"
+            else:
+                # 序列化类中额外定义的字段，模型没有对应属性时使用默认值
+                default_var_ = f"_d{len(namespace_)}"
+                namespace_[default_var_] = field_.get_default()
+                expr_ = f"getattr(obj, {name_!r}, {default_var_})"
+            items_.append(f"        {field_.alias!r}: {expr_},")
+
+        self.source = "def serialize(obj):\n    return {\n" + "\n".join(items_) + "\n    }\n"
+        exec(compile(self.source, f"<CompiledSerializer {self.schema.__name__}>", "exec"), namespace_)
+        self.__columns = tuple(columns_) if len(columns_) == len(self.schema.__fields__) else None
+        self.__serialize = namespace_["serialize"]
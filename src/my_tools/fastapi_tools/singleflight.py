@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/26 9:30
+# @Author  : NotBeBarnon
+# @Description : 合并相同key的并发调用
+import asyncio
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+__all__ = (
+    "SingleFlight",
+)
+
+
+class SingleFlight(object):
+    """
+    相同key的并发调用只执行一次，其余调用等待并共享结果（或异常）
+    - 只在当前进程的事件循环内合并
+    - 调用结束后立即移除，不缓存结果
+    - func在独立的任务中执行（复制第一个调用者的上下文），任何一个调用者被取消都不影响func与其他调用者
+    """
+
+    def __init__(self):
+        self.__flights: Dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.__flights
+
+    def __len__(self) -> int:
+        return len(self.__flights)
+
+    def __done(self, key: Hashable, task: asyncio.Task):
+        if self.__flights.get(key) is task:
+            del self.__flights[key]
+        # 所有调用者都已被取消时避免 "Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        执行func，如果相同key的调用正在执行则等待其结果
+        Args:
+            key: 合并调用的key
+            func: 无参数的协程函数
+        """
+        task_ = self.__flights.get(key)
+        if task_ is None:
+            task_ = self.__flights[key] = asyncio.create_task(func())
+            task_.add_done_callback(partial(self.__done, key))
+        # shield使调用者被取消时只取消自身的等待
+        return await asyncio.shield(task_)
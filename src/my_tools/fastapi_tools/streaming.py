@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/8/23 14:05
+# @Author  : NotBeBarnon
+# @Description : 查询集的流式响应
+from enum import Enum
+from typing import Any, AsyncIterator, List, Mapping, Optional, Sequence, Type
+
+from fastapi.responses import StreamingResponse
+from loguru import logger
+from tortoise.contrib.pydantic import PydanticModel
+from tortoise.queryset import QuerySet
+
+from .pagination import KeysetPagination
+from .planner import RelationPlan
+from .responses import orjson_dumps
+from .serializer import CompiledSerializer
+
+__all__ = (
+    "StreamFormatEnum",
+    "QuerySetStreamingResponse",
+    "iter_queryset",
+    "DEFAULT_CHUNK_SIZE",
+)
+
+DEFAULT_CHUNK_SIZE = 200  # 每次从数据库读取的行数
+
+
+class StreamFormatEnum(str, Enum):
+    ndjson = "ndjson"  # 每行一个json对象
+    json_array = "json_array"  # 分块输出的json数组，与普通列表响应的格式相同
+
+
+async def iter_queryset(
+    queryset: QuerySet,
+    schema: Type[PydanticModel],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    fields: Optional[Sequence[str]] = None,
+    serializer: Optional[CompiledSerializer] = None,
+) -> AsyncIterator[List[Any]]:
+    """
+    按主键分块查询并序列化查询集，每次只在内存中保留一块数据
+    Args:
+        queryset: 查询集，原有的排序会被主键排序覆盖
+        schema: 序列化类
+        chunk_size: 每块的行数
+        fields: 投影查询的列，设置时使用values()查询，不再构建序列化对象，需要包括主键
+        serializer: 编译的序列化器，设置时不再构建序列化对象
+    """
+    pagination_ = KeysetPagination(queryset.model)
+    last_values_ = None
+    while True:
+        chunk_queryset_ = pagination_.seek(queryset, last_values_, chunk_size)
+        if fields:
+            chunk_ = await chunk_queryset_.values(*fields)
+        elif serializer is not None:
+            chunk_ = await serializer.serialize_queryset(chunk_queryset_)
+        else:
+            chunk_ = await RelationPlan.of(schema).from_queryset(chunk_queryset_)
+        if chunk_:
+            yield chunk_
+        if len(chunk_) < chunk_size:
+            return
+        last_values_ = pagination_.values_of(chunk_[-1])
+
+
+class QuerySetStreamingResponse(StreamingResponse):
+    """
+    将查询集逐行序列化写入响应体，内存占用只与chunk_size有关
+    """
+
+    def __init__(
+        self,
+        queryset: QuerySet,
+        schema: Type[PydanticModel],
+        stream_format: StreamFormatEnum = StreamFormatEnum.ndjson,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        fields: Optional[Sequence[str]] = None,
+        serializer: Optional[CompiledSerializer] = None,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        chunks_ = iter_queryset(queryset, schema, chunk_size, fields, serializer)
+        if stream_format == StreamFormatEnum.ndjson:
+            content_, media_type_ = self.__ndjson(queryset, chunks_), "application/x-ndjson"
+        else:
+            content_, media_type_ = self.__json_array(queryset, chunks_), "application/json"
+        super().__init__(content_, status_code=status_code, headers=headers, media_type=media_type_)
+
+    @staticmethod
+    async def __ndjson(queryset: QuerySet, chunks: AsyncIterator[List[Any]]) -> AsyncIterator[bytes]:
+        try:
+            async for chunk_ in chunks:
+                yield b"".join(orjson_dumps(item_) + b"\n" for item_ in chunk_)
+        except Exception as exc:
+            # 响应头已发送，无法再修改状态码，只能中断输出
+            logger.exception(f"Stream {queryset.model.__name__} failed - {exc.__class__.__name__}:{exc}")
+            raise
+
+    @staticmethod
+    async def __json_array(queryset: QuerySet, chunks: AsyncIterator[List[Any]]) -> AsyncIterator[bytes]:
+        yield b"["
+        first_ = True
+        try:
+            async for chunk_ in chunks:
+                body_ = b",".join(orjson_dumps(item_) for item_ in chunk_)
+                yield body_ if first_ else b"," + body_
+                first_ = False
+        except Exception as exc:
+            logger.exception(f"Stream {queryset.model.__name__} failed - {exc.__class__.__name__}:{exc}")
+            raise
+        yield b"]"
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/7 10:10
+# @Author  : NotBeBarnon
+# @Description : 流式读取上传的 ndjson / csv 数据并分批处理
+import csv
+from enum import Enum
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import orjson
+from fastapi import HTTPException, Request
+from starlette import status
+
+__all__ = (
+    "UploadFormatEnum",
+    "UploadRecord",
+    "AdaptiveBatchSize",
+    "iter_lines",
+    "iter_records",
+    "iter_batches",
+)
+
+MAX_LINE_SIZE = 1024 * 1024  # 单行数据的最大字节数
+
+# (行号, 解析后的数据, 解析失败的原因)，行号从1开始，csv的表头为第1行
+UploadRecord = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+
+
+class UploadFormatEnum(str, Enum):
+    ndjson = "ndjson"  # 每行一个json对象
+    csv = "csv"  # 第一行为表头
+
+    @classmethod
+    def of(cls, content_type: Optional[str]) -> "UploadFormatEnum":
+        """
+        根据Content-Type判断格式，无法判断时按ndjson处理
+        """
+        return cls.csv if content_type and "csv" in content_type.lower() else cls.ndjson
+
+
+class AdaptiveBatchSize(object):
+    """
+    根据每批的耗时调整批大小，使每批的耗时接近target秒
+    - 批越大SQL往返越少，但单个事务持有锁的时间越长
+    """
+
+    def __init__(self, initial: int = 500, minimum: int = 100, maximum: int = 5000, target: float = 0.5):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+
+    def record(self, count: int, elapsed: float):
+        """
+        记录一批的处理耗时，调整下一批的大小
+        """
+        if count < self.size:
+            # 不满一批时的耗时不代表批大小的耗时
+            return
+        if elapsed < self.target / 2:
+            self.size = min(self.size * 2, self.maximum)
+        elif elapsed > self.target * 2:
+            self.size = max(self.size // 2, self.minimum)
+
+
+async def iter_lines(request: Request) -> AsyncIterator[bytes]:
+    """
+    逐行读取请求体，不会将完整的请求体读入内存
+    """
+    buffer_ = b""
+    async for chunk_ in request.stream():
+        buffer_ += chunk_
+        *lines_, buffer_ = buffer_.split(b"\n")
+        for line_ in lines_:
+            yield line_
+        if len(buffer_) > MAX_LINE_SIZE:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="单行数据过长")
+    if buffer_:
+        yield buffer_
+
+
+async def iter_records(request: Request, upload_format: UploadFormatEnum) -> AsyncIterator[UploadRecord]:
+    """
+    逐行解析上传的数据，空行被忽略，解析失败的行返回失败原因而不是中断
+    """
+    header_: Optional[List[str]] = None
+    line_no_ = 0
+    async for line_ in iter_lines(request):
+        line_no_ += 1
+        if line_no_ == 1 and line_.startswith(b"\xef\xbb\xbf"):
+            line_ = line_[3:]  # Excel导出的csv带有BOM
+        if not line_.strip():
+            continue
+        if upload_format == UploadFormatEnum.ndjson:
+            try:
+                record_ = orjson.loads(line_)
+            except orjson.JSONDecodeError:
+                yield line_no_, None, "无效的json"
+                continue
+            if isinstance(record_, dict):
+                yield line_no_, record_, None
+            else:
+                yield line_no_, None, "每行需要是一个json对象"
+            continue
+
+        try:
+            values_ = next(csv.reader([line_.decode("utf-8").rstrip("\r")]))
+        except (UnicodeDecodeError, csv.Error):
+            yield line_no_, None, "无效的csv行"
+            continue
+        if header_ is None:
+            header_ = [name_.strip() for name_ in values_]
+        elif len(values_) != len(header_):
+            yield line_no_, None, f"列数与表头不一致，需要{len(header_)}列"
+        else:
+            yield line_no_, dict(zip(header_, values_)), None
+
+
+async def iter_batches(records: AsyncIterator[UploadRecord], batch_size: AdaptiveBatchSize) -> AsyncIterator[List[UploadRecord]]:
+    """
+    按当前的批大小分批，批大小在两批之间调整
+    """
+    batch_: List[UploadRecord] = []
+    async for record_ in records:
+        batch_.append(record_)
+        if len(batch_) >= batch_size.size:
+            yield batch_
+            batch_ = []
+    if batch_:
+        yield batch_
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/8 9:50
+# @Author  : NotBeBarnon
+# @Description : 并发执行相互独立的校验
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+__all__ = (
+    "Rule",
+    "validate_all",
+)
+
+
+class Rule(object):
+    """
+    一条校验规则，check的结果经过expect判断为False时校验失败
+    - check中也可以直接抛出HTTPException，用于需要根据查询结果做多个判断的规则
+    """
+
+    def __init__(
+        self,
+        check: Awaitable[Any],
+        detail: Optional[str] = None,
+        expect: Callable[[Any], bool] = bool,
+        status_code: int = status.HTTP_400_BAD_REQUEST,
+    ):
+        self.check = check
+        self.detail = detail
+        self.expect = expect
+        self.status_code = status_code
+
+    @classmethod
+    def must(cls, check: Awaitable[Any], detail: str, status_code: int = status.HTTP_400_BAD_REQUEST) -> "Rule":
+        """
+        结果为真时通过，如数据必须存在
+        """
+        return cls(check, detail, bool, status_code)
+
+    @classmethod
+    def must_not(cls, check: Awaitable[Any], detail: str, status_code: int = status.HTTP_400_BAD_REQUEST) -> "Rule":
+        """
+        结果为假时通过，如数据不能重复
+        """
+        return cls(check, detail, lambda result_: not result_, status_code)
+
+    @classmethod
+    def custom(cls, check: Awaitable[Any]) -> "Rule":
+        """
+        check自行抛出HTTPException，不判断其结果
+        """
+        return cls(check, expect=lambda _: True)
+
+    def error(self) -> HTTPException:
+        return HTTPException(status_code=self.status_code, detail=self.detail)
+
+
+async def validate_all(*rules: Optional[Rule]) -> List[Any]:
+    """
+    并发执行所有规则，耗时约等于最慢的一条
+    - 与按顺序校验的结果一致：多条规则失败时抛出排在最前的规则的错误
+    - 某条规则失败且排在它前面的规则都已通过时，立即取消其余规则并抛出错误
+    - 每个查询从连接池获取各自的连接，不要在事务中调用（事务中的查询共用一个连接）
+    Args:
+        rules: 校验规则，为None的规则被跳过，用于按条件添加的规则
+
+    Returns:
+        每条规则check的结果，与rules的顺序一致，跳过的规则为None
+    """
+    tasks_: List[Optional[asyncio.Future]] = [
+        asyncio.ensure_future(rule_.check) if rule_ is not None else None for rule_ in rules
+    ]
+    results_: List[Any] = [None] * len(tasks_)
+    index_ = 0
+    try:
+        while index_ < len(tasks_):
+            task_ = tasks_[index_]
+            if task_ is None:
+                index_ += 1
+            elif not task_.done():
+                # 当前规则未结束时等待任意一条规则结束，排在后面的规则失败也要等前面的规则确定结果
+                await asyncio.wait([pending_ for pending_ in tasks_[index_:] if pending_ is not None and not pending_.done()],
+                                   return_when=asyncio.FIRST_COMPLETED)
+            elif task_.exception() is not None:
+                raise task_.exception()
+            elif not rules[index_].expect(task_.result()):
+                raise rules[index_].error()
+            else:
+                results_[index_] = task_.result()
+                index_ += 1
+        return results_
+    finally:
+        for task_ in tasks_:
+            if task_ is None:
+                continue
+            if not task_.done():
+                task_.cancel()
+            elif not task_.cancelled():
+                # 提前结束时后面的规则可能也抛出了异常，避免 "Task exception was never retrieved"
+                task_.exception()
@@ -2,17 +2,58 @@
 # @Time    : 2021/11/29 11:19
 # @Author  : NotBeBarnon
 # @Description :
+import inspect
 import re
-from functools import wraps
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import time
+import typing
+from functools import partial, wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Type
 
-from fastapi import APIRouter, Response
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.types import DecoratedCallable
 from loguru import logger
 from tortoise import Model
 from tortoise.contrib.pydantic import PydanticModel
-
-from .factory import generate_all, generate_create, generate_delete, generate_get, generate_update
+from tortoise.queryset import QuerySet
+
+from .cache import ResponseCache
+from .conditional import etag_matches, make_content_etag, make_version_etag, not_modified_response
+from .factory import (
+    BULK_BATCH_SIZE,
+    MAX_PAGE_SIZE,
+    generate_all,
+    generate_bulk_create,
+    generate_bulk_delete,
+    generate_bulk_update,
+    generate_create,
+    generate_delete,
+    generate_get,
+    generate_update,
+)
+from .lifecycle import ViewSetLifecycle, ViewSetScopeEnum
+from .optimistic import is_version_field
+from .pagination import KeysetPagination
+from .planner import RelationPlan
+from .projection import FieldsProjection
+from .responses import PydanticORJSONResponse
+from .routing import ViewSetRoute
+from .serializer import CompiledSerializer
+from .streaming import DEFAULT_CHUNK_SIZE, QuerySetStreamingResponse
+
+_FIELDS_PARAM_NAME = "fast_fields_"  # 路由注入的字段投影参数名称
+_REQUEST_PARAM_NAME = "fast_request_"  # 路由注入的请求参数名称
+
+
+def get_response_schema(response_model: Any) -> Optional[Type[PydanticModel]]:
+    """
+    获取response_model对应的Tortoise序列化类，List[Schema]返回Schema
+    """
+    if typing.get_origin(response_model) in (list, List):
+        response_model = typing.get_args(response_model)[0]
+    if isinstance(response_model, type) and issubclass(response_model, PydanticModel):
+        return response_model
+    return None
 
 
 class CBVTransponder(object):
@@ -21,8 +62,8 @@ class CBVTransponder(object):
 
 class ViewSetMetaClass(type):
     _essential_attribute_sets = {"model", "schema", "pk_type", "views"}
-    _all_view_name = {"all", "get", "create", "update", "delete"}
-    _inputable_view_name = {"create", "update"}
+    _all_view_name = {"all", "get", "create", "update", "delete", "bulk_create", "bulk_update", "bulk_delete"}
+    _inputable_view_name = {"create", "update", "bulk_create", "bulk_update"}
 
     def __new__(mcs, name, bases, attrs):
         if name == "BaseViewSet":
@@ -36,19 +77,44 @@ class ViewSetMetaClass(type):
             return super().__new__(mcs, name, bases, attrs)
         # 生成基础方法
         if "all" in attrs["views"] and "all" not in attrs:
-            attrs["all"] = generate_all(attrs["model"], attrs["schema"])
+            attrs["all"] = generate_all(
+                attrs["model"],
+                attrs["schema"],
+                page_size=attrs.get("page_size", None),
+                cursor_field=mcs._check_cursor_field(attrs, name),
+                max_page_size=attrs.get("max_page_size", MAX_PAGE_SIZE),
+                stream_format=attrs.get("stream_format", None),
+                stream_chunk_size=attrs.get("stream_chunk_size", DEFAULT_CHUNK_SIZE),
+                compiled=attrs.get("compiled_serializer", False),
+            )
 
         if "create" in attrs["views"] and "create" not in attrs:
             attrs["create"] = generate_create(attrs["model"], attrs["schema"], attrs["views"]["create"])
 
         if "get" in attrs["views"] and "get" not in attrs:
-            attrs["get"] = generate_get(attrs["model"], attrs["schema"], attrs["pk_type"])
+            attrs["get"] = generate_get(
+                attrs["model"], attrs["schema"], attrs["pk_type"], etag=attrs.get("etag", False), compiled=attrs.get("compiled_serializer", False)
+            )
 
+        fast_write_ = attrs.get("fast_write", False)
+        version_field_ = mcs._check_version_field(attrs, name)
         if "update" in attrs["views"] and "update" not in attrs:
-            attrs["update"] = generate_update(attrs["model"], attrs["schema"], attrs["pk_type"], attrs["views"]["update"])
+            attrs["update"] = generate_update(
+                attrs["model"], attrs["schema"], attrs["pk_type"], attrs["views"]["update"], fast_write_, version_field_
+            )
 
         if "delete" in attrs["views"] and "delete" not in attrs:
-            attrs["delete"] = generate_delete(attrs["model"], attrs["schema"], attrs["pk_type"])
+            attrs["delete"] = generate_delete(attrs["model"], attrs["schema"], attrs["pk_type"], fast_write_, version_field_)
+
+        bulk_batch_size_ = attrs.get("bulk_batch_size", BULK_BATCH_SIZE)
+        if "bulk_create" in attrs["views"] and "bulk_create" not in attrs:
+            attrs["bulk_create"] = generate_bulk_create(attrs["model"], attrs["views"]["bulk_create"], bulk_batch_size_)
+
+        if "bulk_update" in attrs["views"] and "bulk_update" not in attrs:
+            attrs["bulk_update"] = generate_bulk_update(attrs["model"], attrs["pk_type"], attrs["views"]["bulk_update"], bulk_batch_size_)
+
+        if "bulk_delete" in attrs["views"] and "bulk_delete" not in attrs:
+            attrs["bulk_delete"] = generate_bulk_delete(attrs["model"], attrs["pk_type"], bulk_batch_size_)
 
         return super().__new__(mcs, name, bases, attrs)
 
@@ -77,8 +143,53 @@ class ViewSetMetaClass(type):
             logger.warning(f"The \"pk_type\" in {name} is invalid.")
             return False
 
+        if attrs.get("page_size", None) is not None and not (isinstance(attrs["page_size"], int) and attrs["page_size"] > 0):
+            logger.warning(f"The \"page_size\" in {name} is invalid.")
+            return False
+        if not (isinstance(attrs.get("bulk_batch_size", BULK_BATCH_SIZE), int) and attrs.get("bulk_batch_size", BULK_BATCH_SIZE) > 0):
+            logger.warning(f"The \"bulk_batch_size\" in {name} is invalid.")
+            return False
+        if attrs.get("page_size", None) is not None and attrs["model"]._meta.pk_attr not in attrs["schema"].__fields__:
+            logger.warning(f"The \"schema\" in {name} must contain the primary key when \"page_size\" is set.")
+            return False
+
         return ViewSetMetaClass._check_views(attrs["views"], name)
 
+    @staticmethod
+    def _check_version_field(attrs: Dict, name: str) -> Optional[str]:
+        """
+        检查乐观并发控制使用的版本列，不合法时不启用
+        """
+        version_field_ = attrs.get("version_field", None)
+        if version_field_ is None:
+            return None
+        if not is_version_field(attrs["model"], version_field_):
+            logger.warning(f"The \"version_field\" in {name} is invalid, it must be an auto_now datetime or integer field.")
+            return None
+        return version_field_
+
+    @staticmethod
+    def _check_cursor_field(attrs: Dict, name: str) -> Optional[str]:
+        """
+        检查游标分页使用的列，不合法时退回使用主键
+        Args:
+            attrs: 所有的类属性
+            name: 类名称
+
+        Returns:
+            Optional[str]: 合法的游标列，None表示使用主键
+        """
+        cursor_field_ = attrs.get("cursor_field", None)
+        if cursor_field_ is None:
+            return None
+        if not KeysetPagination.is_indexed(attrs["model"], cursor_field_):
+            logger.warning(f"The \"cursor_field\" in {name} is not an indexed non-null column, use primary key instead.")
+            return None
+        if cursor_field_ not in attrs["schema"].__fields__:
+            logger.warning(f"The \"cursor_field\" in {name} is not in \"schema\", use primary key instead.")
+            return None
+        return cursor_field_
+
     @staticmethod
     def _check_views(views: Any, name: str) -> bool:
         """
@@ -107,36 +218,95 @@ class BaseViewSet(metaclass=ViewSetMetaClass):
     __pascal_again_regex = re.compile(r"(?P<key>[A-Z]{2,})")
 
     __transponder: Optional[CBVTransponder] = None
+    __lifecycle: Optional[ViewSetLifecycle] = None
+    __registered_viewsets: List[Type["BaseViewSet"]] = []
+    __register_costs: Dict[str, float] = {}
 
     auto_view_path: bool = True  # 是否自动添加路由前缀
+    scope: ViewSetScopeEnum = ViewSetScopeEnum.request  # 视图集实例的作用域
+    pool_size: int = 16  # scope为pool时保留的空闲实例数量
+
+    @classmethod
+    async def on_startup(cls):
+        """
+        应用启动时调用（在Tortoise初始化之后），用于创建视图集共享的资源，如HTTP客户端、缓存等
+        """
+
+    @classmethod
+    async def on_shutdown(cls):
+        """
+        应用关闭时调用（在关闭数据库连接之前），用于释放on_startup创建的资源
+        """
+
+    @staticmethod
+    async def startup_all():
+        """
+        按注册顺序调用所有已注册视图集的on_startup，并预先创建singleton/pool作用域的实例
+        """
+        for viewset_ in BaseViewSet.__registered_viewsets:
+            await viewset_.on_startup()
+            viewset_.__lifecycle.prepare()
+
+    @staticmethod
+    async def shutdown_all():
+        """
+        按注册的逆序调用所有已注册视图集的on_shutdown，单个视图集失败不影响其他视图集
+        """
+        for viewset_ in reversed(BaseViewSet.__registered_viewsets):
+            viewset_.__lifecycle.clear()
+            try:
+                await viewset_.on_shutdown()
+            except Exception as exc:
+                logger.exception(f"Shutdown {viewset_.__name__} failed - {exc.__class__.__name__}:{exc}")
 
     @classmethod
     def __get_views(cls) -> Iterator[Tuple[str, DecoratedCallable]]:
-        all_views_: List[Tuple[str, DecoratedCallable]] = []
-        for attr_name in dir(cls):
-            view = getattr(cls, attr_name)
-            if hasattr(view, "__fast_view__"):
-                all_views_.append((attr_name, view))
+        # 只检查类字典中的属性，子类的同名属性覆盖父类，比dir()+getattr()少触发大量描述符
+        attrs_: Dict[str, Any] = {}
+        for klass_ in reversed(cls.__mro__):
+            attrs_.update(vars(klass_))
+        all_views_: List[Tuple[str, DecoratedCallable]] = [
+            (attr_name, view) for attr_name, view in attrs_.items() if hasattr(view, "__fast_view__")
+        ]
 
         all_views_.sort(key=lambda x: x[1].__fast_view__["path"])
         return all_views_
 
+    @staticmethod
+    def register_costs() -> Dict[str, float]:
+        """
+        各视图集注册路由的耗时（秒），用于分析启动耗时
+        """
+        return dict(BaseViewSet.__register_costs)
+
     @classmethod
     def register(cls, router: APIRouter):
         if cls.__transponder is not None or issubclass(cls, CBVTransponder):
             return
+        start_ = time.perf_counter()
         cbv_transponder_class_ = type(
             f"{cls.__name__}Transponder",
             (CBVTransponder, cls),
             {"__doc__": f"{cls.__name__} CBVTransponder"},
         )
         cls.__transponder = cbv_transponder_class_()
+        scope_ = cls.scope
+        if scope_ not in ViewSetScopeEnum.__members__.values():
+            logger.warning(f"The \"scope\" in {cls.__name__} is invalid, use request scope.")
+            scope_ = ViewSetScopeEnum.request
+        cls.__lifecycle = ViewSetLifecycle(cls, ViewSetScopeEnum(scope_), cls.pool_size)
+        BaseViewSet.__registered_viewsets.append(cls)
 
         for view_name, view_func in cls.__get_views():
-            fast_route = cls.__create_fast_route(view_func, view_name, cls)
+            fast_route = cls.__create_fast_route(view_func, view_name, cls, cls.__lifecycle)
             transponder_func_name_ = f"transponder_{view_name}"
             setattr(cbv_transponder_class_, transponder_func_name_, fast_route)
-            router.add_api_route(endpoint=getattr(cls.__transponder, transponder_func_name_), **cls.__build_fast_view_params(view_func.__fast_view__, view_func))
+            router.add_api_route(
+                endpoint=getattr(cls.__transponder, transponder_func_name_),
+                route_class_override=ViewSetRoute,
+                **cls.__build_fast_view_params(view_func.__fast_view__, view_func),
+            )
+        BaseViewSet.__register_costs[f"{cls.__module__}.{cls.__name__}"] = time.perf_counter() - start_
 
     @classmethod
     def __build_fast_view_params(cls, fast_view: Dict, view_func: DecoratedCallable) -> Dict:
@@ -156,9 +326,143 @@ class BaseViewSet(metaclass=ViewSetMetaClass):
         return fast_view
 
     @staticmethod
-    def __create_fast_route(view_func: DecoratedCallable, view_name: str, call_cls: Callable) -> DecoratedCallable:
+    def __create_fast_route(view_func: DecoratedCallable, view_name: str, call_cls: Callable, lifecycle: ViewSetLifecycle) -> DecoratedCallable:
+        fast_options_ = getattr(view_func, "__fast_options__", {})
+        schema_ = get_response_schema(view_func.__fast_view__["response_model"])
+        if schema_ is None and (fast_options_.get("stream", None) or fast_options_.get("projection", False)):
+            logger.warning(f"The \"response_model\" of {call_cls.__name__}.{view_name} is not a Tortoise pydantic model, stream and projection are disabled.")
+        projection_ = FieldsProjection(schema_) if schema_ is not None and fast_options_.get("projection", False) else None
+        etag_ = fast_options_.get("etag", False)
+        nested_fields_: Set[str] = set()  # 输出中的关联数据，其变更不会改变版本列
+        if isinstance(etag_, str):
+            model_ = getattr(schema_.__config__, "orig_model") if schema_ is not None else None
+            if model_ is None or etag_ not in model_._meta.db_fields:
+                logger.warning(f"The \"etag\" of {call_cls.__name__}.{view_name} is not a field of model, use content etag.")
+                etag_ = True
+            else:
+                nested_fields_ = set(schema_.__fields__) & model_._meta.fetch_fields
+
+        cache_: Optional[ResponseCache] = fast_options_.get("cache", None)
+        if cache_ is not None and fast_options_.get("stream", None):
+            logger.warning(f"The \"cache\" of {call_cls.__name__}.{view_name} is disabled for stream response.")
+            cache_ = None
+        if fast_options_.get("coalesce", False) and fast_options_.get("stream", None):
+            logger.warning(f"The \"coalesce\" of {call_cls.__name__}.{view_name} will buffer the whole stream response.")
+
+        async def respond_(view_args: Tuple, view_kwargs: Dict, fields_: Optional[Tuple[str, ...]], if_none_match_: Optional[str]) -> Any:
+            instance_ = lifecycle.acquire()
+            try:
+                result_ = await view_func(instance_, *view_args, **view_kwargs)
+            finally:
+                lifecycle.release(instance_)
+            if not etag_ and cache_ is None:
+                if schema_ is None or not isinstance(result_, QuerySet):
+                    return result_
+                return await BaseViewSet.__resolve_queryset(result_, schema_, fast_options_, fields_, view_kwargs)
+
+            version_etag_ = version_ = None
+            if isinstance(etag_, str) and isinstance(result_, QuerySet) and result_._single:
+                version_ = (await result_.values(etag_))[etag_]
+                if not nested_fields_.intersection(fields_ or nested_fields_):
+                    # 只查询版本列，匹配时不再查询与序列化完整数据
+                    version_etag_ = make_version_etag(version_, fields_)
+                    if etag_matches(if_none_match_, version_etag_):
+                        return not_modified_response(version_etag_)
+            if schema_ is not None and isinstance(result_, QuerySet):
+                result_ = await BaseViewSet.__resolve_queryset(result_, schema_, fast_options_, fields_, view_kwargs)
+            if isinstance(result_, StreamingResponse):
+                return result_
+            if not isinstance(result_, Response):
+                result_ = PydanticORJSONResponse(result_, headers=BaseViewSet.__sub_response_headers(view_kwargs))
+            if etag_:
+                if version_etag_ is None and version_ is not None:
+                    # 包含关联数据时版本值与响应内容共同生成ETag，仍可用于 If-Match
+                    response_etag_ = make_version_etag(version_, fields_, result_.body)
+                else:
+                    response_etag_ = version_etag_ or make_content_etag(result_.body)
+                if version_etag_ is None and etag_matches(if_none_match_, response_etag_):
+                    return not_modified_response(response_etag_)
+                result_.headers["ETag"] = response_etag_
+            return result_
+
         @wraps(view_func)
         async def fast_route(self, *view_args, **view_kwargs) -> Response:
-            return await view_func(call_cls(), *view_args, **view_kwargs)
-
+            fields_ = view_kwargs.pop(_FIELDS_PARAM_NAME, None)
+            request_: Optional[Request] = view_kwargs.pop(_REQUEST_PARAM_NAME, None)
+            if_none_match_ = request_.headers.get("if-none-match") if request_ is not None else None
+            if cache_ is None:
+                return await respond_(view_args, view_kwargs, fields_, if_none_match_)
+
+            # 缓存的是完整响应，条件请求在缓存之外判断
+            response_ = await cache_.get_or_render(ResponseCache.make_key(request_), partial(respond_, view_args, view_kwargs, fields_, None))
+            if (response_etag_ := response_.headers.get("etag")) and etag_matches(if_none_match_, response_etag_):
+                return not_modified_response(response_etag_)
+            return response_
+
+        if projection_ is not None:
+            BaseViewSet.__inject_params(
+                fast_route,
+                inspect.Parameter(_FIELDS_PARAM_NAME, inspect.Parameter.KEYWORD_ONLY, default=Depends(projection_)),
+            )
+        if etag_ or cache_ is not None:
+            BaseViewSet.__inject_params(
+                fast_route,
+                inspect.Parameter(_REQUEST_PARAM_NAME, inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+            )
         return fast_route
+
+    @staticmethod
+    def __inject_params(fast_route: DecoratedCallable, *params: inspect.Parameter):
+        """
+        为路由添加额外的参数（如依赖），FastAPI根据函数签名解析参数，路由调用视图前需要将这些参数取出
+        """
+        signature_ = inspect.signature(fast_route)
+        parameters_ = list(signature_.parameters.values())
+        index_ = next((i for i, param_ in enumerate(parameters_) if param_.kind == inspect.Parameter.VAR_KEYWORD), len(parameters_))
+        parameters_[index_:index_] = params
+        fast_route.__signature__ = signature_.replace(parameters=parameters_)
+
+    @staticmethod
+    async def __resolve_queryset(queryset: QuerySet, schema: Type[PydanticModel], fast_options: Dict, fields: Optional[Tuple[str, ...]], view_kwargs: Dict) -> Any:
+        """
+        执行视图返回的查询集并序列化
+        Args:
+            queryset: 视图返回的查询集
+            schema: response_model对应的序列化类
+            fast_options: Action的扩展参数
+            fields: ?fields= 投影的列
+            view_kwargs: 视图参数
+        """
+        if fast_options.get("stream", None):
+            return QuerySetStreamingResponse(
+                queryset,
+                schema,
+                stream_format=fast_options["stream"],
+                chunk_size=fast_options["stream_chunk_size"],
+                fields=fields,
+                serializer=CompiledSerializer.of(schema) if fast_options.get("compiled", False) else None,
+                headers=BaseViewSet.__sub_response_headers(view_kwargs),
+            )
+        if fields:
+            return PydanticORJSONResponse(await queryset.values(*fields), headers=BaseViewSet.__sub_response_headers(view_kwargs))
+        if fast_options.get("compiled", False):
+            return PydanticORJSONResponse(
+                await CompiledSerializer.of(schema).serialize_queryset(queryset),
+                headers=BaseViewSet.__sub_response_headers(view_kwargs),
+            )
+        if queryset._single:
+            return await RelationPlan.of(schema).from_queryset_single(queryset)
+        return await RelationPlan.of(schema).from_queryset(queryset)
+
+    @staticmethod
+    def __sub_response_headers(view_kwargs: Dict) -> Dict[str, str]:
+        """
+        视图直接返回Response时FastAPI不会合并注入的response参数中的响应头，需要手动合并
+        """
+        return {
+            key: value
+            for value_ in view_kwargs.values()
+            if isinstance(value_, Response)
+            for key, value in value_.headers.items()
+            if key != "content-length"
+        }
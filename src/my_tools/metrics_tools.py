@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/21 9:30
+# @Author  : NotBeBarnon
+# @Description : 请求指标：按路由模板、方法与状态码统计请求数、耗时与报文大小，多个进程通过文件汇总，输出Prometheus文本格式
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import orjson
+from loguru import logger
+
+__all__ = (
+    "LATENCY_BUCKETS",
+    "SIZE_BUCKETS",
+    "Histogram",
+    "RequestMetrics",
+    "request_metrics",
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)  # 单位 秒
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # 单位 字节
+
+MetricKey = Tuple[str, str, str]  # (方法, 路由模板, 状态码)
+
+
+class Histogram(object):
+    """
+    固定分桶的直方图，counts[i]为落在第i个桶（不超过buckets[i]，最后一个为+Inf）的次数，不是累计计数
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float], counts: Optional[List[int]] = None, sum_: float = 0.0):
+        self.buckets = buckets
+        self.counts = list(counts) if counts is not None else [0] * (len(buckets) + 1)
+        self.sum = sum_
+        self.count = sum(self.counts)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts: Sequence[int], sum_: float):
+        for index_, count_ in enumerate(counts):
+            self.counts[index_] += count_
+        self.sum += sum_
+        self.count += sum(counts)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        估算分位数，与Prometheus的histogram_quantile一致：在所在的桶内线性插值，落在+Inf桶时返回最大的上限
+        """
+        if not self.count:
+            return None
+        rank_ = q * self.count
+        cumulative_ = 0
+        for index_, count_ in enumerate(self.counts):
+            if cumulative_ + count_ >= rank_ and count_:
+                if index_ == len(self.buckets):
+                    return self.buckets[-1]
+                lower_ = self.buckets[index_ - 1] if index_ else 0.0
+                return lower_ + (self.buckets[index_] - lower_) * (rank_ - cumulative_) / count_
+            cumulative_ += count_
+        return self.buckets[-1]
+
+    def dump(self) -> List[Any]:
+        return [self.counts, self.sum]
+
+
+class _RouteMetrics(object):
+    """
+    一个(方法, 路由模板, 状态码)的指标
+    """
+
+    __slots__ = ("duration", "request_size", "response_size")
+
+    def __init__(self):
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.request_size = Histogram(SIZE_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_float(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics(object):
+    """
+    请求指标
+    - 只在内存中累加，记录一次请求是几次字典查找与列表自增，没有锁（只在事件循环中调用）
+    - 配置directory时，每个进程定时将自己的快照写入 {directory}/metrics_{pid}.json（先写临时文件再重命名），
+      读取时汇总目录中所有进程的快照，当前进程使用内存中的最新数据
+    - 计数与直方图包括已退出的进程，超过stale_seconds未更新的文件才删除，避免计数回退；
+      正在处理的请求数只统计最近仍在更新的进程
+    """
+
+    def __init__(self, directory: Union[str, Path, None] = None, flush_interval: float = 5, stale_seconds: float = 3600):
+        """
+        Args:
+            directory: 多进程汇总使用的目录，为空时只统计当前进程
+            flush_interval: 写入快照的间隔，单位 秒
+            stale_seconds: 超过此时长未更新的快照文件被删除，单位 秒
+        """
+        self.directory = Path(directory) if directory else None
+        self.flush_interval = flush_interval
+        self.stale_seconds = stale_seconds
+        self.routes: Dict[MetricKey, _RouteMetrics] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.__task: Optional[asyncio.Task] = None
+
+    def configure(self, **config: Any):
+        """
+        使用配置重新创建，需要在start之前调用
+        """
+        self.__init__(**config)
+
+    def begin(self, method: str):
+        self.in_flight[method] = self.in_flight.get(method, 0) + 1
+
+    def end(self, method: str):
+        self.in_flight[method] -= 1
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, request_bytes: int,
+                response_bytes: int):
+        key_ = (method, route, str(status_code))
+        metrics_ = self.routes.get(key_)
+        if metrics_ is None:
+            metrics_ = self.routes[key_] = _RouteMetrics()
+        metrics_.duration.observe(seconds)
+        metrics_.request_size.observe(request_bytes)
+        metrics_.response_size.observe(response_bytes)
+
+    # 多进程汇总
+
+    @property
+    def snapshot_path(self) -> Optional[Path]:
+        return self.directory.joinpath(f"metrics_{os.getpid()}.json") if self.directory else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "written_at": time.time(),
+            "in_flight": dict(self.in_flight),
+            "routes": [
+                [*key_, metrics_.duration.dump(), metrics_.request_size.dump(), metrics_.response_size.dump()]
+                for key_, metrics_ in self.routes.items()
+            ],
+        }
+
+    def flush(self):
+        path_ = self.snapshot_path
+        if path_ is None:
+            return
+        temp_ = path_.with_suffix(".tmp")
+        temp_.write_bytes(orjson.dumps(self.snapshot()))
+        os.replace(temp_, path_)
+
+    def __load_snapshots(self) -> Iterable[Dict[str, Any]]:
+        yield self.snapshot()
+        if self.directory is None:
+            return
+        own_ = self.snapshot_path
+        now_ = time.time()
+        for path_ in self.directory.glob("metrics_*.json"):
+            if path_ == own_:
+                continue
+            try:
+                if now_ - path_.stat().st_mtime > self.stale_seconds:
+                    path_.unlink(missing_ok=True)
+                    continue
+                yield orjson.loads(path_.read_bytes())
+            except (OSError, orjson.JSONDecodeError) as exc:
+                # 其他进程正在替换或删除文件
+                logger.debug(f"Skip metrics snapshot {path_}: {exc!r}")
+
+    def collect(self) -> Tuple[Dict[MetricKey, _RouteMetrics], Dict[str, int]]:
+        """
+        汇总所有进程的指标
+        Returns:
+            (各个路由的指标, 各个方法正在处理的请求数)
+        """
+        routes_: Dict[MetricKey, _RouteMetrics] = {}
+        in_flight_: Dict[str, int] = {}
+        alive_after_ = time.time() - self.flush_interval * 3
+        for snapshot_ in self.__load_snapshots():
+            for method_, route_, status_, duration_, request_size_, response_size_ in snapshot_["routes"]:
+                metrics_ = routes_.get((method_, route_, status_))
+                if metrics_ is None:
+                    metrics_ = routes_[(method_, route_, status_)] = _RouteMetrics()
+                metrics_.duration.merge(*duration_)
+                metrics_.request_size.merge(*request_size_)
+                metrics_.response_size.merge(*response_size_)
+            if snapshot_["written_at"] >= alive_after_:
+                for method_, count_ in snapshot_["in_flight"].items():
+                    in_flight_[method_] = in_flight_.get(method_, 0) + count_
+        return routes_, in_flight_
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as exc:
+                logger.warning(f"Flush metrics snapshot failed: {exc!r}")
+
+    async def start(self):
+        if self.directory is None or self.__task is not None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.flush()
+        self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        task_, self.__task = self.__task, None
+        if task_ is None:
+            return
+        task_.cancel()
+        try:
+            await task_
+        except asyncio.CancelledError:
+            pass
+        # 退出前写入最后的数据，正在处理的请求已结束
+        self.in_flight.clear()
+        self.flush()
+
+    # 输出
+
+    def render(self) -> str:
+        """
+        Prometheus文本格式（text/plain; version=0.0.4）
+        """
+        routes_, in_flight_ = self.collect()
+        lines_: List[str] = [
+            "# HELP http_requests_in_flight Requests currently being processed.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for method_, count_ in sorted(in_flight_.items()):
+            lines_.append(f'http_requests_in_flight{{method="{method_}"}} {count_}')
+
+        items_ = sorted(routes_.items())
+        lines_.extend((
+            "# HELP http_requests_total Requests by method, route template and status code.",
+            "# TYPE http_requests_total counter",
+        ))
+        for (method_, route_, status_), metrics_ in items_:
+            lines_.append(
+                f'http_requests_total{{method="{method_}",route="{_escape(route_)}",status="{status_}"}} '
+                f'{metrics_.duration.count}'
+            )
+        for name_, attr_, help_ in (
+                ("http_request_duration_seconds", "duration", "Request latency until the last body chunk."),
+                ("http_request_size_bytes", "request_size", "Request body size from Content-Length."),
+                ("http_response_size_bytes", "response_size", "Response body size."),
+        ):
+            lines_.extend((f"# HELP {name_} {help_}", f"# TYPE {name_} histogram"))
+            for (method_, route_, status_), metrics_ in items_:
+                histogram_: Histogram = getattr(metrics_, attr_)
+                labels_ = f'method="{method_}",route="{_escape(route_)}",status="{status_}"'
+                cumulative_ = 0
+                for bound_, count_ in zip((*histogram_.buckets, float("inf")), histogram_.counts):
+                    cumulative_ += count_
+                    lines_.append(f'{name_}_bucket{{{labels_},le="{_format_float(bound_)}"}} {cumulative_}')
+                lines_.append(f"{name_}_sum{{{labels_}}} {_format_float(histogram_.sum)}")
+                lines_.append(f"{name_}_count{{{labels_}}} {histogram_.count}")
+        return "\n".join(lines_) + "\n"
+
+    def route_summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        各个路由（合并状态码）的请求数、错误数与耗时分位数，单位 毫秒，用于容量规划与发现性能回退
+        """
+        merged_: Dict[str, Tuple[Histogram, List[int]]] = {}
+        for (method_, route_, status_), metrics_ in self.collect()[0].items():
+            name_ = f"{method_} {route_}"
+            if name_ not in merged_:
+                merged_[name_] = (Histogram(LATENCY_BUCKETS), [0])
+            histogram_, errors_ = merged_[name_]
+            histogram_.merge(metrics_.duration.counts, metrics_.duration.sum)
+            if status_.startswith("5"):
+                errors_[0] += metrics_.duration.count
+        summary_ = {}
+        for name_, (histogram_, errors_) in sorted(merged_.items()):
+            summary_[name_] = {
+                "count": histogram_.count,
+                "errors": errors_[0],
+                "mean": round(histogram_.sum / histogram_.count * 1000, 3),
+                **{
+                    label_: round(histogram_.quantile(q_) * 1000, 3)
+                    for label_, q_ in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+                },
+            }
+        return summary_
+
+
+request_metrics = RequestMetrics()
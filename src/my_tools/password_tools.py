@@ -1,12 +1,34 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2021/11/25 14:37
 # @Author  : NotBeBarnon
-# @Description :
+# @Description : 密码哈希，计算较慢，在异步代码中通过executor_tools.run_cpu调用
+import base64
 import hashlib
+import hmac
+import secrets
 
+PBKDF2_ALGORITHM = "pbkdf2_sha256"
+PBKDF2_ITERATIONS = 260000
 
-def make_password(password: str):
-    return hashlib.md5(password.encode(encoding="ascii")).hexdigest()
+
+def make_password(password: str, iterations: int = PBKDF2_ITERATIONS) -> str:
+    """
+    生成 pbkdf2_sha256$迭代次数$盐$哈希 格式的密码
+    """
+    salt_ = secrets.token_hex(8)
+    hash_ = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt_.encode("ascii"), iterations)
+    return f"{PBKDF2_ALGORITHM}${iterations}${salt_}${base64.b64encode(hash_).decode('ascii')}"
+
+
+def check_password(password: str, encoded: str) -> bool:
+    """
+    校验密码，兼容旧的md5密码
+    """
+    if not encoded.startswith(f"{PBKDF2_ALGORITHM}$"):
+        return hmac.compare_digest(hashlib.md5(password.encode("utf-8")).hexdigest(), encoded)
+    _, iterations_, salt_, hash_ = encoded.split("$", 3)
+    expected_ = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt_.encode("ascii"), int(iterations_))
+    return hmac.compare_digest(base64.b64encode(expected_).decode("ascii"), hash_)
 
 
 if __name__ == '__main__':
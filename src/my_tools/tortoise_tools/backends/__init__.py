@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/14 10:30
+# @Author  : NotBeBarnon
+# @Description : 自定义的Tortoise数据库客户端，在DATABASE_CONFIG的engine中使用
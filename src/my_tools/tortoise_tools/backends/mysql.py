@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/15 10:30
+# @Author  : NotBeBarnon
+# @Description : MySQL主库客户端，engine: "src.my_tools.tortoise_tools.backends.mysql"
+from tortoise.backends.base.client import TransactionContextPooled
+from tortoise.backends.mysql.client import MySQLClient, TransactionWrapper
+
+from ..pools import PooledClientMixin
+from ..query_stats import QueryStatsMixin
+
+
+class QueryStatsTransactionWrapper(QueryStatsMixin, TransactionWrapper):
+    pass
+
+
+class PooledMySQLClient(QueryStatsMixin, PooledClientMixin, MySQLClient):
+    def _in_transaction(self) -> "TransactionContext":
+        # 事务中的SQL同样计入请求的统计
+        return TransactionContextPooled(QueryStatsTransactionWrapper(self))
+
+
+client_class = PooledMySQLClient
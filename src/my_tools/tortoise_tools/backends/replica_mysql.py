@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/14 10:30
+# @Author  : NotBeBarnon
+# @Description : MySQL从库客户端，engine: "src.my_tools.tortoise_tools.backends.replica_mysql"
+from tortoise.backends.mysql.client import MySQLClient
+
+from ..pools import PooledClientMixin
+from ..query_stats import QueryStatsMixin
+from ..routers import ReplicaClientMixin
+
+
+class ReplicaMySQLClient(ReplicaClientMixin, QueryStatsMixin, PooledClientMixin, MySQLClient):
+    pass
+
+
+client_class = ReplicaMySQLClient
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/5 10:20
+# @Author  : NotBeBarnon
+# @Description : 闭包表，维护树中所有 祖先-后代 关系，层级查询只需一条SQL
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from tortoise import BaseDBAsyncClient
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
+__all__ = (
+    "ClosureTable",
+)
+
+
+class ClosureTable(object):
+    """
+    闭包表模型需要包含 ancestor(外键)、descendant(外键)、depth(整数) 三列，每个节点有一行depth为0的自身记录
+    - 查询子树、祖先、深度、是否为下级均为一条带索引的查询
+    - 写入节点或修改父节点时需要调用insert/move保持同步，与修改树的写操作在同一事务中执行
+    - 删除节点由外键的级联删除处理，其下级的路径不会自动调整，需要先move下级
+    """
+
+    def __init__(self, closure_model: Type[Model], ancestor: str = "ancestor_id", descendant: str = "descendant_id",
+                 depth: str = "depth"):
+        self.model = closure_model
+        self.ancestor = ancestor
+        self.descendant = descendant
+        self.depth = depth
+
+    def __write_db(self, using_db: Optional[BaseDBAsyncClient]) -> BaseDBAsyncClient:
+        return using_db or self.model._choose_db(True)
+
+    async def __ancestor_rows(self, pk: Any, using_db: BaseDBAsyncClient) -> List[Tuple[Any, int]]:
+        return await self.model.filter(**{self.descendant: pk}).using_db(using_db).values_list(self.ancestor, self.depth)
+
+    def __rows_of(self, links: Iterable[Tuple[Any, Any, int]]) -> List[Model]:
+        return [
+            self.model(**{self.ancestor: ancestor_, self.descendant: descendant_, self.depth: depth_})
+            for ancestor_, descendant_, depth_ in links
+        ]
+
+    async def insert(self, pk: Any, parent_pk: Optional[Any] = None, using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        新节点写入后调用，复制父节点的所有祖先路径
+        """
+        using_db_ = self.__write_db(using_db)
+        links_ = [(pk, pk, 0)]
+        if parent_pk is not None:
+            links_.extend((ancestor_, pk, depth_ + 1) for ancestor_, depth_ in await self.__ancestor_rows(parent_pk, using_db_))
+        await self.model.bulk_create(self.__rows_of(links_), using_db=using_db_)
+
+    async def move(self, pk: Any, parent_pk: Optional[Any], using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        将pk及其子树移动到parent_pk下，parent_pk为None时成为根节点
+        Raises:
+            ValueError: parent_pk是pk自身或其下级
+        """
+        if using_db is None:
+            async with in_transaction(self.model._choose_db(True).connection_name) as connection_:
+                return await self.move(pk, parent_pk, connection_)
+
+        subtree_: Dict[Any, int] = dict(
+            await self.model.filter(**{self.ancestor: pk}).using_db(using_db).values_list(self.descendant, self.depth)
+        )
+        if parent_pk is not None and parent_pk in subtree_:
+            raise ValueError(f"Node {parent_pk} is in the subtree of {pk}")
+        # 子树以外的祖先到子树的路径全部失效
+        await self.model.filter(**{
+            f"{self.descendant}__in": list(subtree_.keys()),
+            f"{self.ancestor}__not_in": list(subtree_.keys()),
+        }).using_db(using_db).delete()
+        if parent_pk is None:
+            return
+        ancestors_ = await self.__ancestor_rows(parent_pk, using_db)
+        await self.model.bulk_create(self.__rows_of(
+            (ancestor_, descendant_, ancestor_depth_ + depth_ + 1)
+            for ancestor_, ancestor_depth_ in ancestors_
+            for descendant_, depth_ in subtree_.items()
+        ), using_db=using_db)
+
+    async def rebuild(self, nodes: Iterable[Tuple[Any, Optional[Any]]], using_db: Optional[BaseDBAsyncClient] = None,
+                      batch_size: int = 1000):
+        """
+        根据 (主键, 父主键) 重建整张闭包表，用于初始化已有数据
+        """
+        parents_ = dict(nodes)
+        if using_db is None:
+            async with in_transaction(self.model._choose_db(True).connection_name) as connection_:
+                return await self.rebuild(parents_.items(), connection_, batch_size)
+
+        links_: List[Tuple[Any, Any, int]] = []
+        for pk_ in parents_:
+            ancestor_, depth_, visited_ = pk_, 0, set()
+            while ancestor_ is not None and ancestor_ in parents_ and ancestor_ not in visited_:
+                visited_.add(ancestor_)
+                links_.append((ancestor_, pk_, depth_))
+                ancestor_, depth_ = parents_[ancestor_], depth_ + 1
+        await self.model.all().using_db(using_db).delete()
+        await self.model.bulk_create(self.__rows_of(links_), batch_size=batch_size, using_db=using_db)
+
+    async def descendants(self, pk: Any, max_depth: Optional[int] = None) -> List[Any]:
+        """
+        pk所有下级的主键（不包括自身），按层级排序
+        """
+        filter_ = {self.ancestor: pk, f"{self.depth}__gt": 0}
+        if max_depth is not None:
+            filter_[f"{self.depth}__lte"] = max_depth
+        return await self.model.filter(**filter_).order_by(self.depth).values_list(self.descendant, flat=True)
+
+    async def ancestors(self, pk: Any) -> List[Any]:
+        """
+        pk所有上级的主键（不包括自身），从最高级开始
+        """
+        return await self.model.filter(**{self.descendant: pk, f"{self.depth}__gt": 0}).order_by(
+            f"-{self.depth}").values_list(self.ancestor, flat=True)
+
+    async def depth_of(self, pk: Any) -> Optional[int]:
+        """
+        pk到根节点的层数，根节点为0，节点不存在时返回None
+        """
+        count_ = await self.model.filter(**{self.descendant: pk}).count()
+        return count_ - 1 if count_ else None
+
+    async def is_descendant(self, pk: Any, ancestor_pk: Any, include_self: bool = False) -> bool:
+        """
+        pk是否是ancestor_pk的下级，修改父节点前用于检测环
+        """
+        filter_ = {self.ancestor: ancestor_pk, self.descendant: pk}
+        if not include_self:
+            filter_[f"{self.depth}__gt"] = 0
+        return await self.model.exists(**filter_)
+
+    async def is_descendant_of_any(self, pk: Any, ancestor_pks: Iterable[Any], include_self: bool = False) -> bool:
+        """
+        pk是否是ancestor_pks中任意一个的下级，批量修改父节点前用于检测环
+        """
+        filter_ = {f"{self.ancestor}__in": list(ancestor_pks), self.descendant: pk}
+        if not include_self:
+            filter_[f"{self.depth}__gt"] = 0
+        return await self.model.exists(**filter_)
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/15 9:30
+# @Author  : NotBeBarnon
+# @Description : 数据库连接池的指标、预热与自适应大小
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from aiomysql import Pool
+from loguru import logger
+from pymysql.err import DataError, IntegrityError, NotSupportedError, ProgrammingError
+from tortoise import connections
+from tortoise.backends.base.client import PoolConnectionWrapper
+from tortoise.exceptions import DBConnectionError
+
+__all__ = (
+    "PoolTimeoutError",
+    "PoolStats",
+    "PooledClientMixin",
+    "PoolManager",
+    "database_pools",
+    "ConnectionPins",
+    "pin_connections",
+)
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # 获取连接等待时间直方图的上界，单位 秒
+_STATEMENT_ERRORS = (DataError, IntegrityError, NotSupportedError, ProgrammingError)  # 语句本身的错误，连接仍然可用
+
+
+class PoolTimeoutError(DBConnectionError):
+    """
+    在acquire_timeout内没有从连接池获取到连接
+    """
+
+
+class PoolStats(object):
+    """
+    连接池的获取连接指标
+    - 直方图为累计计数，wait_buckets[i]为等待时间不超过WAIT_BUCKETS[i]的次数，最后一项为全部次数
+    - window_开头的指标在每个自适应周期结束时清零
+    """
+
+    def __init__(self):
+        self.acquires = 0
+        self.timeouts = 0
+        self.waiting = 0  # 正在等待连接的协程数
+        self.wait_seconds = 0.0
+        self.wait_buckets: List[int] = [0] * (len(WAIT_BUCKETS) + 1)
+        self.window_acquires = 0
+        self.window_wait_seconds = 0.0
+        self.window_peak_in_use = 0
+        self.pinned_reuses = 0  # 复用请求中固定的连接而没有从连接池获取的次数
+
+    def record(self, wait: float, in_use: int):
+        self.acquires += 1
+        self.wait_seconds += wait
+        for index_, bound_ in enumerate(WAIT_BUCKETS):
+            if wait <= bound_:
+                self.wait_buckets[index_] += 1
+        self.wait_buckets[-1] += 1
+        self.window_acquires += 1
+        self.window_wait_seconds += wait
+        self.window_peak_in_use = max(self.window_peak_in_use, in_use)
+
+    @property
+    def window_mean_wait(self) -> float:
+        return self.window_wait_seconds / self.window_acquires if self.window_acquires else 0.0
+
+    def reset_window(self, in_use: int):
+        self.window_acquires = 0
+        self.window_wait_seconds = 0.0
+        self.window_peak_in_use = in_use
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "waiting": self.waiting,
+            "wait_seconds": round(self.wait_seconds, 6),
+            "pinned_reuses": self.pinned_reuses,
+            "wait_histogram": {
+                **{str(bound_): count_ for bound_, count_ in zip(WAIT_BUCKETS, self.wait_buckets)},
+                "+Inf": self.wait_buckets[-1],
+            },
+        }
+
+
+class _PinnedConnection(object):
+    """
+    一次请求中一个数据库连接名称固定使用的连接，lock保证同一时间只有一个查询使用
+    """
+
+    def __init__(self, client: "PooledClientMixin"):
+        self.client = client
+        self.connection: Any = None
+        self.lock = asyncio.Lock()
+        self.closing = False  # 请求已结束但连接仍在使用，使用结束后归还
+
+    def release(self):
+        connection_, self.connection = self.connection, None
+        if connection_ is not None and self.client._pool is not None:
+            self.client._pool.release(connection_)
+
+    def discard(self):
+        """
+        连接状态未知时关闭后归还，如查询被取消时结果未读取完
+        """
+        if self.connection is not None:
+            self.connection.close()
+        self.release()
+
+
+class ConnectionPins(object):
+    """
+    一次请求中各个数据库连接名称固定使用的连接，第一次查询时从连接池获取，请求结束时归还
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.__pins: Dict[str, _PinnedConnection] = {}
+
+    def pin_of(self, client: "PooledClientMixin") -> _PinnedConnection:
+        pin_ = self.__pins.get(client.connection_name)
+        if pin_ is None:
+            pin_ = self.__pins[client.connection_name] = _PinnedConnection(client)
+        return pin_
+
+    def release(self):
+        self.closed = True
+        for pin_ in self.__pins.values():
+            if pin_.lock.locked():
+                pin_.closing = True
+            else:
+                pin_.release()
+        self.__pins.clear()
+
+
+_pins: ContextVar[Optional[ConnectionPins]] = ContextVar("connection_pins", default=None)
+
+
+@asynccontextmanager
+async def pin_connections() -> AsyncIterator[ConnectionPins]:
+    """
+    在此范围内，每个数据库连接名称的查询都复用同一个连接，减少连接池的获取与归还
+    - 并发的查询（如validate_all）在固定的连接使用中时从连接池获取其他连接，不会互相等待
+    - 事务仍然从连接池获取单独的连接
+    - 固定的连接在范围结束前不会归还，适用于查询多且没有其他耗时操作的请求
+    - 只对PooledClientMixin的客户端生效
+    """
+    pins_ = ConnectionPins()
+    token_ = _pins.set(pins_)
+    try:
+        yield pins_
+    finally:
+        _pins.reset(token_)
+        pins_.release()
+
+
+class _PinnedConnectionWrapper(object):
+    """
+    替代PoolConnectionWrapper，使用请求中固定的连接
+    """
+
+    def __init__(self, client: "PooledClientMixin", pins: ConnectionPins):
+        self.client = client
+        self.pins = pins
+        self.pin: Optional[_PinnedConnection] = None
+        self.fallback: Optional[PoolConnectionWrapper] = None
+
+    async def __aenter__(self):
+        pin_ = self.pins.pin_of(self.client)
+        if pin_.lock.locked():
+            self.fallback = PoolConnectionWrapper(self.client)
+            return await self.fallback.__aenter__()
+        await pin_.lock.acquire()
+        self.pin = pin_
+        try:
+            if pin_.connection is None:
+                if self.client._pool is None:
+                    await self.client.create_connection(with_db=True)
+                pin_.connection = await self.client._pool.acquire()
+            else:
+                self.client.pool_stats.pinned_reuses += 1
+        except BaseException:
+            pin_.lock.release()
+            raise
+        return pin_.connection
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        if self.fallback is not None:
+            return await self.fallback.__aexit__(exc_type, exc_val, exc_tb)
+        pin_ = self.pin
+        try:
+            if exc_type is not None and not issubclass(exc_type, _STATEMENT_ERRORS):
+                pin_.discard()
+            elif pin_.closing:
+                pin_.release()
+        finally:
+            pin_.lock.release()
+
+
+class PooledClientMixin(object):
+    """
+    使用aiomysql连接池的客户端，与具体数据库的客户端组合使用，见backends.mysql
+    - 记录获取连接的等待时间、超时次数与使用中的连接数
+    - 获取连接超过acquire_timeout秒时抛出PoolTimeoutError，而不是无限排队
+    - adaptive为True时，周期内获取连接的平均等待超过grow_wait秒则扩大maxsize（不超过adaptive_maxsize），
+      空闲时逐步缩小到配置的maxsize
+    - 在pin_connections的范围内，查询复用请求中固定的连接
+    以下参数与连接参数一起配置在DATABASE_CONFIG的credentials中
+    """
+
+    connection_name: str
+    pool_minsize: int
+    pool_maxsize: int
+    _pool: Optional[Pool]
+
+    def __init__(self, *, acquire_timeout: float = 10, adaptive: bool = False, adaptive_maxsize: Optional[int] = None,
+                 adaptive_interval: float = 5, grow_wait: float = 0.05, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.acquire_timeout = float(acquire_timeout)
+        self.adaptive = bool(adaptive)
+        self.adaptive_maxsize = max(int(adaptive_maxsize or self.pool_maxsize * 4), self.pool_maxsize)
+        self.adaptive_interval = float(adaptive_interval)
+        self.grow_wait = float(grow_wait)
+        self.pool_stats = PoolStats()
+        self.__adaptive_task: Optional[asyncio.Task] = None
+
+    async def create_connection(self, with_db: bool) -> None:
+        await super().create_connection(with_db)
+        if isinstance(self._pool, Pool):
+            self.__instrument(self._pool)
+
+    def acquire_connection(self) -> Any:
+        pins_ = _pins.get()
+        if pins_ is None or pins_.closed:
+            return super().acquire_connection()
+        return _PinnedConnectionWrapper(self, pins_)
+
+    def __instrument(self, pool: Pool):
+        # Pool.acquire与事务的获取连接都通过pool._acquire，替换实例上的_acquire即可统计全部获取
+        acquire_ = pool._acquire
+        stats_ = self.pool_stats
+
+        async def timed_acquire_():
+            stats_.waiting += 1
+            start_ = time.perf_counter()
+            try:
+                if self.acquire_timeout > 0:
+                    connection_ = await asyncio.wait_for(acquire_(), self.acquire_timeout)
+                else:
+                    connection_ = await acquire_()
+            except asyncio.TimeoutError:
+                stats_.timeouts += 1
+                raise PoolTimeoutError(
+                    f"Acquire connection from {self.connection_name} timeout after {self.acquire_timeout}s"
+                )
+            finally:
+                stats_.waiting -= 1
+            stats_.record(time.perf_counter() - start_, len(pool._used))
+            return connection_
+
+        pool._acquire = timed_acquire_
+
+    async def prewarm(self):
+        """
+        创建连接池并建立minsize个连接，逐个ping确认可用，避免第一批请求承担建立连接的耗时
+        """
+        if self._pool is None:
+            await self.create_connection(with_db=True)
+        pool_ = self._pool
+        connections_ = [await pool_.acquire() for _ in range(pool_.minsize)]
+        try:
+            await asyncio.gather(*(connection_.ping(reconnect=True) for connection_ in connections_))
+        finally:
+            for connection_ in connections_:
+                pool_.release(connection_)
+
+    async def resize(self, maxsize: int):
+        """
+        修改连接池的maxsize
+        - 缩小时先关闭多余的空闲连接，连接数不超过新的上限后才修改，
+          否则归还连接时超出上限的连接会被丢弃而不关闭
+        """
+        pool_ = self._pool
+        if pool_ is None or maxsize == pool_.maxsize:
+            return
+        if maxsize < pool_.maxsize:
+            while pool_.freesize and pool_.size > maxsize:
+                pool_._free.popleft().close()
+            if pool_.size > maxsize:
+                return
+        logger.info(f"Resize pool {self.connection_name}: {pool_.maxsize} -> {maxsize}")
+        pool_._free = deque(pool_._free, maxlen=maxsize)
+        if maxsize > pool_.size:
+            # 唤醒等待的协程创建新连接
+            async with pool_._cond:
+                pool_._cond.notify_all()
+
+    async def adapt(self):
+        """
+        根据一个周期内获取连接的等待时间调整maxsize
+        """
+        pool_ = self._pool
+        if pool_ is None:
+            return
+        stats_ = self.pool_stats
+        maxsize_ = pool_.maxsize
+        if stats_.window_acquires and stats_.window_mean_wait > self.grow_wait and maxsize_ < self.adaptive_maxsize:
+            await self.resize(min(maxsize_ + max(maxsize_ // 2, 1), self.adaptive_maxsize))
+        elif (maxsize_ > self.pool_maxsize and stats_.window_mean_wait < self.grow_wait / 10
+              and stats_.window_peak_in_use < maxsize_ - 1):
+            await self.resize(maxsize_ - 1)
+        stats_.reset_window(len(pool_._used))
+
+    async def __run_adaptive(self):
+        while True:
+            await asyncio.sleep(self.adaptive_interval)
+            try:
+                await self.adapt()
+            except Exception as exc:
+                logger.warning(f"Adapt pool {self.connection_name} failed: {exc!r}")
+
+    def start_adaptive(self):
+        if self.adaptive and self.__adaptive_task is None:
+            self.__adaptive_task = asyncio.create_task(self.__run_adaptive())
+
+    async def stop_adaptive(self):
+        task_, self.__adaptive_task = self.__adaptive_task, None
+        if task_ is not None:
+            task_.cancel()
+            try:
+                await task_
+            except asyncio.CancelledError:
+                pass
+
+    def pool_metrics(self) -> Dict[str, Any]:
+        pool_ = self._pool
+        size_ = pool_.size if pool_ is not None else 0
+        idle_ = pool_.freesize if pool_ is not None else 0
+        return {
+            "minsize": self.pool_minsize,
+            "maxsize": pool_.maxsize if pool_ is not None else self.pool_maxsize,
+            "size": size_,
+            "in_use": size_ - idle_,
+            "idle": idle_,
+            **self.pool_stats.metrics(),
+        }
+
+
+class PoolManager(object):
+    """
+    在应用启动与关闭时统一处理所有PooledClientMixin的连接
+    """
+
+    @staticmethod
+    def clients() -> List[PooledClientMixin]:
+        return [client_ for client_ in connections.all() if isinstance(client_, PooledClientMixin)]
+
+    async def start(self):
+        """
+        在Tortoise.init之后调用
+        """
+        clients_ = self.clients()
+        await asyncio.gather(*(client_.prewarm() for client_ in clients_))
+        for client_ in clients_:
+            client_.start_adaptive()
+
+    async def stop(self):
+        """
+        在关闭连接之前调用
+        """
+        await asyncio.gather(*(client_.stop_adaptive() for client_ in self.clients()))
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {client_.connection_name: client_.pool_metrics() for client_ in self.clients()}
+
+
+database_pools = PoolManager()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/19 9:30
+# @Author  : NotBeBarnon
+# @Description : 统计一次请求中执行的SQL，发现慢查询与N+1查询
+import heapq
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+__all__ = (
+    "QueryStats",
+    "QueryStatsMixin",
+    "collect_query_stats",
+)
+
+_STRING_REGEX = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER_REGEX = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_REGEX = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE_REGEX = re.compile(r"\s+")
+MAX_SQL_LENGTH = 300  # 记录的SQL的最大长度
+
+
+def query_shape(sql: str) -> str:
+    """
+    将SQL中的字面量替换为?，只是参数不同的查询得到相同的结果，IN列表的长度也被忽略
+    """
+    shape_ = _STRING_REGEX.sub("?", sql)
+    shape_ = _NUMBER_REGEX.sub("?", shape_)
+    shape_ = _IN_LIST_REGEX.sub("(?)", shape_)
+    return _SPACE_REGEX.sub(" ", shape_).strip()[:MAX_SQL_LENGTH]
+
+
+class QueryStats(object):
+    """
+    一次请求中执行的SQL的统计
+    - slowest: 耗时最长的几条SQL
+    - repeated: 形状相同的SQL执行次数达到n_plus_one_threshold，通常是在循环中逐个查询关联数据（N+1）
+    """
+
+    def __init__(self, slowest: int = 3, n_plus_one_threshold: int = 5):
+        self.slowest_limit = slowest
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.__slowest: List[Tuple[float, int, str]] = []  # 小顶堆 (耗时, 序号, SQL)
+        self.__shapes: Counter = Counter()
+
+    def record(self, sql: str, seconds: float, ok: bool = True):
+        self.count += 1
+        self.seconds += seconds
+        if not ok:
+            self.errors += 1
+        item_ = (seconds, self.count, sql)
+        if len(self.__slowest) < self.slowest_limit:
+            heapq.heappush(self.__slowest, item_)
+        elif self.__slowest and seconds > self.__slowest[0][0]:
+            heapq.heapreplace(self.__slowest, item_)
+        self.__shapes[query_shape(sql)] += 1
+
+    @property
+    def slowest(self) -> List[Dict[str, Any]]:
+        return [
+            {"ms": round(seconds_ * 1000, 3), "sql": sql_[:MAX_SQL_LENGTH]}
+            for seconds_, _, sql_ in sorted(self.__slowest, reverse=True)
+        ]
+
+    @property
+    def repeated(self) -> List[Dict[str, Any]]:
+        return [
+            {"count": count_, "shape": shape_}
+            for shape_, count_ in self.__shapes.most_common()
+            if count_ >= self.n_plus_one_threshold
+        ]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "ms": round(self.seconds * 1000, 3),
+            "errors": self.errors,
+            "slowest": self.slowest,
+            "repeated": self.repeated,
+        }
+
+
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def collect_query_stats(slowest: int = 3, n_plus_one_threshold: int = 5) -> Iterator[QueryStats]:
+    """
+    在此范围内（包括复制了上下文的子任务）QueryStatsMixin的客户端执行的SQL都计入返回的QueryStats
+    """
+    stats_ = QueryStats(slowest, n_plus_one_threshold)
+    token_ = _query_stats.set(stats_)
+    try:
+        yield stats_
+    finally:
+        _query_stats.reset(token_)
+
+
+class QueryStatsMixin(object):
+    """
+    记录SQL的耗时，与具体数据库的客户端组合使用，见backends.mysql
+    - 不在collect_query_stats范围内时不做任何统计
+    """
+
+    async def __timed(self, method: str, query: str, *args: Any) -> Any:
+        stats_ = _query_stats.get()
+        if stats_ is None:
+            return await getattr(super(), method)(query, *args)
+        start_ = time.perf_counter()
+        ok_ = False
+        try:
+            result_ = await getattr(super(), method)(query, *args)
+            ok_ = True
+            return result_
+        finally:
+            stats_.record(query, time.perf_counter() - start_, ok_)
+
+    async def execute_insert(self, query: str, values: list) -> Any:
+        return await self.__timed("execute_insert", query, values)
+
+    async def execute_many(self, query: str, values: list) -> None:
+        return await self.__timed("execute_many", query, values)
+
+    async def execute_query(self, query: str, values: Optional[list] = None) -> Tuple[int, List[dict]]:
+        return await self.__timed("execute_query", query, values)
+
+    async def execute_query_dict(self, query: str, values: Optional[list] = None) -> List[dict]:
+        return await self.__timed("execute_query_dict", query, values)
+
+    async def execute_script(self, query: str) -> None:
+        return await self.__timed("execute_script", query)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/14 9:40
+# @Author  : NotBeBarnon
+# @Description : 多个从库的负载均衡与被动健康检查
+import random
+import time
+from typing import Any, Collection, Dict, List, Optional
+
+__all__ = (
+    "ReplicaState",
+    "ReplicaPool",
+)
+
+
+class ReplicaState(object):
+    """
+    一个从库的负载与健康状态
+    """
+
+    def __init__(self, name: str, weight: float = 1):
+        self.name = name
+        self.weight = weight
+        self.outstanding = 0  # 正在执行的查询数
+        self.failures = 0  # 连续失败次数，成功一次后清零
+        self.ejected_until = 0.0  # 在此时间之前不参与选择
+        # 指标
+        self.queries = 0
+        self.errors = 0
+        self.ejections = 0
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "ejected": self.ejected,
+            "queries": self.queries,
+            "errors": self.errors,
+            "ejections": self.ejections,
+        }
+
+
+class ReplicaPool(object):
+    """
+    按权重选择正在执行的查询较少的从库（weighted least outstanding requests）
+    - 以 weight / (outstanding + 1) 为概率随机选择，空闲时按权重分配，正在执行的查询越多被选中的概率越低
+    - 不直接选择最小值，否则负载低时所有读取都落在权重最大的从库上
+    - 连续max_failures次连接失败的从库被移出eject_seconds秒，到期后重新参与选择，
+      此时仍未成功过，再失败一次就会再次被移出
+    """
+
+    def __init__(self, weights: Dict[str, float], max_failures: int = 3, eject_seconds: float = 10):
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.replicas: Dict[str, ReplicaState] = {
+            name_: ReplicaState(name_, weight_) for name_, weight_ in weights.items() if weight_ > 0
+        }
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.replicas
+
+    def choose(self, exclude: Collection[str] = ()) -> Optional[str]:
+        """
+        选择一个从库，没有可用的从库时返回None
+        Args:
+            exclude: 不参与选择的从库，如延迟过大或本次查询已经失败的从库
+        """
+        candidates_: List[ReplicaState] = [
+            replica_ for name_, replica_ in self.replicas.items() if name_ not in exclude and not replica_.ejected
+        ]
+        if not candidates_:
+            return None
+        if len(candidates_) == 1:
+            return candidates_[0].name
+        return random.choices(
+            candidates_, weights=[replica_.weight / (replica_.outstanding + 1) for replica_ in candidates_]
+        )[0].name
+
+    def acquire(self, name: str):
+        replica_ = self.replicas.get(name)
+        if replica_ is not None:
+            replica_.outstanding += 1
+            replica_.queries += 1
+
+    def release(self, name: str, ok: bool = True):
+        """
+        查询结束，ok为False表示连接失败
+        """
+        replica_ = self.replicas.get(name)
+        if replica_ is None:
+            return
+        replica_.outstanding -= 1
+        if ok:
+            replica_.failures = 0
+            return
+        replica_.errors += 1
+        replica_.failures += 1
+        if replica_.failures >= self.max_failures and not replica_.ejected:
+            replica_.ejected_until = time.monotonic() + self.eject_seconds
+            replica_.ejections += 1
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {name_: replica_.metrics() for name_, replica_ in self.replicas.items()}
@@ -1,15 +1,290 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2022/6/14 10:06
 # @Author  : NotBeBarnon
-# @Description :
-from typing import Type
+# @Description : 读写分离路由，在多个从库间负载均衡，从库不可用或刚写入过数据时读主库
+import asyncio
+import math
+import time
+from contextvars import ContextVar
+from typing import Any, Collection, Dict, Iterable, List, Optional, Tuple, Type
 
-from tortoise import Model
+from loguru import logger
+from tortoise import Model, connections
+from tortoise.exceptions import DBConnectionError
+
+from .replicas import ReplicaPool
+
+__all__ = (
+    "ReadConsistency",
+    "ReplicaLagMonitor",
+    "ReadRouting",
+    "read_routing",
+    "WriteOrReadRouter",
+    "ReplicaClientMixin",
+)
+
+
+class ReadConsistency(object):
+    """
+    一次请求的读一致性状态，由中间件创建并放入contextvar
+    - pinned: 请求开始时已确定读主库，如写请求或刚写入过数据的会话
+    - written: 请求中执行过写操作，之后的读取都读主库
+    """
+
+    def __init__(self, pinned: bool = False):
+        self.pinned = pinned
+        self.written = False
+
+    @property
+    def read_master(self) -> bool:
+        return self.pinned or self.written
+
+
+# 中间件在调用视图前设置，视图在复制了上下文的任务中执行，因此只修改对象的属性而不重新设置contextvar
+_consistency: ContextVar[Optional[ReadConsistency]] = ContextVar("read_consistency", default=None)
+
+
+class ReplicaLagMonitor(object):
+    """
+    定时查询各个从库的复制延迟，延迟超过阈值或查询失败的从库不参与读取
+    - MySQL从库通过 SHOW SLAVE STATUS 的 Seconds_Behind_Master 获取延迟，复制线程停止时为NULL
+    - 不是从库（结果为空）或不是MySQL时延迟为0
+    """
+
+    def __init__(self, replicas: Iterable[str] = ("slave",), max_lag: float = 1.0, interval: float = 1.0):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lags: Dict[str, float] = {name_: 0.0 for name_ in replicas}  # 未启动时不限制读从库，与原有行为一致
+        self.checked_at: Optional[float] = None
+        self.__task: Optional[asyncio.Task] = None
+
+    def healthy(self, replica: str) -> bool:
+        return self.lags.get(replica, 0.0) <= self.max_lag
+
+    @property
+    def lagging(self) -> List[str]:
+        return [name_ for name_, lag_ in self.lags.items() if lag_ > self.max_lag]
+
+    async def probe(self, replica: str) -> float:
+        connection_ = connections.get(replica)
+        if connection_.capabilities.dialect != "mysql":
+            return 0.0
+        _, rows_ = await connection_.execute_query("SHOW SLAVE STATUS")
+        if not rows_:
+            return 0.0
+        row_ = dict(rows_[0])
+        lag_ = row_.get("Seconds_Behind_Master", row_.get("Seconds_Behind_Source"))
+        return math.inf if lag_ is None else float(lag_)
+
+    async def check(self, replica: str) -> float:
+        try:
+            lag_ = await self.probe(replica)
+        except Exception as exc:
+            logger.warning(f"Replica {replica} lag probe failed: {exc!r}")
+            lag_ = math.inf
+        if self.healthy(replica) != (lag_ <= self.max_lag):
+            logger.warning(f"Replica {replica} lag changed: {self.lags.get(replica)} -> {lag_}")
+        self.lags[replica] = lag_
+        return lag_
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(name_) for name_ in self.lags))
+        self.checked_at = time.time()
+
+    async def __run(self):
+        while True:
+            await self.check_all()
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.__task is None:
+            # 先完成一次检查，启动后的第一个请求就能使用检查结果
+            await self.check_all()
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        task_, self.__task = self.__task, None
+        if task_ is not None:
+            task_.cancel()
+            try:
+                await task_
+            except asyncio.CancelledError:
+                pass
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "lags": dict(self.lags),
+            "max_lag": self.max_lag,
+            "checked_at": self.checked_at,
+        }
+
+
+class ReadRouting(object):
+    """
+    选择读取使用的连接
+    - 请求中写入过数据（read-your-writes）或请求开始时被固定到主库时读主库
+    - 在延迟未超过阈值且未被移出的从库中，按权重选择正在执行的查询最少的从库
+    - 没有可用的从库时读主库
+    - 不在请求中（如后台任务）时只根据从库状态选择
+    """
+
+    def __init__(self, master: str = "master", replicas: Optional[Dict[str, float]] = None, sticky_seconds: float = 2.0,
+                 max_replica_lag: float = 1.0, lag_check_interval: float = 1.0, max_failures: int = 3,
+                 eject_seconds: float = 10):
+        """
+        Args:
+            replicas: 从库连接名称: 权重，默认只有权重为1的slave
+            sticky_seconds: 写入后同一会话的读取固定到主库的时长，应大于从库的正常延迟
+            max_failures: 从库连续连接失败的次数达到此值后被移出
+            eject_seconds: 从库被移出的时长
+        """
+        replicas = replicas if replicas is not None else {"slave": 1}
+        self.master = master
+        self.sticky_seconds = sticky_seconds
+        self.pool = ReplicaPool(replicas, max_failures, eject_seconds)
+        self.monitor = ReplicaLagMonitor(self.pool.replicas.keys(), max_replica_lag, lag_check_interval)
+        # 指标
+        self.replica_reads = 0
+        self.master_reads = 0
+        self.master_fallbacks = 0  # 没有可用的从库而读主库的次数
+        self.retries = 0  # 从库连接失败后在其他连接上重试的次数
+
+    def configure(self, **config: Any):
+        """
+        使用配置重新创建，需要在start之前调用
+        """
+        self.__init__(**config)
+
+    @staticmethod
+    def begin(pinned: bool = False) -> ReadConsistency:
+        consistency_ = ReadConsistency(pinned)
+        _consistency.set(consistency_)
+        return consistency_
+
+    @staticmethod
+    def current() -> Optional[ReadConsistency]:
+        return _consistency.get()
+
+    def db_for_read(self) -> str:
+        consistency_ = _consistency.get()
+        if consistency_ is not None and consistency_.read_master:
+            self.master_reads += 1
+            return self.master
+        replica_ = self.pool.choose(exclude=self.monitor.lagging)
+        if replica_ is None:
+            self.master_fallbacks += 1
+            self.master_reads += 1
+            return self.master
+        self.replica_reads += 1
+        return replica_
+
+    def db_for_write(self) -> str:
+        consistency_ = _consistency.get()
+        if consistency_ is not None:
+            consistency_.written = True
+        return self.master
+
+    def db_for_retry(self, tried: Collection[str]) -> Optional[str]:
+        """
+        读取失败后选择另一个连接重试，依次尝试其他从库与主库，都已尝试过时返回None
+        """
+        replica_ = self.pool.choose(exclude={*tried, *self.monitor.lagging})
+        if replica_ is None and self.master not in tried:
+            replica_ = self.master
+        if replica_ is not None:
+            self.retries += 1
+        return replica_
+
+    async def start(self):
+        await self.monitor.start()
+
+    async def stop(self):
+        await self.monitor.stop()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "sticky_seconds": self.sticky_seconds,
+            "replica_reads": self.replica_reads,
+            "master_reads": self.master_reads,
+            "master_fallbacks": self.master_fallbacks,
+            "retries": self.retries,
+            "replicas": self.pool.metrics(),
+            "monitor": self.monitor.metrics(),
+        }
+
+
+read_routing = ReadRouting()
 
 
 class WriteOrReadRouter:
     def db_for_read(self, model: Type[Model]):
-        return "slave"
+        return read_routing.db_for_read()
 
     def db_for_write(self, model: Type[Model]):
-        return "master"
+        return read_routing.db_for_write()
+
+
+_CONNECTION_ERROR_CODES = (2002, 2003, 2006, 2013, 2055)  # 无法连接、连接断开等MySQL客户端错误
+_RETRYABLE_PREFIXES = ("SELECT", "WITH")
+
+
+def _is_connection_error(exc: BaseException) -> bool:
+    """
+    Tortoise将驱动的异常包装为OperationalError，原异常在args[0]中
+    """
+    seen_ = set()
+    while exc is not None and id(exc) not in seen_:
+        seen_.add(id(exc))
+        if isinstance(exc, (DBConnectionError, OSError)):
+            return True
+        args_ = getattr(exc, "args", ())
+        if args_ and isinstance(args_[0], int) and args_[0] in _CONNECTION_ERROR_CODES:
+            return True
+        exc = args_[0] if args_ and isinstance(args_[0], BaseException) else (exc.__cause__ or exc.__context__)
+    return False
+
+
+class ReplicaClientMixin(object):
+    """
+    从库连接的客户端，与具体数据库的客户端组合使用，见backends.replica_mysql
+    - 记录正在执行的查询数，用于选择从库
+    - 连接失败时计入从库的连续失败次数，SELECT在其他从库或主库上重试
+    """
+
+    connection_name: str
+
+    async def _execute_read(self, method: str, query: str, values: Optional[list] = None) -> Any:
+        pool_ = read_routing.pool
+        pool_.acquire(self.connection_name)
+        ok_ = True
+        try:
+            return await getattr(super(), method)(query, values)
+        except Exception as exc:
+            ok_ = not _is_connection_error(exc)
+            raise
+        finally:
+            pool_.release(self.connection_name, ok_)
+
+    async def _execute_with_retry(self, method: str, query: str, values: Optional[list] = None) -> Any:
+        tried_ = [self.connection_name]
+        client_ = self
+        while True:
+            try:
+                if isinstance(client_, ReplicaClientMixin):
+                    return await client_._execute_read(method, query, values)
+                return await getattr(client_, method)(query, values)
+            except Exception as exc:
+                if not _is_connection_error(exc) or not query.lstrip().upper().startswith(_RETRYABLE_PREFIXES):
+                    raise
+                next_ = read_routing.db_for_retry(tried_)
+                if next_ is None:
+                    raise
+                logger.warning(f"Read on {tried_[-1]} failed, retry on {next_}: {exc!r}")
+                tried_.append(next_)
+                client_ = connections.get(next_)
+
+    async def execute_query(self, query: str, values: Optional[list] = None) -> Tuple[int, List[dict]]:
+        return await self._execute_with_retry("execute_query", query, values)
+
+    async def execute_query_dict(self, query: str, values: Optional[list] = None) -> List[dict]:
+        return await self._execute_with_retry("execute_query_dict", query, values)
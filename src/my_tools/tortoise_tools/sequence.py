@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/6 9:30
+# @Author  : NotBeBarnon
+# @Description : 基于序列表的hi/lo编号分配
+import asyncio
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional, Type
+
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
+__all__ = (
+    "HiLoAllocator",
+)
+
+
+class HiLoAllocator(object):
+    """
+    每次用一条原子的UPDATE从序列表预留一段编号，之后在内存中分配，用完再预留下一段
+    - 序列表模型需要包含 name(主键，序列名称) 与 value(下一个未预留的编号) 两列
+    - 多个进程各自预留不同的编号段，编号唯一但不保证按时间递增
+    - 进程退出时未分配的编号被丢弃，编号可能不连续
+    """
+
+    def __init__(self, sequence_model: Type[Model], block_size: int = 20,
+                 initial: Optional[Callable[[str], Awaitable[int]]] = None):
+        """
+        Args:
+            sequence_model: 序列表模型
+            block_size: 每次预留的编号数量
+            initial: 序列不存在时获取其第一个编号，用于接续已有数据，默认从1开始
+        """
+        self.model = sequence_model
+        self.block_size = block_size
+        self.initial = initial
+        self.__ranges: Dict[str, List[int]] = {}  # 序列名称: [下一个编号, 编号段的上界(不包括)]
+        self.__locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def next(self, name: str) -> int:
+        """
+        获取序列的下一个编号
+        """
+        range_ = self.__ranges.get(name)
+        if range_ is None or range_[0] >= range_[1]:
+            async with self.__locks[name]:
+                # 等待锁的过程中其他调用可能已经预留了新的编号段
+                range_ = self.__ranges.get(name)
+                if range_ is None or range_[0] >= range_[1]:
+                    range_ = self.__ranges[name] = await self.__reserve(name)
+        value_ = range_[0]
+        range_[0] += 1
+        return value_
+
+    def discard(self, name: Optional[str] = None):
+        """
+        丢弃内存中未分配的编号，如序列前缀变化后不再使用旧序列
+        """
+        if name is None:
+            self.__ranges.clear()
+        else:
+            self.__ranges.pop(name, None)
+
+    async def __reserve(self, name: str) -> List[int]:
+        connection_name_ = self.model._choose_db(True).connection_name
+        while True:
+            async with in_transaction(connection_name_) as connection_:
+                # UPDATE持有行锁直到事务结束，随后读取到的就是本次预留后的值
+                if await self.model.filter(name=name).using_db(connection_).update(value=F("value") + self.block_size):
+                    high_ = await self.model.filter(name=name).using_db(connection_).first().values_list("value", flat=True)
+                    return [high_ - self.block_size, high_]
+            start_ = await self.initial(name) if self.initial is not None else 1
+            try:
+                await self.model.create(name=name, value=start_)
+            except IntegrityError:
+                # 其他进程同时创建了此序列
+                pass
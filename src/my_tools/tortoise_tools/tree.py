@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/2 9:40
+# @Author  : NotBeBarnon
+# @Description : 邻接表（parent_id）结构的内存树索引
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, Type
+
+from tortoise.models import Model
+
+__all__ = (
+    "TreeIndex",
+    "TreeIndexCache",
+)
+
+_ALL = object()  # 不分组，索引整张表
+
+
+class TreeIndex(object):
+    """
+    一次性读入的节点建立 父节点 -> 子节点 的索引，建立耗时O(n)，之后不再查询数据库
+    - 节点为values()得到的字典，输出树时复制节点并添加子节点列表
+    - 父节点为None或不在本组节点中的节点视为根节点
+    - 数据中存在环时，环上的节点只输出一次
+    """
+
+    def __init__(self, rows: Sequence[Dict[str, Any]], pk: str = "id", parent: str = "parent_id",
+                 children_key: str = "children"):
+        self.pk = pk
+        self.parent = parent
+        self.children_key = children_key
+        self.nodes: Dict[Any, Dict[str, Any]] = {row_[pk]: row_ for row_ in rows}
+        self.children: Dict[Any, List[Any]] = defaultdict(list)
+        self.roots: List[Any] = []
+        for row_ in rows:
+            parent_ = row_[parent]
+            if parent_ is None or parent_ not in self.nodes:
+                self.roots.append(row_[pk])
+            else:
+                self.children[parent_].append(row_[pk])
+
+    def __contains__(self, pk: Any) -> bool:
+        return pk in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def build(self, pks: Sequence[Any], max_depth: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        输出以pks为根的树
+        Args:
+            pks: 根节点主键
+            max_depth: 最大深度，0表示只输出根节点，None表示不限制
+        """
+        visited_ = set()
+        result_: List[Dict[str, Any]] = []
+        # 使用栈代替递归，层级很深时不会超过递归限制
+        stack_: List[Tuple[Any, int, List[Dict[str, Any]]]] = [(pk_, 0, result_) for pk_ in reversed(pks)]
+        while stack_:
+            pk_, depth_, container_ = stack_.pop()
+            if pk_ in visited_ or pk_ not in self.nodes:
+                continue
+            visited_.add(pk_)
+            node_ = dict(self.nodes[pk_])
+            node_[self.children_key] = []
+            container_.append(node_)
+            if max_depth is None or depth_ < max_depth:
+                stack_.extend((child_, depth_ + 1, node_[self.children_key]) for child_ in reversed(self.children.get(pk_, ())))
+        return result_
+
+    def subtree(self, pk: Any, max_depth: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        输出以pk为根的子树，节点不存在时返回None
+        """
+        tree_ = self.build([pk], max_depth)
+        return tree_[0] if tree_ else None
+
+    def path(self, pk: Any) -> List[Dict[str, Any]]:
+        """
+        从根节点到pk节点（包括）的路径，节点不存在时返回空列表
+        """
+        path_: List[Dict[str, Any]] = []
+        visited_ = set()
+        while pk in self.nodes and pk not in visited_:
+            visited_.add(pk)
+            path_.append(self.nodes[pk])
+            pk = self.nodes[pk][self.parent]
+        path_.reverse()
+        return path_
+
+    def descendants(self, pk: Any) -> List[Any]:
+        """
+        pk节点所有后代的主键，不包括pk
+        """
+        result_: List[Any] = []
+        visited_ = {pk}
+        stack_ = list(self.children.get(pk, ()))
+        while stack_:
+            child_ = stack_.pop()
+            if child_ in visited_:
+                continue
+            visited_.add(child_)
+            result_.append(child_)
+            stack_.extend(self.children.get(child_, ()))
+        return result_
+
+
+class TreeIndexCache(object):
+    """
+    按分组（如company_id）缓存TreeIndex，每组一次values()查询
+    - 同一分组并发的加载只查询一次
+    - 加载过程中分组被清理时，加载结果只返回给本次调用，不会写入缓存
+    - 只在当前进程内生效，多进程部署时其他进程的数据依赖ttl过期
+    """
+
+    def __init__(self, model: Type[Model], group_field: Optional[str], parent_field: str, fields: Sequence[str],
+                 pk: str = "id", children_key: str = "children", ttl: Optional[float] = None):
+        """
+        Args:
+            model: orm模型
+            group_field: 分组列，为None时整张表为一组
+            parent_field: 父节点列
+            fields: 节点需要的列，会自动加入主键与父节点列
+            pk: 主键列
+            children_key: 输出树时子节点列表的key
+            ttl: 缓存有效期（秒），None表示只在清理时失效
+        """
+        self.model = model
+        self.group_field = group_field
+        self.parent_field = parent_field
+        self.pk = pk
+        self.children_key = children_key
+        self.ttl = ttl
+        self.fields: Tuple[str, ...] = tuple(dict.fromkeys((pk, parent_field, *fields)))
+        self.__indexes: Dict[Hashable, Tuple[TreeIndex, float]] = {}
+        self.__loading: Dict[Hashable, asyncio.Task] = {}
+        self.__generations: Dict[Hashable, int] = defaultdict(int)
+
+    async def get(self, group: Hashable = _ALL) -> TreeIndex:
+        """
+        获取分组的索引，group不传时索引整张表
+        """
+        if self.group_field is None:
+            group = _ALL
+        cached_ = self.__indexes.get(group)
+        if cached_ is not None and (self.ttl is None or cached_[1] > time.monotonic()):
+            return cached_[0]
+
+        if (task_ := self.__loading.get(group)) is None:
+            task_ = self.__loading[group] = asyncio.create_task(self.__load(group, self.__generations[group]))
+            task_.add_done_callback(lambda done_: self.__loading.get(group) is done_ and self.__loading.pop(group))
+        # shield防止某个调用者被取消时中断其他调用者共享的加载
+        return await asyncio.shield(task_)
+
+    def invalidate(self, *groups: Hashable):
+        """
+        清理分组的索引，不传参数时清理全部
+        整表索引包含所有分组的数据，任何分组被清理时一起清理
+        """
+        if not groups:
+            groups = tuple(self.__indexes.keys() | self.__loading.keys())
+        for group_ in (*groups, _ALL):
+            self.__indexes.pop(group_, None)
+            # 正在加载的结果可能读到旧数据，之后的调用重新加载，且旧的结果不写入缓存
+            self.__loading.pop(group_, None)
+            self.__generations[group_] += 1
+
+    async def __load(self, group: Hashable, generation: int) -> TreeIndex:
+        queryset_ = self.model.all() if group is _ALL else self.model.filter(**{self.group_field: group})
+        rows_ = await queryset_.order_by(self.pk).values(*self.fields)
+        index_ = TreeIndex(rows_, pk=self.pk, parent=self.parent_field, children_key=self.children_key)
+        if self.__generations[group] == generation:
+            expire_ = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+            self.__indexes[group] = (index_, expire_)
+        return index_
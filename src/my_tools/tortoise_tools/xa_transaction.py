@@ -1,63 +1,154 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2022/7/26 16:07
 # @Author  : NotBeBarnon
-# @Description :
-from typing import Optional
+# @Description : MySQL XA事务与多个连接间的两阶段提交
+import asyncio
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
 
+import orjson
+from loguru import logger
 from pymysql.constants import COMMAND
 from tortoise import connections
 from tortoise.backends.base.client import TransactionContextPooled
 from tortoise.backends.mysql.client import MySQLClient, TransactionWrapper, translate_exceptions
-from tortoise.exceptions import ParamsError, TransactionManagementError
+from tortoise.exceptions import OperationalError, ParamsError, TransactionManagementError
+
+from src.my_tools.executor_tools import run_in_thread
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+__all__ = (
+    "XATransactionWrapper",
+    "XAMySQLClient",
+    "xa_in_transaction",
+    "XADecisionLog",
+    "XACoordinator",
+    "xa_coordinator",
+)
 
 
 class XATransactionWrapper(TransactionWrapper):
-    def __init__(self, connection: MySQLClient, transaction_id: str) -> None:
+    """
+    一个XA分支
+    - 退出xa_in_transaction时执行第一阶段（XA END + XA PREPARE），出现异常时回滚
+    - 第二阶段xa_commit/xa_rollback在原连接上执行，原连接已归还时从连接池获取连接执行，已准备的分支不依赖开启它的连接
+    """
+
+    def __init__(self, connection: MySQLClient, transaction_id: str, branch_qualifier: Optional[str] = None) -> None:
         super().__init__(connection)
         self.transaction_id = transaction_id
+        self.branch_qualifier = branch_qualifier
+        self.prepared = False
+
+    @property
+    def xid(self) -> str:
+        if self.branch_qualifier is None:
+            return f"'{self.transaction_id}'"
+        return f"'{self.transaction_id}','{self.branch_qualifier}'"
+
+    async def __xa(self, statement: str) -> None:
+        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA {statement} {self.xid}")
+        await self._connection._read_ok_packet()
 
     @translate_exceptions
     async def start(self) -> None:
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA START '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
+        await self.__xa("START")
         self._finalized = False
 
-    async def commit(self) -> None:
+    @translate_exceptions
+    async def prepare(self) -> None:
         if self._finalized:
             raise TransactionManagementError("Transaction already finalised")
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA END '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA PREPARE '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
+        await self.__xa("END")
+        await self.__xa("PREPARE")
+        self.prepared = True
         self._finalized = True
 
+    async def commit(self) -> None:
+        await self.prepare()
+
+    @translate_exceptions
     async def rollback(self) -> None:
         if self._finalized:
             raise TransactionManagementError("Transaction already finalised")
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA END '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA PREPARE '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
+        await self.__xa("END")
+        await self.__xa("ROLLBACK")
         self._finalized = True
 
+    @translate_exceptions
+    async def __finish(self, statement: str) -> None:
+        if not self.prepared:
+            raise TransactionManagementError("Transaction is not prepared")
+        if self._connection is not None:
+            await self.__xa(statement)
+        else:
+            await self._parent.execute_script(f"XA {statement} {self.xid}")
+        self.prepared = False
+
     async def xa_commit(self) -> None:
-        if self._finalized:
-            raise TransactionManagementError("Transaction already finalised")
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA COMMIT '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
-        self._finalized = True
+        await self.__finish("COMMIT")
 
     async def xa_rollback(self) -> None:
-        if self._finalized:
-            raise TransactionManagementError("Transaction already finalised")
-        await self._connection._execute_command(COMMAND.COM_QUERY, f"XA ROLLBACK '{self.transaction_id}'")
-        await self._connection._read_ok_packet()
-        self._finalized = True
+        await self.__finish("ROLLBACK")
+
+    async def open(self) -> None:
+        """
+        不通过xa_in_transaction时，从连接池获取连接并开始分支
+        """
+        if not self._parent._pool:
+            await self._parent.create_connection(with_db=True)
+        self._connection = await self._parent._pool.acquire()
+        try:
+            await self.start()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self, discard: bool = False) -> None:
+        """
+        将连接归还连接池，discard为True时先关闭连接，用于XA语句失败后连接状态未知的情况
+        """
+        connection_, self._connection = self._connection, None
+        if connection_ is None or not self._parent._pool:
+            return
+        if discard:
+            connection_.close()
+        self._parent._pool.release(connection_)
+
+
+class XATransactionContext(TransactionContextPooled):
+    """
+    第一阶段或回滚失败时同样归还连接
+    """
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        discard_ = False
+        try:
+            if not self.connection._finalized:
+                if exc_type:
+                    if exc_type is not TransactionManagementError:
+                        await self.connection.rollback()
+                else:
+                    await self.connection.commit()
+        except BaseException:
+            discard_ = True
+            raise
+        finally:
+            self.connection.close(discard_)
+            connections.reset(self.token)
 
 
 class XAMySQLClient(MySQLClient):
-    def xa_in_transaction(self, transaction_id: str) -> "TransactionContext":
-        return TransactionContextPooled(XATransactionWrapper(self, transaction_id))
+    def xa_in_transaction(self, transaction_id: str, branch_qualifier: Optional[str] = None) -> "TransactionContext":
+        return XATransactionContext(XATransactionWrapper(self, transaction_id, branch_qualifier))
 
 
 def _get_connection(connection_name: Optional[str]) -> "BaseDBAsyncClient":
@@ -74,6 +165,278 @@ def _get_connection(connection_name: Optional[str]) -> "BaseDBAsyncClient":
     return connection
 
 
-def xa_in_transaction(transaction_id: str, connection_name: Optional[str] = None) -> "TransactionContext":
+def xa_in_transaction(transaction_id: str, connection_name: Optional[str] = None,
+                      branch_qualifier: Optional[str] = None) -> "TransactionContext":
     connection = _get_connection(connection_name)
-    return XAMySQLClient.xa_in_transaction(connection, transaction_id)
+    return XAMySQLClient.xa_in_transaction(connection, transaction_id, branch_qualifier)
+
+
+class XADecisionLog(object):
+    """
+    协调者的提交决定日志，每行一个json
+    - 所有分支准备成功后写入 {"gtrid", "branches", "decision": "commit"} 并fsync，之后才开始第二阶段
+    - 第二阶段全部完成后写入 {"gtrid", "done": true}
+    - 只记录提交的决定，没有记录的事务按回滚处理（presumed abort），准备失败时不需要写日志
+    - 多个进程共用同一个文件，追加与整理时加文件锁（fcntl可用时）
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def __append(self, record: Dict[str, Any], sync: bool):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd_ = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd_, fcntl.LOCK_EX)
+            os.write(fd_, orjson.dumps(record) + b"\n")
+            if sync:
+                os.fsync(fd_)
+        finally:
+            os.close(fd_)
+
+    async def record_commit(self, gtrid: str, branches: Sequence[str]):
+        await run_in_thread(self.__append, {"gtrid": gtrid, "branches": list(branches), "decision": "commit", "at": time.time()}, True)
+
+    async def record_done(self, gtrid: str):
+        # 丢失done记录只会在恢复时多检查一次，不需要fsync
+        await run_in_thread(self.__append, {"gtrid": gtrid, "done": True}, False)
+
+    def __read_pending(self, lines: List[bytes]) -> Dict[str, List[str]]:
+        pending_: Dict[str, List[str]] = {}
+        for line_ in lines:
+            try:
+                record_ = orjson.loads(line_)
+            except orjson.JSONDecodeError:
+                # 写入时崩溃留下的不完整行，其决定未fsync，事务没有进入第二阶段
+                continue
+            if record_.get("done"):
+                pending_.pop(record_["gtrid"], None)
+            elif record_.get("decision") == "commit":
+                pending_[record_["gtrid"]] = record_["branches"]
+        return pending_
+
+    def pending(self) -> Dict[str, List[str]]:
+        """
+        已决定提交但第二阶段未确认完成的事务: 分支列表
+        """
+        if not self.path.exists():
+            return {}
+        return self.__read_pending(self.path.read_bytes().splitlines())
+
+    def compact(self):
+        """
+        只保留未完成的决定
+        """
+        if not self.path.exists():
+            return
+        with open(self.path, "r+b") as file_:
+            if fcntl is not None:
+                fcntl.flock(file_.fileno(), fcntl.LOCK_EX)
+            pending_ = self.__read_pending(file_.read().splitlines())
+            file_.seek(0)
+            file_.truncate()
+            for gtrid_, branches_ in pending_.items():
+                file_.write(orjson.dumps({"gtrid": gtrid_, "branches": branches_, "decision": "commit"}) + b"\n")
+            file_.flush()
+            os.fsync(file_.fileno())
+
+
+_XAER_NOTA = 1397  # XID不存在，分支已经提交或回滚
+
+
+def _is_unknown_xid(exc: BaseException) -> bool:
+    args_ = getattr(exc, "args", ())
+    inner_ = args_[0] if args_ and isinstance(args_[0], BaseException) else exc
+    return bool(getattr(inner_, "args", ())) and inner_.args[0] == _XAER_NOTA
+
+
+class XACoordinator(object):
+    """
+    在多个Tortoise连接上执行分布式事务
+    - 各个分支的开始、准备、提交或回滚都并发执行，耗时约等于最慢的一个分支
+    - 所有分支准备成功后先写入提交的决定，再提交所有分支；任何分支准备失败则回滚所有分支
+    - 第二阶段失败或进程崩溃时，已准备的分支持有锁直到recover根据决定日志提交或回滚
+    - 全局事务ID为 {prefix}-{毫秒时间戳}-{随机值}，分支限定符为连接名称，
+      recover只处理本协调者前缀的、超过recover_after秒的未决分支，避免回滚其他进程正在执行的事务
+
+    使用：
+        async with xa_coordinator.transaction("master", "order") as branches_:
+            await Company.create(name="...", using_db=branches_["master"])
+            await Order.create(..., using_db=branches_["order"])
+    """
+
+    def __init__(self, connection_names: Sequence[str] = ("master",), log_path: Union[str, Path] = "logs/xa_decisions.log",
+                 prefix: str = "fs", recover_after: float = 60):
+        """
+        Args:
+            connection_names: recover时检查的连接
+            log_path: 决定日志的路径，需要在持久化的磁盘上
+            recover_after: 没有提交决定的未决分支超过此秒数后才回滚
+        """
+        self.connection_names = list(connection_names)
+        self.decision_log = XADecisionLog(log_path)
+        self.prefix = prefix
+        self.recover_after = recover_after
+        # 指标
+        self.committed = 0
+        self.rolled_back = 0
+        self.prepare_failures = 0
+        self.commit_failures = 0
+        self.recovered_commits = 0
+        self.recovered_rollbacks = 0
+
+    def configure(self, **config: Any):
+        """
+        使用配置重新创建，需要在recover之前调用
+        """
+        self.__init__(**config)
+
+    def new_gtrid(self) -> str:
+        return f"{self.prefix}-{int(time.time() * 1000)}-{uuid.uuid4().hex[:12]}"
+
+    def __age_of(self, gtrid: str) -> Optional[float]:
+        """
+        本协调者生成的gtrid的存在时长，不是本协调者生成的返回None
+        """
+        parts_ = gtrid.rsplit("-", 2)
+        if len(parts_) != 3 or parts_[0] != self.prefix or not parts_[1].isdigit():
+            return None
+        millis_ = parts_[1]
+        return time.time() - int(millis_) / 1000
+
+    @staticmethod
+    async def __gather(branches: Sequence[XATransactionWrapper], action: str) -> List[Optional[BaseException]]:
+        results_ = await asyncio.gather(*(getattr(branch_, action)() for branch_ in branches), return_exceptions=True)
+        return [result_ if isinstance(result_, BaseException) else None for result_ in results_]
+
+    async def __rollback(self, gtrid: str, branches: Sequence[XATransactionWrapper]):
+        """
+        回滚所有分支，未准备的分支执行 XA END + XA ROLLBACK，已准备的分支执行 XA ROLLBACK
+        """
+        errors_ = await self.__gather([branch_ for branch_ in branches if not branch_.prepared and not branch_._finalized], "rollback")
+        errors_ += await self.__gather([branch_ for branch_ in branches if branch_.prepared], "xa_rollback")
+        for error_ in errors_:
+            if error_ is not None:
+                logger.error(f"XA {gtrid} rollback failed, branch left for recovery: {error_!r}")
+        self.rolled_back += 1
+
+    @asynccontextmanager
+    async def transaction(self, *connection_names: str, gtrid: Optional[str] = None) -> AsyncIterator[Dict[str, XATransactionWrapper]]:
+        """
+        在各个连接上开启XA分支，返回 连接名称: 分支，范围内未指定using_db的写入也使用对应的分支
+        """
+        if len(set(connection_names)) != len(connection_names) or not connection_names:
+            raise ParamsError("XA transaction needs distinct connection names")
+        gtrid_ = gtrid or self.new_gtrid()
+        branches_: Dict[str, XATransactionWrapper] = {
+            name_: XATransactionWrapper(_get_connection(name_), gtrid_, name_) for name_ in connection_names
+        }
+        branch_list_ = list(branches_.values())
+        open_errors_ = await self.__gather(branch_list_, "open")
+        if any(open_errors_):
+            opened_ = [branch_ for branch_, error_ in zip(branch_list_, open_errors_) if error_ is None]
+            await self.__rollback(gtrid_, opened_)
+            for branch_ in opened_:
+                branch_.close()
+            raise next(error_ for error_ in open_errors_ if error_ is not None)
+
+        tokens_ = [connections.set(name_, branch_) for name_, branch_ in branches_.items()]
+        try:
+            yield branches_
+        except BaseException:
+            await self.__rollback(gtrid_, branch_list_)
+            raise
+        else:
+            prepare_errors_ = await self.__gather(branch_list_, "prepare")
+            if any(prepare_errors_):
+                self.prepare_failures += 1
+                await self.__rollback(gtrid_, branch_list_)
+                raise next(error_ for error_ in prepare_errors_ if error_ is not None)
+            # 决定写入磁盘之前崩溃时，recover回滚所有分支
+            await self.decision_log.record_commit(gtrid_, list(branches_.keys()))
+            commit_errors_ = await self.__gather(branch_list_, "xa_commit")
+            if any(commit_errors_):
+                # 已决定提交，不能再回滚，由recover继续提交
+                self.commit_failures += 1
+                for error_ in commit_errors_:
+                    if error_ is not None:
+                        logger.error(f"XA {gtrid_} commit failed, branch left for recovery: {error_!r}")
+            else:
+                await self.decision_log.record_done(gtrid_)
+            self.committed += 1
+        finally:
+            for token_ in reversed(tokens_):
+                connections.reset(token_)
+            for branch_ in branch_list_:
+                branch_.close(discard=branch_._connection is not None and not branch_._finalized)
+
+    @staticmethod
+    def __parse_recover_row(row: Dict[str, Any]) -> Tuple[str, str]:
+        data_ = row["data"]
+        if isinstance(data_, str):
+            data_ = data_.encode("utf-8")
+        gtrid_length_ = int(row["gtrid_length"])
+        bqual_length_ = int(row["bqual_length"])
+        return data_[:gtrid_length_].decode("utf-8"), data_[gtrid_length_:gtrid_length_ + bqual_length_].decode("utf-8")
+
+    async def recover(self) -> Dict[str, int]:
+        """
+        处理各个连接上的未决分支（XA RECOVER），在启动时调用
+        - 有提交决定的分支提交，没有决定且超过recover_after秒的分支回滚
+        - 所有分支都已处理的决定从日志中移除
+        """
+        pending_ = await run_in_thread(self.decision_log.pending)
+        unresolved_ = set()
+        result_ = {"committed": 0, "rolled_back": 0, "skipped": 0}
+        for name_ in list(self.connection_names):
+            client_ = connections.get(name_)
+            if client_.capabilities.dialect != "mysql":
+                unresolved_.update(pending_)
+                continue
+            for row_ in await client_.execute_query_dict("XA RECOVER"):
+                gtrid_, bqual_ = self.__parse_recover_row(row_)
+                age_ = self.__age_of(gtrid_)
+                if age_ is None:
+                    continue
+                if gtrid_ in pending_:
+                    statement_ = "COMMIT"
+                elif age_ > self.recover_after:
+                    statement_ = "ROLLBACK"
+                else:
+                    result_["skipped"] += 1
+                    continue
+                try:
+                    await client_.execute_script(f"XA {statement_} '{gtrid_}','{bqual_}'")
+                except OperationalError as exc:
+                    if not _is_unknown_xid(exc):
+                        logger.error(f"XA recover {statement_} {gtrid_} on {name_} failed: {exc!r}")
+                        unresolved_.add(gtrid_)
+                        continue
+                logger.warning(f"XA recover {statement_} {gtrid_},{bqual_} on {name_}")
+                if statement_ == "COMMIT":
+                    result_["committed"] += 1
+                    self.recovered_commits += 1
+                else:
+                    result_["rolled_back"] += 1
+                    self.recovered_rollbacks += 1
+        checked_ = set(self.connection_names)
+        for gtrid_, branches_ in pending_.items():
+            # 分支所在的连接都检查过才能确认决定已完成
+            if gtrid_ not in unresolved_ and checked_.issuperset(branches_):
+                await self.decision_log.record_done(gtrid_)
+        await run_in_thread(self.decision_log.compact)
+        return result_
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "committed": self.committed,
+            "rolled_back": self.rolled_back,
+            "prepare_failures": self.prepare_failures,
+            "commit_failures": self.commit_failures,
+            "recovered_commits": self.recovered_commits,
+            "recovered_rollbacks": self.recovered_rollbacks,
+        }
+
+
+xa_coordinator = XACoordinator()
@@ -3,13 +3,11 @@
 # @Author  : NotBeBarnon
 # @Description : 配置文件
 import datetime
-import json
 import os
 import sys
 from pathlib import Path
 
 import dotenv
-import tomlkit
 from loguru import logger as __logger
 
 # 项目根目录
@@ -19,12 +17,15 @@ if PROJECT_DIR.name == "lib":  # 适配cx_Freeze打包项目后根目录的变
 
 # 加载环境变量
 dotenv.load_dotenv(PROJECT_DIR.joinpath("project_env"))
-# 加载项目配置
-__toml_config = json.loads(
-    json.dumps(
-        tomlkit.loads(PROJECT_DIR.joinpath("pyproject.toml").read_bytes())
-    )
-)  # 转换包装类型为Python默认类型
+# 加载项目配置，只读取时优先使用标准库的tomllib（Python3.11+），比tomlkit快一个数量级
+try:
+    import tomllib as __tomllib
+
+    __toml_config = __tomllib.loads(PROJECT_DIR.joinpath("pyproject.toml").read_text(encoding="utf-8"))
+except ImportError:
+    import tomlkit as __tomlkit
+
+    __toml_config = __tomlkit.loads(PROJECT_DIR.joinpath("pyproject.toml").read_bytes()).unwrap()  # 转换包装类型为Python默认类型
 
 VERSION = __toml_config["tool"]["commitizen"]["version"]
 VERSION_FORMAT = __toml_config["tool"]["commitizen"]["tag_format"].replace("$version", VERSION)
@@ -101,39 +102,67 @@ LOGGERS_ID = {
 }
 __logger.success(f"Loggers: {LOGGERS_ID}")
 
+# 进程池与线程池
+EXECUTOR_CONFIG = {
+    "process_workers": int(PROJECT_CONFIG.get("executor", {}).get("process_workers", 2)),
+    "thread_workers": int(PROJECT_CONFIG.get("executor", {}).get("thread_workers", 8)),
+    "max_pending": int(PROJECT_CONFIG.get("executor", {}).get("max_pending", 64)),
+    "wait_timeout": float(PROJECT_CONFIG.get("executor", {}).get("wait_timeout", 10)),
+    "mp_context": PROJECT_CONFIG.get("executor", {}).get("mp_context", "spawn"),
+}
+
 DEFAULT_TIMEZONE = "UTC"
 LOCAL_TIMEZONE = "Asia/Shanghai"
 
 DATABASE_NAME = os.getenv("FS_DATABASE_NAME", PROJECT_CONFIG["database"]["db_name"])
+# 从库列表，每个从库为一个连接，连接名称为name；未配置replicas时使用slave
+DATABASE_REPLICAS = PROJECT_CONFIG["database"].get("replicas") or [
+    {"name": "slave", **PROJECT_CONFIG["database"]["slave"]},
+]
+# 连接池：获取连接的超时时间，以及是否根据获取连接的等待时间自动调整maxsize
+DATABASE_POOL_CONFIG = {
+    "acquire_timeout": float(PROJECT_CONFIG["database"].get("pool", {}).get("acquire_timeout", 10)),
+    "adaptive": bool(PROJECT_CONFIG["database"].get("pool", {}).get("adaptive", False)),
+    "adaptive_interval": float(PROJECT_CONFIG["database"].get("pool", {}).get("adaptive_interval", 5)),
+    "grow_wait": float(PROJECT_CONFIG["database"].get("pool", {}).get("grow_wait", 0.05)),
+}
 DATABASE_CONFIG = {
     "connections": {
         "master": {
-            "engine": "tortoise.backends.mysql",
+            "engine": "src.my_tools.tortoise_tools.backends.mysql",  # 记录连接池指标，启动时预热
             "credentials": {
                 "host": os.getenv("FS_MASTER_DATABASE_HOST", PROJECT_CONFIG["database"]["master"]["host"]),  # FS_DATABASE_HOST 数据库名称环境变量根据需求修改
                 "port": int(os.getenv("FS_MASTER_DATABASE_PORT", PROJECT_CONFIG["database"]["master"]["port"])),
                 "user": os.getenv("FS_MASTER_DATABASE_USER", PROJECT_CONFIG["database"]["master"]["user"]),
                 "password": os.getenv("FS_MASTER_DATABASE_PASSWORD", PROJECT_CONFIG["database"]["master"]["password"]),
                 "database": os.getenv("FS_DATABASE_NAME", PROJECT_CONFIG["database"]["db_name"]),
-                "minsize": PROJECT_CONFIG["database"]["minsize"],
-                "maxsize": PROJECT_CONFIG["database"]["maxsize"],
+                # 每个连接可以单独配置连接池大小，未配置时使用[myproject.database]中的值
+                "minsize": PROJECT_CONFIG["database"]["master"].get("minsize", PROJECT_CONFIG["database"]["minsize"]),
+                "maxsize": PROJECT_CONFIG["database"]["master"].get("maxsize", PROJECT_CONFIG["database"]["maxsize"]),
+                "adaptive_maxsize": PROJECT_CONFIG["database"]["master"].get("adaptive_maxsize"),
                 "charset": "utf8mb4",
                 "pool_recycle": PROJECT_CONFIG["database"]["pool_recycle"],
+                **DATABASE_POOL_CONFIG,
             }
         },
-        "slave": {
-            "engine": "tortoise.backends.mysql",
-            "credentials": {
-                "host": os.getenv("FS_SLAVE_DATABASE_HOST", PROJECT_CONFIG["database"]["slave"]["host"]),  # FS_DATABASE_HOST 数据库名称环境变量根据需求修改
-                "port": int(os.getenv("FS_SLAVE_DATABASE_PORT", PROJECT_CONFIG["database"]["slave"]["port"])),
-                "user": os.getenv("FS_SLAVE_DATABASE_USER", PROJECT_CONFIG["database"]["slave"]["user"]),
-                "password": os.getenv("FS_SLAVE_DATABASE_PASSWORD", PROJECT_CONFIG["database"]["slave"]["password"]),
-                "database": os.getenv("FS_DATABASE_NAME", PROJECT_CONFIG["database"]["db_name"]),
-                "minsize": PROJECT_CONFIG["database"]["minsize"],
-                "maxsize": PROJECT_CONFIG["database"]["maxsize"],
-                "charset": "utf8mb4",
-                "pool_recycle": PROJECT_CONFIG["database"]["pool_recycle"],
+        **{
+            replica_["name"]: {
+                "engine": "src.my_tools.tortoise_tools.backends.replica_mysql",  # 记录从库负载与连接失败，SELECT失败时换连接重试
+                "credentials": {
+                    "host": os.getenv(f"FS_{replica_['name'].upper()}_DATABASE_HOST", replica_["host"]),  # 如 FS_SLAVE_DATABASE_HOST
+                    "port": int(os.getenv(f"FS_{replica_['name'].upper()}_DATABASE_PORT", replica_["port"])),
+                    "user": os.getenv(f"FS_{replica_['name'].upper()}_DATABASE_USER", replica_["user"]),
+                    "password": os.getenv(f"FS_{replica_['name'].upper()}_DATABASE_PASSWORD", replica_["password"]),
+                    "database": os.getenv("FS_DATABASE_NAME", PROJECT_CONFIG["database"]["db_name"]),
+                    "minsize": replica_.get("minsize", PROJECT_CONFIG["database"]["minsize"]),
+                    "maxsize": replica_.get("maxsize", PROJECT_CONFIG["database"]["maxsize"]),
+                    "adaptive_maxsize": replica_.get("adaptive_maxsize"),
+                    "charset": "utf8mb4",
+                    "pool_recycle": PROJECT_CONFIG["database"]["pool_recycle"],
+                    **DATABASE_POOL_CONFIG,
+                }
             }
+            for replica_ in DATABASE_REPLICAS
         },
     },
     "apps": {
@@ -152,6 +181,41 @@ DATABASE_CONFIG = {
     "timezone": DEFAULT_TIMEZONE,  # 设置时区转换，即从数据库取出utc时间后会被转换为timezone所指定的时区时间（待验证）
 }
 
+# 读写分离：从库权重、写入后固定读主库的时长、从库允许的最大延迟与延迟检查间隔，单位 秒
+READ_ROUTING_CONFIG = {
+    "master": "master",
+    "replicas": {replica_["name"]: float(replica_.get("weight", 1)) for replica_ in DATABASE_REPLICAS},
+    "sticky_seconds": float(PROJECT_CONFIG["database"].get("routing", {}).get("sticky_seconds", 2)),
+    "max_replica_lag": float(PROJECT_CONFIG["database"].get("routing", {}).get("max_replica_lag", 1)),
+    "lag_check_interval": float(PROJECT_CONFIG["database"].get("routing", {}).get("lag_check_interval", 1)),
+    "max_failures": int(PROJECT_CONFIG["database"].get("routing", {}).get("max_failures", 3)),
+    "eject_seconds": float(PROJECT_CONFIG["database"].get("routing", {}).get("eject_seconds", 10)),
+}
+
+# 请求的SQL统计：记录的慢SQL条数、N+1查询的判断次数、慢查询阈值（毫秒）、是否输出Server-Timing响应头
+QUERY_TIMING_CONFIG = {
+    "slowest": int(PROJECT_CONFIG.get("query_timing", {}).get("slowest", 3)),
+    "n_plus_one_threshold": int(PROJECT_CONFIG.get("query_timing", {}).get("n_plus_one_threshold", 5)),
+    "slow_ms": float(PROJECT_CONFIG.get("query_timing", {}).get("slow_ms", 200)),
+    "server_timing": bool(PROJECT_CONFIG.get("query_timing", {}).get("server_timing", True)),
+}
+
+# 请求指标：多进程汇总的目录（为空时只统计当前进程）、写入快照的间隔与过期快照的删除时间（秒）
+METRICS_CONFIG = {
+    "directory": PROJECT_DIR.joinpath(PROJECT_CONFIG["metrics"]["directory"])
+    if PROJECT_CONFIG.get("metrics", {}).get("directory") else None,
+    "flush_interval": float(PROJECT_CONFIG.get("metrics", {}).get("flush_interval", 5)),
+    "stale_seconds": float(PROJECT_CONFIG.get("metrics", {}).get("stale_seconds", 3600)),
+}
+
+# 多个连接间的XA两阶段提交：启动时检查未决分支的连接、提交决定日志的路径与未决分支的回滚等待时间
+XA_CONFIG = {
+    "connection_names": PROJECT_CONFIG.get("xa", {}).get("connection_names", ["master"]),
+    "log_path": PROJECT_DIR.joinpath(PROJECT_CONFIG.get("xa", {}).get("log_path", "logs/xa_decisions.log")),
+    "prefix": PROJECT_CONFIG.get("xa", {}).get("prefix", "fs"),
+    "recover_after": float(PROJECT_CONFIG.get("xa", {}).get("recover_after", 60)),
+}
+
 # 仅开发时需要记录迁移情况
 DEV and DATABASE_CONFIG["apps"].update(
     {